@@ -32,6 +32,8 @@ class _SimpleProxy(object):
 
 eye = _SimpleProxy(lambda: import_module('birdseye.bird').eye)
 BirdsEye = _SimpleProxy(lambda: import_module('birdseye.bird').BirdsEye)
+register_expander = _SimpleProxy(lambda: import_module('birdseye.bird').register_expander)
+register_opaque = _SimpleProxy(lambda: import_module('birdseye.bird').register_opaque)
 
 
 def load_ipython_extension(ipython_shell):
@@ -5,24 +5,30 @@ import inspect
 import json
 import os
 import sys
+import tokenize
 import traceback
+import warnings
+from bisect import bisect_left, bisect_right
+from time import perf_counter
+from tokenize import TokenInfo
 from collections import defaultdict, deque, namedtuple, Counter
-from functools import partial
+from functools import partial, wraps
 from itertools import chain, islice
-from threading import Lock
-from types import FrameType, TracebackType, CodeType, FunctionType, ModuleType
+from threading import Lock, local
+from types import FrameType, TracebackType, CodeType, FunctionType, ModuleType, BuiltinFunctionType
 from typing import Deque
 from uuid import uuid4
+from weakref import WeakKeyDictionary, ref
 
 from asttokens import ASTTokens
 from cached_property import cached_property
-from cheap_repr import cheap_repr, try_register_repr
+from cheap_repr import cheap_repr, register_repr, repr_registry, suppressed_classes
 from cheap_repr.utils import safe_qualname, exception_string
 from littleutils import group_by_key_func, only
 
 from birdseye import __version__
 from birdseye import tracer
-from birdseye.db import Database, retry_db
+from birdseye.cache import CodeCache
 from birdseye.tracer import (
     TreeTracerBase,
     TracedFile,
@@ -32,7 +38,6 @@ from birdseye.tracer import (
     ChangeValue,
 )
 from birdseye.utils import (
-    one_or_none,
     of_type,
     flatten_list,
     ProtocolEncoder,
@@ -41,43 +46,23 @@ from birdseye.utils import (
     is_future_import,
     get_unfrozen_datetime,
     FILE_SENTINEL_NAME,
+    first_lineno,
     read_source_file,
-    html_escape,
     format_pandas_index,
 )
+from birdseye.writer import CallRecord, CallWriter
 from functools import lru_cache
 
 from collections.abc import Sequence, Set, Mapping
 
-try:
-    from numpy import ndarray
-except Exception:
-    class ndarray(object):
-        pass
-
-try:
-    from pandas import DataFrame, Series
-except Exception:
-    class DataFrame(object):
-        pass
-
-
-    class Series(object):
-        pass
+if os.environ.get('BIRDSEYE_CHECK_OUTDATED'):
+    try:
+        from outdated import warn_if_outdated
 
-try:
-    from django.db.models import QuerySet
-except Exception:
-    class QuerySet(object):
+        warn_if_outdated("birdseye", __version__)
+    except Exception:
         pass
 
-try:
-    from outdated import warn_if_outdated
-
-    warn_if_outdated("birdseye", __version__)
-except Exception:
-    pass
-
 # noinspection PyUnreachableCode
 if False:
     from typing import (
@@ -89,11 +74,60 @@ if False:
         Iterator,
         Iterable,
         Union,
+        Callable,
     )
+    from birdseye.db import Database
     Loop = Union[ast.For, ast.While, ast.comprehension]
 
 
-CodeInfo = namedtuple('CodeInfo', 'db_func traced_file arg_names')
+CodeInfo = namedtuple('CodeInfo', 'function_hash traced_file arg_names')
+
+
+class _HookState(local):
+    # True while the current thread is running one of the hooks below.
+    # Code called by a hook (e.g. a traced __repr__ called by cheap_repr)
+    # must not be traced, otherwise the hooks would recurse into themselves.
+    active = False
+
+
+_hook_state = _HookState()
+
+
+def _non_reentrant(hook):
+    """
+    Makes the decorated hook do nothing and return None when it's called
+    from within another such hook in the same thread.
+    """
+
+    @wraps(hook)
+    def wrapper(*args):
+        if _hook_state.active:
+            return None
+        _hook_state.active = True
+        try:
+            return hook(*args)
+        finally:
+            _hook_state.active = False
+
+    return wrapper
+
+
+def _retry_db(func):
+    """
+    Like birdseye.db.retry_db, but only imports birdseye.db and SQLAlchemy
+    when the decorated function is first called.
+    """
+    retrying = []
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not retrying:
+            from birdseye.db import retry_db
+
+            retrying.append(retry_db(func))
+        return retrying[0](*args, **kwargs)
+
+    return wrapper
 
 
 class BirdsEye(TreeTracerBase):
@@ -110,8 +144,31 @@ class BirdsEye(TreeTracerBase):
         super(BirdsEye, self).__init__()
         self._db_uri = db_uri
         self._code_infos = {}  # type: Dict[CodeType, CodeInfo]
+
+        # Functions are stored in the database in batches, when a call
+        # to one of them is first written, so functions that are never called
+        # aren't stored at all. These map function hashes
+        # to the column values of Function rows that haven't been stored yet,
+        # and to the IDs of rows that have.
+        self._pending_functions = {}  # type: Dict[str, Dict[str, Any]]
+        self._function_ids = {}  # type: Dict[str, int]
+        self._functions_lock = Lock()
+        self._store_functions_lock = Lock()
         self._last_call_id = None
         self._ipython_cell_value = None
+        self.writer = CallWriter(self)
+        self._governor = None
+
+        # The hooks installed on this instance while there is a governor,
+        # and whether any function has been decorated without one
+        self._timed_hooks = {}  # type: Dict[str, Callable]
+        self._ungoverned_functions = False
+        self.code_cache = CodeCache() if os.environ.get('BIRDSEYE_CACHE_DIR') else None
+
+        # Limits on how much is recorded for each call, or None for no limit.
+        # See _expression_value and _call_data.
+        self.max_values_per_call = 100000
+        self.max_call_data_size = 50 * 1024 * 1024
         self.num_samples = num_samples or dict(
             big=dict(
                 attributes=50,
@@ -133,7 +190,110 @@ class BirdsEye(TreeTracerBase):
 
     @cached_property
     def db(self):
-        return Database(self._db_uri)
+        # type: () -> Database
+        """
+        Importing SQLAlchemy and checking the tables takes a while,
+        so this only happens when something is first written.
+        """
+        from birdseye.db import get_database
+
+        return get_database(self._db_uri)
+
+    @property
+    def governor(self):
+        """
+        An optional OverheadGovernor (see birdseye.governor) which decides
+        whether each call of a traced function is traced, based on the time
+        previous calls spent in this tracer's hooks.
+        Only functions decorated while there is a governor are governed,
+        so a warning is issued if it's set after decorating other functions.
+        """
+        return self._governor
+
+    @governor.setter
+    def governor(self, governor):
+        if governor is not None and self._ungoverned_functions:
+            warnings.warn('Functions decorated before setting the governor are not governed by it',
+                          stacklevel=2)
+        self._governor = governor
+
+        # The hooks are only timed while there is a governor,
+        # so that tracing without one pays nothing extra
+        if governor is None:
+            for name, hook in self._timed_hooks.items():
+                if self.__dict__.get(name) is hook:
+                    del self.__dict__[name]
+            self._timed_hooks = {}
+        elif not self._timed_hooks:
+            cls = type(self)
+            self._timed_hooks = dict(
+                enter_call=self._timed_enter_call(cls.enter_call),
+                after_expr=self._timed_hook(cls.after_expr),
+                after_stmt=self._timed_hook(cls.after_stmt),
+                exit_call=self._timed_exit_call(cls.exit_call),
+            )
+            self.__dict__.update(self._timed_hooks)
+
+    def _timed_hook(self, hook):
+        def timed(node, frame, *args):
+            start = perf_counter()
+            try:
+                return hook(self, node, frame, *args)
+            finally:
+                frame_info = self.stack.get(frame)
+                if frame_info is not None and hasattr(frame_info, 'overhead'):
+                    frame_info.overhead += perf_counter() - start
+
+        return timed
+
+    def _timed_enter_call(self, hook):
+        def timed_enter_call(enter_info):
+            # type: (EnterCallInfo) -> None
+            start = perf_counter()
+            hook(self, enter_info)
+            frame_info = self.stack[enter_info.current_frame]
+            frame_info.start_counter = start
+            frame_info.overhead = perf_counter() - start
+
+        return timed_enter_call
+
+    def _timed_exit_call(self, hook):
+        def timed_exit_call(exit_info):
+            # type: (ExitCallInfo) -> None
+            start = perf_counter()
+            hook(self, exit_info)
+            frame = exit_info.current_frame  # type: FrameType
+            frame_info = self.stack[frame]
+            governor = self._governor
+            if (governor is not None and frame.f_code in self._code_infos
+                    and hasattr(frame_info, 'start_counter')):
+                end = perf_counter()
+                governor.record_call(
+                    frame.f_code,
+                    runtime=end - frame_info.start_counter,
+                    overhead=frame_info.overhead + end - start,
+                )
+
+        return timed_exit_call
+
+    def _call_filter(self, traced, optional, sample_rate, when):
+        should_trace = super(BirdsEye, self)._call_filter(traced, optional, sample_rate, when)
+        if optional and should_trace is None:
+            return should_trace
+        if self._governor is None:
+            self._ungoverned_functions = True
+            return should_trace
+
+        code = traced.__code__
+
+        def allow():
+            # Look up the governor on each call so that it can be replaced or removed later
+            governor = self._governor
+            return governor is None or governor.allow(code)
+
+        if should_trace is None:
+            return lambda *_, **__: allow()
+        return lambda *args, **kwargs: allow() and should_trace(*args, **kwargs)
 
     def parse_extra(self, root, source, filename):
         # type: (ast.Module, str, str) -> None
@@ -141,13 +301,98 @@ class BirdsEye(TreeTracerBase):
             node._loops = tracer.loops(node)
             if isinstance(node, ast.expr):
                 node._is_interesting_expression = is_interesting_expression(node)
+            elif isinstance(node, ast.For):
+                node._can_exit_early = can_exit_early(node)
+
+    def needs_expr_hooks(self, node):
+        # type: (ast.expr) -> bool
+        if (type(self).before_expr is not BirdsEye.before_expr or
+                type(self).after_expr is not BirdsEye.after_expr):
+            return True
+
+        parent = node.parent
+        return (
+            # Values are recorded
+            node._is_interesting_expression or
+
+            # Literals containing dicts may still raise an exception, e.g. {[]: 1},
+            # and exceptions are recorded in the innermost expression being evaluated
+            any(isinstance(n, ast.Dict) for n in ast.walk(node)) or
+
+            # These are needed by before_expr, after_expr, and exit_call
+            isinstance(parent, ast.While) and node is parent.test or
+            isinstance(parent, (ast.For, ast.comprehension)) and node is parent.iter or
+            isinstance(parent, ast.Return)
+        )
 
     @lru_cache()
     def compile(self, source, filename, flags=0):
+        cache = self.code_cache
+        if type(self).parse_extra is not BirdsEye.parse_extra:
+            # The cache doesn't know what else parse_extra does to the nodes
+            cache = None
+
+        data = cache and cache.load(self, source, filename, flags)
+        if data:
+            traced_file = TracedFile(self, source, filename, flags, cached=data)
+            cache.release_names(traced_file, data)
+            self._load_node_data(traced_file, source, data['nodes'])
+            return traced_file
+
         traced_file = super(BirdsEye, self).compile(source, filename, flags)
         traced_file.tokens = ASTTokens(source, tree=traced_file.root)
+
+        data = traced_file.cache_data()
+        if cache and data:
+            data['nodes'] = self._node_data(traced_file)
+            cache.store(self, source, filename, flags, data)
+            cache.release_names(traced_file, data)
         return traced_file
 
+    def _node_data(self, traced_file):
+        # type: (TracedFile) -> dict
+        """
+        The attributes added to nodes by parse_extra and ASTTokens,
+        for the code cache, with nodes replaced by their _tree_index.
+        """
+        nodes = traced_file.nodes
+        return dict(
+            loops=[[loop._tree_index for loop in node._loops] for node in nodes],
+            interesting=[getattr(node, '_is_interesting_expression', None) for node in nodes],
+            exits=[getattr(node, '_can_exit_early', None) for node in nodes],
+            tokens=[tok[:4] for tok in traced_file.tokens.tokens],
+            token_indices=[
+                (node.first_token.index, node.last_token.index)
+                if hasattr(node, 'first_token') else None
+                for node in nodes
+            ],
+        )
+
+    def _load_node_data(self, traced_file, source, data):
+        # type: (TracedFile, str, dict) -> None
+        """
+        The reverse of _node_data.
+        """
+        nodes = traced_file.nodes
+        for node, loops, interesting, exits in zip(
+                nodes, data['loops'], data['interesting'], data['exits']):
+            node._loops = tuple(nodes[i] for i in loops)
+            if interesting is not None:
+                node._is_interesting_expression = interesting
+            if exits is not None:
+                node._can_exit_early = exits
+
+        lines = source.splitlines(True)
+        traced_file.tokens = ASTTokens(source, tokens=[
+            TokenInfo(typ, string, start, end, lines[start[0] - 1] if start[0] <= len(lines) else '')
+            for typ, string, start, end in data['tokens']
+        ])
+        tokens = traced_file.tokens.tokens
+        for node, indices in zip(nodes, data['token_indices']):
+            if indices:
+                node.first_token = tokens[indices[0]]
+                node.last_token = tokens[indices[1]]
+
     def before_stmt(self, node, frame):
         # type: (ast.stmt, FrameType) -> None
         if frame.f_code not in self._code_infos:
@@ -165,20 +410,35 @@ class BirdsEye(TreeTracerBase):
         Given one or more nested loops, add an iteration for the innermost
         loop (the last in the sequence).
         """
-        iteration = self.stack[frame].iteration  # type: Iteration
-        for i, loop_node in enumerate(loops):
-            loop = iteration.loops[loop_node._tree_index]
-            if i == len(loops) - 1:
-                loop.append(Iteration())
-            else:
-                iteration = loop.last()
+        frame_info = self.stack[frame]
+        current_loops = frame_info.current_loops
+        loop_node = loops[-1]
+        if len(loops) > 1:
+            outer_loop = current_loops[loops[-2]]
+            parent = outer_loop.last()
+            first = outer_loop.first_iteration
+        else:
+            parent = frame_info.iteration
+            first = True
+        loop = parent.loops[loop_node._tree_index]
+        loop.next_iteration()
+        loop.first_iteration = first and loop.length == 1
+        current_loops[loop_node] = loop
+
+    def _current_iteration(self, frame_info, loops):
+        # type: (FrameInfo, Sequence[Loop]) -> Iteration
+        """
+        Returns the Iteration where the values of nodes directly inside
+        the given loops are currently being stored.
+        """
+        if loops:
+            return frame_info.current_loops[loops[-1]].last()
+        return frame_info.iteration
 
+    @_non_reentrant
     def after_expr(self, node, frame, value, exc_value, exc_tb):
         # type: (ast.expr, FrameType, Any, Optional[BaseException], Optional[TracebackType]) -> Optional[ChangeValue]
 
-        if _tracing_recursively(frame):
-            return None
-
         if frame.f_code not in self._code_infos:
             return None
 
@@ -197,14 +457,31 @@ class BirdsEye(TreeTracerBase):
             frame_info = self.stack[frame]
             if exc_value:
                 node_value = self._exception_value(node, frame, exc_value)
+                self._check_inner_call(frame_info, node, node_value)
             else:
-                node_value = NodeValue.expression(
-                    self.num_samples,
-                    value,
-                    level=max(1, 3 - len(node._loops) * (not self._is_first_loop_iteration(node, frame))),
-                )
-                self._set_node_value(node, frame, node_value)
-            self._check_inner_call(frame_info, node, node_value)
+                iteration = self._discarded_iteration(frame_info, node)
+                if iteration:
+                    # Most likely the value will never be needed,
+                    # so only note that the expression was evaluated
+                    node_value = NodeValue.covered()
+                else:
+                    node_value = self._expression_value(
+                        frame_info,
+                        value,
+                        level=max(1, 3 - len(node._loops) * (not self._is_first_loop_iteration(node, frame))),
+                    )
+                inner_calls = frame_info.inner_calls.pop(node, None)
+                if inner_calls:
+                    node_value = node_value.with_meta('inner_calls', inner_calls)
+                if iteration:
+                    iteration.vals[node._tree_index] = node_value
+                else:
+                    self._set_node_value(node, frame, node_value)
+
+        if isinstance(node.parent, ast.For) and node is node.parent.iter:
+            if not exc_value:
+                self._set_expected_length(node, frame, value)
+            return None
 
         # i.e. is `node` the `y` in `[f(x) for x in y]`, making `node.parent` the `for x in y`
         is_special_comprehension_iter = (
@@ -221,25 +498,86 @@ class BirdsEye(TreeTracerBase):
         if exc_value:
             return None
 
+        self._set_expected_length(node, frame, value)
+
         # Track each iteration over `y` so that the 'loop' can be stepped through
         loops = node._loops + (node.parent,)  # type: Tuple[Loop, ...]
 
         is_genexpr = isinstance(node.parent.parent, ast.GeneratorExp)
 
         def comprehension_iter_proxy():
+            loop = None
             for item in value:
+                if loop is not None and loop.in_middle:
+                    # Other comprehensions run to completion before anything else
+                    # in the frame, so the IterationList is still current and
+                    # the iteration can advance without looking it up again
+                    loop.next_iteration()
                 # Don't try to add an iteration if this is a generator
                 # which has outlived its main frame
-                # This way of doing things has the weird side effect
-                # of grey values when the main frame is still alive
-                # but the generator is evaluated elsewhere
-                if not (is_genexpr and frame not in self.stack):
+                elif not (is_genexpr and frame not in self.stack):
                     self._add_iteration(loops, frame)
+                    if not is_genexpr:
+                        loop = self.stack[frame].current_loops[node.parent]
                 yield item
 
         # This effectively changes to code to `for x in comprehension_iter_proxy()`
         return ChangeValue(comprehension_iter_proxy())
 
+    def _set_expected_length(self, node, frame, value):
+        # type: (ast.expr, FrameType, Any) -> None
+        """
+        `node` is the iterable of a for loop or comprehension which is about to start.
+        If the length of its value is cheap to find and the loop is long enough
+        that some iterations will be discarded, tell the IterationList.
+        Not for loops which may stop early, whose last iterations would then
+        be kept after their values were skipped.
+        """
+        if type(value) not in _sized_types:
+            return
+        if getattr(node.parent, '_can_exit_early', False):
+            return
+        length = len(value)
+        if length <= 2 * IterationList.side_len:
+            return
+        iteration = self._current_iteration(self.stack[frame], node._loops)
+        loop = iteration.loops[node.parent._tree_index]
+        if not loop.length:
+            loop.expected_length = length
+
+    def _discarded_iteration(self, frame_info, node):
+        # type: (FrameInfo, ast.expr) -> Optional[Iteration]
+        """
+        Returns the iteration of the innermost loop containing `node` if that
+        iteration is expected to be discarded, meaning that the value of `node`
+        in it is not needed, or None otherwise.
+        """
+        if not node._loops:
+            return None
+        loop = frame_info.current_loops[node._loops[-1]]
+        iteration = loop.last()
+        # If this node hasn't been recorded enough in the loop,
+        # recording it will mark the iteration to keep
+        if loop.in_middle and not iteration.keep and loop.recorded[node] >= 2:
+            return iteration
+        return None
+
+    def _expression_value(self, frame_info, value, level):
+        # type: (FrameInfo, Any, int) -> NodeValue
+        """
+        Records the value of an expression within the limit of max_values_per_call.
+        After half the limit only the repr of each value is recorded,
+        and after the whole limit only the fact that the expression ran.
+        """
+        frame_info.num_values += 1
+        limit = self.max_values_per_call
+        if limit is not None and frame_info.num_values * 2 > limit:
+            frame_info.truncated = True
+            if frame_info.num_values > limit:
+                return NodeValue.covered()
+            level = 0
+        return NodeValue.expression(self.num_samples, value, level)
+
     def _check_inner_call(self, frame_info, node, node_value):
         # type: (FrameInfo, Union[ast.stmt, ast.expr], NodeValue) -> None
         inner_calls = frame_info.inner_calls.pop(node, None)
@@ -248,22 +586,33 @@ class BirdsEye(TreeTracerBase):
 
     def _is_first_loop_iteration(self, node, frame):
         # type: (ast.AST, FrameType) -> bool
-        iteration = self.stack[frame].iteration  # type: Iteration
-        for loop_node in node._loops:  # type: ast.AST
-            loop = iteration.loops[loop_node._tree_index]
-            iteration = loop.last()
-            if iteration.index > 0:
-                return False
-        return True
+        loops = node._loops
+        return not loops or self.stack[frame].current_loops[loops[-1]].first_iteration
 
     def _set_node_value(self, node, frame, value):
         # type: (ast.AST, FrameType, NodeValue) -> None
-        iteration = self.stack[frame].iteration  # type: Iteration
-        for loop_node in node._loops:  # type: ast.AST
-            loop = iteration.loops[loop_node._tree_index]
+        frame_info = self.stack[frame]
+        loops = node._loops
+        if not loops:
+            frame_info.iteration.vals[node._tree_index] = value
+            return
+
+        current_loops = frame_info.current_loops
+        innermost_loop = loop = current_loops[loops[-1]]
+
+        # A node can't have been recorded in the innermost loop more often
+        # than in the loops around it, so going outwards, the loops which
+        # still need to see it all come before the first one that doesn't.
+        # Each loop sees each node at most twice, so this is cheap on average.
+        i = len(loops) - 1
+        while loop.recorded[node] < 2:
             loop.recorded_node(node)
-            iteration = loop.last()
-        iteration.vals[node._tree_index] = value
+            if not i:
+                break
+            i -= 1
+            loop = current_loops[loops[i]]
+
+        innermost_loop.last().vals[node._tree_index] = value
 
     def _exception_value(self, node, frame, exc_value):
         # type: (Union[ast.expr, ast.stmt], FrameType, BaseException) -> NodeValue
@@ -271,9 +620,10 @@ class BirdsEye(TreeTracerBase):
         self._set_node_value(node, frame, value)
         return value
 
+    @_non_reentrant
     def after_stmt(self, node, frame, exc_value, exc_traceback, exc_node):
         # type: (ast.stmt, FrameType, Optional[BaseException], Optional[TracebackType], Optional[ast.AST]) -> Optional[bool]
-        if frame.f_code not in self._code_infos or _tracing_recursively(frame):
+        if frame.f_code not in self._code_infos:
             return None
         if exc_value and node is exc_node:
             value = self._exception_value(node, frame, exc_value)
@@ -283,15 +633,26 @@ class BirdsEye(TreeTracerBase):
         self._check_inner_call(self.stack[frame], node, value)
         return None
 
+    @_non_reentrant
     def enter_call(self, enter_info):
         # type: (EnterCallInfo) -> None
         frame = enter_info.current_frame  # type: FrameType
-        if frame.f_code not in self._code_infos or _tracing_recursively(frame):
+        if frame.f_code not in self._code_infos:
             return
         frame_info = self.stack[frame]
         frame_info.start_time = get_unfrozen_datetime()
         frame_info.iteration = Iteration()
 
+        # The IterationList of the current run of each loop (by loop node)
+        # that has started in this call, so that finding where to store
+        # a value doesn't need to go through all the loops around it
+        frame_info.current_loops = {}  # type: Dict[Loop, IterationList]
+
+        # Number of expression values recorded so far, and whether any were
+        # left out or shortened because of max_values_per_call
+        frame_info.num_values = 0
+        frame_info.truncated = False
+
         code_info = self._code_infos[frame.f_code]
         if isinstance(enter_info.enter_node.parent, ast.Module):
             arguments = []
@@ -305,8 +666,11 @@ class BirdsEye(TreeTracerBase):
                             # the enclosing scope. It's handy to treat them like arguments in the UI
                             it for it in f_locals.items()
                             if it[0][0] != '.'  # Appears when using nested tuple arguments
+                            and not it[0].startswith('_treetrace_hidden_')
                         ]
-        frame_info.arguments = json.dumps([[k, cheap_repr(v)] for k, v in arguments])
+        library_types.update()
+        _expression_memo.check_repr_settings()
+        frame_info.arguments = json.dumps([[k, _repr_value(v)] for k, v in arguments])
         frame_info.call_id = self._call_id()
         frame_info.inner_calls = defaultdict(list)
         prev = self.stack.get(enter_info.caller_frame)
@@ -319,22 +683,18 @@ class BirdsEye(TreeTracerBase):
         # type: () -> Text
         return uuid4().hex
 
+    @_non_reentrant
     def exit_call(self, exit_info):
         # type: (ExitCallInfo) -> None
         """
         This is where all the data collected during the call is gathered up
-        and sent to the database.
+        and handed to self.writer to be stored in the database.
         """
         frame = exit_info.current_frame  # type: FrameType
-        if frame.f_code not in self._code_infos or _tracing_recursively(frame):
+        if frame.f_code not in self._code_infos:
             return
         frame_info = self.stack[frame]
 
-        top_iteration = frame_info.iteration  # type: Iteration
-        node_values = _deep_dict()
-        self._extract_node_values(top_iteration, (), node_values)
-
-        db_func = self._code_infos[frame.f_code].db_func
         exc = exit_info.exc_value  # type: Optional[Exception]
         if exc:
             traceback_str = ''.join(traceback.format_exception(type(exc), exc, exit_info.exc_tb))
@@ -342,33 +702,62 @@ class BirdsEye(TreeTracerBase):
         else:
             traceback_str = exception = None
 
-        @retry_db
-        def add_call():
-            Call = self.db.Call
-            call = Call(id=frame_info.call_id,
-                        function_id=db_func,
-                        arguments=frame_info.arguments,
-                        return_value=cheap_repr(exit_info.return_value),
-                        exception=exception,
-                        traceback=traceback_str,
-                        data=json.dumps(
-                            dict(
-                                node_values=node_values,
-                                loop_iterations=top_iteration.extract_iterations()['loops'],
-                                type_names=type_registry.names(),
-                                num_special_types=type_registry.num_special_types,
-                            ),
-                            cls=ProtocolEncoder,
-                            separators=(',', ':')
-                        ),
-                        start_time=frame_info.start_time)
-            with self.db.session_scope() as session:
-                session.add(call)
-
-        add_call()
+        self.writer.add_call(CallRecord(
+            id=frame_info.call_id,
+            function_hash=self._code_infos[frame.f_code].function_hash,
+            arguments=frame_info.arguments,
+            return_value=_repr_value(exit_info.return_value),
+            exception=exception,
+            traceback=traceback_str,
+            iteration=frame_info.iteration,
+            start_time=frame_info.start_time,
+            truncated=frame_info.truncated,
+        ))
 
         self._last_call_id = frame_info.call_id
 
+    @_retry_db
+    def _write_calls(self, records):
+        # type: (List[CallRecord]) -> None
+        """
+        Stores the given calls in the database in a single transaction.
+        Called by self.writer.
+        """
+        Call = self.db.Call
+        calls = [Call(id=record.id,
+                      function_id=self._function_id(record.function_hash),
+                      arguments=record.arguments,
+                      return_value=record.return_value,
+                      exception=record.exception,
+                      traceback=record.traceback,
+                      data=self._call_data(record.iteration, record.truncated),
+                      start_time=record.start_time)
+                 for record in records]
+        with self.db.session_scope() as session:
+            session.add_all(calls)
+
+    def _call_data(self, top_iteration, truncated=False):
+        # type: (Iteration, bool) -> str
+        node_values = _deep_dict()
+        self._extract_node_values(top_iteration, (), node_values)
+        data = dict(
+            node_values=node_values,
+            loop_iterations=top_iteration.extract_iterations()['loops'],
+            type_names=type_registry.names(),
+            num_special_types=type_registry.num_special_types,
+        )
+        if truncated:
+            data['truncated'] = True
+        result = json.dumps(data, cls=ProtocolEncoder, separators=(',', ':'))
+
+        limit = self.max_call_data_size
+        if limit is not None and len(result) > limit:
+            # Keep which expressions ran, but not their values
+            _coverage_only(node_values)
+            data['truncated'] = True
+            result = json.dumps(data, cls=ProtocolEncoder, separators=(',', ':'))
+        return result
+
     def _extract_node_values(self, iteration, path, node_values):
         # type: (Iteration, Tuple[int, ...], dict) -> None
         """
@@ -399,22 +788,23 @@ class BirdsEye(TreeTracerBase):
             for i, iteration in enumerate(loop):
                 self._extract_node_values(iteration, path + (i,), node_values)
 
-    def trace_function(self, func):
-        # type: (FunctionType) -> FunctionType
-        new_func = super(BirdsEye, self).trace_function(func)
+    def trace_function(self, func, expressions=True):
+        # type: (FunctionType, bool) -> FunctionType
+        new_func = super(BirdsEye, self).trace_function(func, expressions)
         code_info = self._code_infos.get(new_func.__code__)
         if code_info:
             return new_func
 
-        lines, start_lineno = inspect.getsourcelines(func)  # type: List[Text], int
-        end_lineno = start_lineno + len(lines)
+        traced_file = new_func.traced_file
+        func_node = traced_file.function_node(new_func.__code__)
+        start_lineno = first_lineno(func_node)
+        end_lineno = _end_lineno(traced_file, func_node)
         name = safe_qualname(func)
         source_file = inspect.getsourcefile(func)
         if source_file.startswith('<ipython-input'):
             filename = IPYTHON_FILE_PATH
         else:
             filename = os.path.abspath(source_file)
-        traced_file = new_func.traced_file
 
         arg_info = inspect.getargs(new_func.__code__)
         arg_names = list(chain(flatten_list(arg_info[0]), arg_info[1:]))  # type: List[str]
@@ -446,6 +836,7 @@ class BirdsEye(TreeTracerBase):
             shell.ex(traced_file.code)
             return self._ipython_cell_value
         finally:
+            self.writer.flush()
             callback(self._last_call_id)
             self._ipython_cell_value = None
 
@@ -484,35 +875,18 @@ class BirdsEye(TreeTracerBase):
         self._trace(FILE_SENTINEL_NAME, filename, traced_file, traced_file.code, 'module', source)
 
         if deep:
-            nodes_by_lineno = {
-                node.lineno: node
-                for node in traced_file.nodes
-                if isinstance(node, ast.FunctionDef)
-            }
-
-            def find_code(root_code):
-                # type: (CodeType) -> None
-                for code in root_code.co_consts:  # type: CodeType
-                    if not inspect.iscode(code) or code.co_name.startswith('<'):
-                        continue
-
-                    find_code(code)
-
-                    lineno = code.co_firstlineno
-                    node = nodes_by_lineno.get(lineno)
-                    if not node:
-                        continue
-
+            for node in traced_file.nodes:
+                if not isinstance(node, ast.FunctionDef):
+                    continue
+                for code in traced_file.find_codes(node.lineno, node.name):
                     self._trace(
                         code.co_name, filename, traced_file, code,
                         typ='function',
                         source=source,
-                        start_lineno=lineno,
+                        start_lineno=node.lineno,
                         end_lineno=node.last_token.end[0] + 1,
                     )
 
-            find_code(traced_file.code)
-
         exec(traced_file.code, globs, locs)
 
     def _trace(
@@ -530,7 +904,6 @@ class BirdsEye(TreeTracerBase):
         if not end_lineno:
             end_lineno = start_lineno + len(source.splitlines())
         nodes = list(self._nodes_of_interest(traced_file, start_lineno, end_lineno))
-        html_body = self._nodes_html(nodes, start_lineno, end_lineno, traced_file)
 
         data_dict = dict(
             # This maps each node to the loops enclosing that node
@@ -539,6 +912,7 @@ class BirdsEye(TreeTracerBase):
                 for node, _ in nodes
                 if node._loops
             },
+            html=self._html_data(nodes, start_lineno, end_lineno, traced_file),
         )
         if typ == 'function':
             tokens = traced_file.tokens
@@ -554,8 +928,8 @@ class BirdsEye(TreeTracerBase):
             )
 
         data = json.dumps(data_dict, sort_keys=True)
-        db_func = self._db_func(data, filename, html_body, name, start_lineno, source, typ)
-        self._code_infos[code] = CodeInfo(db_func, traced_file, arg_names)
+        function_hash = self._add_function(data, filename, name, start_lineno, source, typ)
+        self._code_infos[code] = CodeInfo(function_hash, traced_file, arg_names)
 
     def _loop_ranges(self, nodes, tokens, func_start):
         # For a for loop, e.g.
@@ -607,33 +981,126 @@ class BirdsEye(TreeTracerBase):
                 classes=classes,
             )
 
-    @retry_db
-    def _db_func(self, data, filename, html_body, name, start_lineno, source, typ):
+    def _add_function(self, data, filename, name, start_lineno, source, typ):
+        # type: (str, str, str, int, str, str) -> str
         """
-        Retrieve the Function object from the database if one exists, or create one.
+        Queues a Function to be stored in the database, unless it already has an ID,
+        and returns its hash.
         """
         def h(s):
             return hashlib.sha256(s.encode('utf8')).hexdigest()
 
-        function_hash = h(filename + name + html_body + data + str(start_lineno))
+        # data includes the source and the nodes shown in the HTML
+        function_hash = h(filename + name + data + str(start_lineno))
+
+        with self._functions_lock:
+            if function_hash not in self._function_ids:
+                self._pending_functions[function_hash] = dict(
+                    file=filename,
+                    name=name,
+                    type=typ,
+                    lineno=start_lineno,
+                    data=data,
+                    body_hash=h(source),
+                    hash=function_hash,
+                )
+        return function_hash
 
-        Function = self.db.Function
+    def _function_id(self, function_hash):
+        # type: (str) -> int
+        function_id = self._function_ids.get(function_hash)
+        if function_id is None:
+            self._store_functions()
+            function_id = self._function_ids[function_hash]
+        return function_id
 
-        with self.db.session_scope() as session:
-            db_func = one_or_none(session.query(Function).filter_by(hash=function_hash))  # type: Optional[Function]
-            if not db_func:
-                db_func = Function(file=filename,
-                                   name=name,
-                                   type=typ,
-                                   html_body=html_body,
-                                   lineno=start_lineno,
-                                   data=data,
-                                   body_hash=h(source),
-                                   hash=function_hash)
-                session.add(db_func)
-                session.commit()  # ensure .id exists
-            assert isinstance(db_func.id, int)
-            return db_func.id
+    def _store_functions(self):
+        """
+        Finds the IDs of all pending functions, first in the code cache
+        and then in the database, and inserts the ones that are missing,
+        using one query and one transaction for each batch.
+        Only one thread does this at a time, but _functions_lock isn't held
+        during the I/O so that decorating functions isn't blocked by it.
+        """
+        with self._store_functions_lock:
+            with self._functions_lock:
+                pending = self._pending_functions
+                if not pending:
+                    return
+                self._pending_functions = {}
+
+            try:
+                function_ids = self._stored_function_ids(pending)
+            except BaseException:
+                with self._functions_lock:
+                    # Try again next time
+                    for function_hash, row in pending.items():
+                        self._pending_functions.setdefault(function_hash, row)
+                raise
+
+            with self._functions_lock:
+                self._function_ids.update(function_ids)
+
+    def _stored_function_ids(self, pending):
+        # type: (Dict[str, Dict[str, Any]]) -> Dict[str, int]
+        pending = dict(pending)
+        function_ids = {}  # type: Dict[str, int]
+        cache = self.code_cache
+        if cache is not None:
+            cached_ids = cache.load_function_ids(self._db_key)
+            for function_hash in list(pending):
+                if function_hash in cached_ids:
+                    function_ids[function_hash] = cached_ids[function_hash]
+                    del pending[function_hash]
+            if not pending:
+                return function_ids
+
+        db_function_ids = self._db_function_ids(list(pending.values()))
+        if cache is not None:
+            cache.store_function_ids(self._db_key, db_function_ids)
+        function_ids.update(db_function_ids)
+        return function_ids
+
+    @cached_property
+    def _db_key(self):
+        # type: () -> str
+        db = self.db
+        return db.db_uri + '\0' + db.instance_id
+
+    @_retry_db
+    def _db_function_ids(self, rows):
+        # type: (List[Dict[str, Any]]) -> Dict[str, int]
+        """
+        Retrieves the IDs of the given Function rows from the database,
+        inserting the rows that don't exist yet.
+        """
+        from sqlalchemy.exc import IntegrityError
+
+        Function = self.db.Function
+        hashes = [row['hash'] for row in rows]
+        for attempt in range(2):
+            function_ids = {}  # type: Dict[str, int]
+            try:
+                with self.db.session_scope() as session:
+                    # Chunked to stay below the limit on query parameters in SQLite
+                    for i in range(0, len(hashes), 500):
+                        function_ids.update(
+                            session.query(Function.hash, Function.id)
+                                .filter(Function.hash.in_(hashes[i:i + 500]))
+                        )
+                    new_funcs = [Function(**row) for row in rows
+                                 if row['hash'] not in function_ids]
+                    session.add_all(new_funcs)
+                    session.flush()  # ensure .id exists
+                    for func in new_funcs:
+                        assert isinstance(func.id, int)
+                        function_ids[func.hash] = func.id
+                return function_ids
+            except IntegrityError:
+                # Another process inserted some of the same functions in the meantime,
+                # so the query will find them next time
+                if attempt:
+                    raise
 
     def _nodes_of_interest(self, traced_file, start_lineno, end_lineno):
         # type: (TracedFile, int, int) -> Iterator[Tuple[ast.AST, Tuple]]
@@ -641,105 +1108,50 @@ class BirdsEye(TreeTracerBase):
         Nodes that may have a value, show up as a box in the UI, and lie within the
         given line range.
         """
-        for node in traced_file.nodes:
-            classes = []
-
-            if isinstance(node, (ast.While, ast.For, ast.comprehension)):
-                classes.append('loop')
-            if isinstance(node, ast.stmt):
-                classes.append('stmt')
-
-            if isinstance(node, ast.expr):
-                if not node._is_interesting_expression:
-                    continue
-            elif not classes:
-                continue
-
-            assert isinstance(node, ast.AST)
-
-            # In particular FormattedValue is missing this
-            if not hasattr(node, 'first_token'):
-                continue
-
-            if not start_lineno <= node.first_token.start[0] <= end_lineno:
-                continue
-
-            start, end = traced_file.tokens.get_text_range(node)  # type: int, int
-            if start == end == 0:
-                continue
-
-            yield node, (classes, start, end)
-
-    def _nodes_html(self, nodes, start_lineno, end_lineno, traced_file):
-        # type: (list, int, int, TracedFile) -> str
+        index = self._node_index(traced_file)
+        entries = index.entries[
+                  bisect_left(index.linenos, start_lineno):
+                  bisect_right(index.linenos, end_lineno)]
+        entries.sort(key=lambda entry: entry[0]._tree_index)
+        return iter(entries)
+
+    @staticmethod
+    def _node_index(traced_file):
+        # type: (TracedFile) -> NodeIndex
+        index = getattr(traced_file, '_node_index', None)
+        if index is None:
+            index = traced_file._node_index = NodeIndex(traced_file)
+        return index
+
+    def _html_data(self, nodes, start_lineno, end_lineno, traced_file):
+        # type: (list, int, int, TracedFile) -> dict
         """
-        The algorithm for generating the HTML works as follows. We generate a list
-        of HTMLPositions, which are essentially places to insert HTML into the source plus some
-        metadata. The order of the fields of HTMLPosition ensure that when the list is sorted,
-        the resulting HTML is valid and correct. Specifically, the fields are:
-        
-          1. index: the index in the source string where the HTML would be inserted
-          2. is_start: Indicates if this piece of HTML is the start of a tag, rather than the end.
-             Ends should appear first, so that the resulting HTML looks like:
-                <span> ... </span><span> ... </span>
-             rather than:
-                <span> ... <span></span> ... </span>
-             (I think this might actually be unnecessary, since I can't think of any cases of two
-              expressions right next to each other with nothing in between)
-          3. depth: the depth of the corresponding node in the AST. We want the start of a tag from
-             a node to appear before the start of a tag nested within, e.g. `foo()` should become:
-                <span [for foo()]><span [for foo]>foo</span>()</span>
-             rather than:   
-                <span [for foo]><span [for foo()]>foo</span>()</span>
-          4. html: the actual HTML to insert. Not important for ordering.
-          
-        Mostly the list contains pairs of HTMLPositions corresponding to AST nodes, one for the
-        start and one for the end.
-        
-        After the list is sorted, the HTML generated is essentially:
-        
-        source[0:positions[0].index] + positions[0].html + source[positions[0].index:positions[1].index] + positions[1].html + ...
+        Returns the data needed by render_html_body to show the given lines of the file
+        with boxes around the given nodes. The HTML itself is only rendered
+        by the server when the function is first viewed.
+        Offsets are relative to the start of the lines.
         """
+        index = self._node_index(traced_file)
+        source_start = index.line_start(start_lineno)
+        source_end = max(index.line_start(end_lineno) - 1, source_start)
+
+        html_nodes = [
+            [node._tree_index, ' '.join(classes), node._depth, start - source_start, end - source_start]
+            for node, (classes, start, end) in nodes
+        ]
+        breaks = [
+            position - source_start
+            for position in self._separate_comprehensions([n[0] for n in nodes], traced_file)
+        ]
+
+        return dict(
+            source=traced_file.source[source_start:source_end],
+            nodes=html_nodes,
+            breaks=breaks,
+        )
 
-        traced_file.root._depth = 0
-        for node in ast.walk(traced_file.root):  # type: ast.AST
-            for child in ast.iter_child_nodes(node):
-                child._depth = node._depth + 1
-
-        positions = []  # type: List[HTMLPosition]
-
-        for node, (classes, start, end) in nodes:
-            # noinspection PyArgumentList
-            positions.extend(map(
-                HTMLPosition,
-                [start, end],
-                [True, False],  # is_start
-                [node._depth, node._depth],
-                ['<span data-index="%s" class="%s">' % (node._tree_index, ' '.join(classes)),
-                 '</span>']))
-
-        end_lineno = self._separate_comprehensions(
-            [n[0] for n in nodes],
-            end_lineno, positions, traced_file)
-
-        # This just makes the loop below simpler
-        positions.append(HTMLPosition(len(traced_file.source), False, 0, ''))
-
-        positions.sort()
-
-        html_parts = []
-        start = 0
-        for position in positions:
-            html_parts.append(html_escape(traced_file.source[start:position.index]))
-            html_parts.append(position.html)
-            start = position.index
-        html_body = ''.join(html_parts)
-        html_body = '\n'.join(html_body.split('\n')[start_lineno - 1:end_lineno - 1])
-
-        return html_body.strip('\n')
-
-    def _separate_comprehensions(self, nodes, end_lineno, positions, traced_file):
-        # type: (list, int, List[HTMLPosition], TracedFile) -> int
+    def _separate_comprehensions(self, nodes, traced_file):
+        # type: (list, TracedFile) -> List[int]
         """
         Comprehensions (e.g. list comprehensions) are troublesome because they can
         be navigated like loops, and the buttons for these need to be on separate lines.
@@ -754,7 +1166,10 @@ class BirdsEye(TreeTracerBase):
          for y in range(5)] and
         [[x + y for x in range(3)]
          for y in range(5)]
+
+        Returns the positions in the source where newlines should be inserted.
         """
+        breaks = []
 
         comprehensions = group_by_key_func(of_type((ast.comprehension, ast.While, ast.For), nodes),
                                            lambda c: c.first_token.start[0]
@@ -774,33 +1189,100 @@ class BirdsEye(TreeTracerBase):
                 else:
                     start = get_start(comp)
                 if prev_start is not None:
-                    positions.append(HTMLPosition(start, True, 0, '\n '))
-                    end_lineno += 1
+                    breaks.append(start)
                 prev_start = start
 
-        return end_lineno
+        return breaks
 
 
-eye = BirdsEye()
+class NodeIndex(object):
+    """
+    The nodes of a TracedFile which can show up as a box in the UI, sorted by line,
+    and the offsets where each line of the source starts. This is computed once per file
+    so that finding the nodes and HTML of each function only costs the size of
+    the function, rather than the whole file.
+    """
 
-HTMLPosition = namedtuple('HTMLPosition', 'index is_start depth html')
+    def __init__(self, traced_file):
+        # type: (TracedFile) -> None
+        traced_file.root._depth = 0
+        for node in ast.walk(traced_file.root):  # type: ast.AST
+            for child in ast.iter_child_nodes(node):
+                child._depth = node._depth + 1
 
+        entries = []
+        for node in traced_file.nodes:
+            classes = []
 
-def _deep_dict():
-    return defaultdict(_deep_dict)
+            if isinstance(node, (ast.While, ast.For, ast.comprehension)):
+                classes.append('loop')
+            if isinstance(node, ast.stmt):
+                classes.append('stmt')
 
+            if isinstance(node, ast.expr):
+                if not node._is_interesting_expression:
+                    continue
+            elif not classes:
+                continue
 
-_bad_codes = (eye.enter_call.__code__,
-              eye.exit_call.__code__,
-              eye.after_expr.__code__,
-              eye.after_stmt.__code__)
+            assert isinstance(node, ast.AST)
 
+            # In particular FormattedValue is missing this
+            if not hasattr(node, 'first_token'):
+                continue
 
-def _tracing_recursively(frame):
-    while frame:
-        if frame.f_code in _bad_codes:
-            return True
-        frame = frame.f_back
+            start, end = traced_file.tokens.get_text_range(node)  # type: int, int
+            if start == end == 0:
+                continue
+
+            entries.append((node.first_token.start[0], node, (classes, start, end)))
+
+        # Sorting is stable, so nodes on the same line stay in tree order
+        entries.sort(key=lambda entry: entry[0])
+        self.linenos = [entry[0] for entry in entries]  # type: List[int]
+        self.entries = [entry[1:] for entry in entries]  # type: List[Tuple[ast.AST, Tuple]]
+
+        source = traced_file.source
+        self.line_starts = line_starts = [0]
+        offset = source.find('\n')
+        while offset != -1:
+            line_starts.append(offset + 1)
+            offset = source.find('\n', offset + 1)
+        self.source_length = len(source)
+
+    def line_start(self, lineno):
+        # type: (int) -> int
+        """
+        The offset in the source where the given line (starting from 1) starts,
+        or one more than the length of the source if there's no such line.
+        """
+        if lineno - 1 < len(self.line_starts):
+            return self.line_starts[lineno - 1]
+        return self.source_length + 1
+
+
+eye = BirdsEye()
+
+
+def _coverage_only(node_values):
+    # type: (dict) -> None
+    """
+    Replaces the values of expressions in node_values (see BirdsEye._call_data)
+    with NodeValue.covered(), keeping exceptions and links to inner calls.
+    """
+    for key, value in node_values.items():
+        if isinstance(value, dict):
+            _coverage_only(value)
+        elif value.type_index >= 0:
+            covered = NodeValue.covered()
+            inner_calls = (value.meta or {}).get('inner_calls')
+            if inner_calls:
+                covered = covered.with_meta('inner_calls', inner_calls)
+            node_values[key] = covered
+
+
+def _deep_dict():
+    return defaultdict(_deep_dict)
 
 
 class Iteration(object):
@@ -860,21 +1342,45 @@ class IterationList:
         # Number of times each node has been recorded in this loop
         self.recorded = Counter()
 
-    def append(self, iteration):
-        # type: (Iteration) -> None
-        if self.length < self.side_len:
+        # Number of iterations the loop will have if that was known when it started
+        self.expected_length = None  # type: Optional[int]
+
+        # Whether the current iteration is in the middle of a loop with an expected_length,
+        # so that it will be discarded unless something marks it to keep
+        self.in_middle = False
+
+        # Whether the current iteration and those of all the loops around
+        # this one are the first, set by BirdsEye._add_iteration
+        self.first_iteration = True
+
+    def next_iteration(self):
+        # type: () -> None
+        index = self.length
+        self.length += 1
+        self.in_middle = (self.expected_length is not None and
+                          self.side_len <= index < self.expected_length - self.side_len)
+        if index < self.side_len:
+            iteration = Iteration()
             self.start.append(iteration)
         else:
-            # If self.end is too long, the first element self.end[0]
+            # If self.end is full, the first element self.end[0]
             # is about to be dropped by the deque. If that iteration
             # should be kept because of some node that was recorded,
-            # add it to self.start
-            if len(self.end) >= self.side_len and self.end[0].keep:
-                self.start.append(self.end[0])
-
+            # add it to self.start, otherwise reuse it for the new iteration
+            # so that running through a long loop allocates less
+            iteration = None
+            if len(self.end) >= self.side_len:
+                oldest = self.end[0]
+                if oldest.keep:
+                    self.start.append(oldest)
+                else:
+                    iteration = oldest
+                    iteration.vals.clear()
+                    iteration.loops.clear()
+            if iteration is None:
+                iteration = Iteration()
             self.end.append(iteration)
-        iteration.index = self.length
-        self.length += 1
+        iteration.index = index
 
     def __iter__(self):
         # type: () -> Iterator[Iteration]
@@ -898,6 +1404,12 @@ class IterationList:
         self.recorded[node] += 1
 
 
+# Types whose length is cheap and safe to find and matches
+# the number of iterations in a loop over an instance
+_sized_types = {list, tuple, range, dict, set, frozenset, str, bytes,
+                type({}.keys()), type({}.values()), type({}.items())}
+
+
 class TypeRegistry(object):
     basic_types = (type(None), bool, int, float, complex)
     special_types = basic_types + (list, dict, tuple, set, frozenset, str)
@@ -917,13 +1429,285 @@ class TypeRegistry(object):
 
     def names(self):
         # type: () -> List[str]
-        rev = dict((v, k) for k, v in self.data.items())
+        with self.lock:
+            rev = dict((v, k) for k, v in self.data.items())
         return [safe_qualname(rev[i]) for i in range(len(rev))]
 
 
 type_registry = TypeRegistry()
 
 
+class _Missing(object):
+    """
+    Stands in for a class from a library that hasn't been imported,
+    so nothing is an instance of it.
+    """
+
+
+class LibraryTypes(object):
+    """
+    Classes from optional libraries whose values are recorded specially.
+    birdseye never imports these libraries itself, as that can take a long time:
+    the classes are looked up in sys.modules once the traced program has imported
+    the library, and until then they're _Missing.
+    Call update() before using the attributes.
+    """
+
+    classes = dict(
+        ndarray=('numpy', 'ndarray'),
+        numpy_int64=('numpy', 'int64'),
+        DataFrame=('pandas', 'DataFrame'),
+        Series=('pandas', 'Series'),
+        QuerySet=('django.db.models', 'QuerySet'),
+
+        # Values which can't be inspected without doing I/O or a lot of work,
+        # see register_opaque
+        SQLAlchemyQuery=('sqlalchemy.orm.query', 'Query'),
+        DaskCollection=('dask.base', 'DaskMethodsMixin'),
+        mmap=('mmap', 'mmap'),
+    )
+    opaque = ('SQLAlchemyQuery', 'DaskCollection', 'mmap')
+
+    ndarray = numpy_int64 = DataFrame = Series = QuerySet = _Missing
+    SQLAlchemyQuery = DaskCollection = mmap = _Missing
+
+    def __init__(self):
+        self._missing = dict(self.classes)
+
+        # Functions to register with cheap_repr once the class is found
+        self.reprs = {}  # type: Dict[str, Callable]
+
+    def update(self):
+        found = False
+        for name, (module_name, class_name) in list(self._missing.items()):
+            module = sys.modules.get(module_name)
+            if module is None:
+                continue
+            cls = getattr(module, class_name, None)
+            if not isinstance(cls, type):
+                # e.g. the module is still being imported
+                continue
+            setattr(self, name, cls)
+            del self._missing[name]
+            found = True
+            if name in self.reprs:
+                register_repr(cls)(self.reprs[name])
+
+        if found:
+            # Types seen before may be subclasses of the new classes
+            _expansion_infos.clear()
+
+
+library_types = LibraryTypes()
+
+
+# How NodeValue.expression treats values of a particular type, see _expansion_info
+ExpansionInfo = namedtuple('ExpansionInfo', 'basic queryset module ndarray series dataframe '
+                                            'atomic sequence mapping set slots expander stable opaque')
+
+_expansion_infos = {}  # type: Dict[type, ExpansionInfo]
+_expanders = {}  # type: Dict[type, Callable]
+_opaque_classes = []  # type: List[type]
+
+# Objects which are usually recorded over and over with the same result
+_stable_types = (ModuleType, type, FunctionType, BuiltinFunctionType)
+
+# NodeValues of stable objects from previous calls to NodeValue.expression,
+# see NodeValue._stable_expression
+_stable_values = WeakKeyDictionary()  # type: WeakKeyDictionary
+
+# Limits for memoizing the NodeValues of immutable values, see _memo_key
+_max_memo_length = 100
+_max_memo_size = 10000
+_memo_types = frozenset([int, bool, str, bytes, type(None)])
+_memo_repr_types = tuple(_memo_types) + (float, tuple)
+
+
+class _ExpressionMemo(local):
+    # The same small immutable values, like loop indices and short strings,
+    # are recorded over and over, so their NodeValues are kept for each thread
+    def __init__(self):
+        self.values = {}  # type: Dict[tuple, NodeValue]
+        self.repr_settings = None  # type: Optional[tuple]
+
+    def check_repr_settings(self):
+        """
+        Forgets the values if cheap_repr has been configured differently
+        since they were recorded. Called at the start of each traced call.
+        """
+        settings = _repr_settings()
+        if settings != self.repr_settings:
+            self.values.clear()
+            self.repr_settings = settings
+
+
+_expression_memo = _ExpressionMemo()
+
+
+def _repr_settings():
+    # type: () -> tuple
+    """
+    The cheap_repr settings which the reprs of values in _expression_memo depend on.
+    """
+    functions = [repr_registry.get(t) for t in _memo_repr_types]
+    return (cheap_repr.suppression_threshold,
+            tuple(functions),
+            tuple(getattr(f, 'maxparts', None) for f in functions))
+
+
+def _stable_attributes(val, level, num_attributes):
+    # type: (Any, int, int) -> Optional[tuple]
+    """
+    The attributes of a stable object which may be shown when it's expanded
+    to the given level, for NodeValue._stable_expression to check that
+    they're still the same objects. Stable attributes are weakly referenced,
+    with their own attributes in a tuple after them, so that the cache doesn't
+    keep anything alive. Returns None if any attribute is mutable.
+    """
+    d = getattr(val, '__dict__', None)
+    if isinstance(val, ModuleType):
+        level = min(level, 2)
+    if not d or level <= 0:
+        return ()
+    result = []
+    for attr in islice(d.values(), num_attributes):
+        t = type(attr)
+        if t in _memo_types:
+            # Immutable and can't refer to anything
+            result.append(attr)
+        elif issubclass(t, _stable_types):
+            inner = _stable_attributes(attr, level - 1, num_attributes)
+            if inner is None:
+                return None
+            try:
+                result.append(ref(attr))
+            except TypeError:
+                return None
+            result.append(inner)
+        else:
+            return None
+    return tuple(result)
+
+
+def _same_attributes(old, new):
+    # type: (tuple, tuple) -> bool
+    """
+    Compares the results of two calls to _stable_attributes by identity.
+    Weak references to the same object are the same object as long as one exists.
+    """
+    return len(old) == len(new) and all(
+        a is b or type(a) is tuple and type(b) is tuple and _same_attributes(a, b)
+        for a, b in zip(old, new)
+    )
+
+
+def _samples_key(samples):
+    # type: (dict) -> tuple
+    """
+    A key for the contents of a num_samples dict, which may be modified in place.
+    """
+    return tuple((name, tuple(sorted(sizes.items())))
+                 for name, sizes in sorted(samples.items()))
+
+
+def _memo_key(val):
+    # type: (Any) -> Optional[tuple]
+    """
+    Returns a key such that values with equal keys are recorded identically,
+    or None if val isn't a small immutable value.
+    Equality of the values isn't enough, e.g. 1 == 1.0 == True and 0.0 == -0.0.
+    """
+    t = type(val)
+    if t in _memo_types:
+        if t in (str, bytes) and len(val) > _max_memo_length:
+            return None
+        return t, val
+    if t is float:
+        # Excludes 0.0 and -0.0, and NaN which isn't equal to itself
+        if not val or val != val:
+            return None
+        return t, val
+    if t is tuple and len(val) <= _max_memo_length:
+        keys = tuple(map(_memo_key, val))
+        if None in keys:
+            return None
+        return t, keys
+    return None
+
+
+def register_expander(cls):
+    # type: (type) -> Callable
+    """
+    Decorator which registers a function to find the children of
+    values of the given class (and its subclasses) in the UI,
+    instead of the items and attributes that are found by default.
+    The function is called as func(val, add_child, samples), where
+    add_child(key, value) adds a child with a string key, and samples
+    is the dict of limits in eye.num_samples that applies, e.g.:
+
+        @register_expander(Point)
+        def expand_point(point, add_child, samples):
+            add_child('x', point.x)
+            add_child('y', point.y)
+    """
+
+    def decorator(func):
+        _expanders[cls] = func
+        _expansion_infos.clear()
+        return func
+
+    return decorator
+
+
+def register_opaque(cls):
+    # type: (type) -> None
+    """
+    Values of the given class (and its subclasses) are recorded as just their
+    type and identity, without calling len() or repr(), iterating over them,
+    or looking at their attributes. Use this for objects where any of that
+    could do I/O or a lot of computation, e.g. lazy database queries.
+    Some such classes from common libraries are opaque by default,
+    see LibraryTypes.opaque.
+    The global registry of cheap_repr isn't changed, so the repr of a container
+    holding such a value still includes the repr of the value.
+    """
+    _opaque_classes.append(cls)
+    _expansion_infos.clear()
+
+
+def _expansion_info(cls):
+    # type: (type) -> ExpansionInfo
+    """
+    Checking a value against all the classes in NodeValue.expression is slow,
+    especially the abstract base classes, so this is done once for each type.
+    """
+    info = _expansion_infos.get(cls)
+    if info is None:
+        library_types.update()
+        ndarray = library_types.ndarray
+        info = _expansion_infos[cls] = ExpansionInfo(
+            basic=issubclass(cls, (TypeRegistry.basic_types, BirdsEye)),
+            queryset=issubclass(cls, library_types.QuerySet),
+            module=issubclass(cls, ModuleType),
+            ndarray=issubclass(cls, ndarray),
+            series=issubclass(cls, library_types.Series),
+            dataframe=issubclass(cls, library_types.DataFrame),
+            atomic=issubclass(cls, (str, bytes, range)),
+            sequence=issubclass(cls, (Sequence, ndarray)),
+            mapping=issubclass(cls, Mapping),
+            set=issubclass(cls, Set),
+            slots=sorted(getattr(cls, '__slots__', None) or ()),
+            expander=next((_expanders[klass] for klass in cls.__mro__
+                           if klass in _expanders), None),
+            stable=issubclass(cls, _stable_types),
+            opaque=issubclass(cls, tuple(_opaque_classes) +
+                              tuple(getattr(library_types, name) for name in library_types.opaque)),
+        )
+        if info.expander:
+            info = _expansion_infos[cls] = info._replace(stable=False)
+    return info
+
+
 class NodeValue(object):
     """
     The 'value' of a node during a particular iteration.
@@ -943,6 +1727,17 @@ class NodeValue(object):
         self.meta = self.meta or {}
         self.meta[key] = value
 
+    def with_meta(self, key, value):
+        # type: (str, Any) -> NodeValue
+        """
+        Returns a copy of this value with the given metadata added.
+        Values returned by NodeValue.expression may be shared, so they mustn't be changed.
+        """
+        result = NodeValue(self.val_repr, self.type_index)
+        result.meta = dict(self.meta or (), **{key: value})
+        result.children = self.children
+        return result
+
     def add_child(self, samples, level, key, value):
         # type: (dict, int, str, Any) -> None
         self.children = self.children or []
@@ -976,12 +1771,141 @@ class NodeValue(object):
         The value of an expression or one of its children, with attributes,
         dictionary items, etc as children. Has a max depth of `level` levels.
         """
+        key = _memo_key(val)
+        if key is not None:
+            # Only the children of tuples depend on samples
+            key = (key, level, _samples_key(samples) if type(val) is tuple else None)
+            memo = _expression_memo.values
+            result = memo.get(key)
+            if result is None:
+                if len(memo) >= _max_memo_size:
+                    memo.clear()
+                result = memo[key] = cls._new_expression(samples, val, level)
+            return result
+        return cls._new_expression(samples, val, level)
+
+    @classmethod
+    def _new_expression(cls, samples, val, level):
+        # type: (dict, Any, int) -> NodeValue
+        info = _expansion_info(type(val))
+        if info.opaque:
+            return cls(_repr_opaque(val, None), type_registry[val])
+        if info.stable:
+            return cls._stable_expression(samples, val, level, info)
+        return cls._expression(samples, val, level, info)
+
+    @classmethod
+    def _stable_expression(cls, samples, val, level, info):
+        # type: (dict, Any, int, ExpansionInfo) -> NodeValue
+        """
+        Modules, classes and functions are recorded every time a name like `np`
+        or `json` is evaluated, and expanding their attributes each time is slow.
+        Their values are shared until the object is garbage collected
+        or the attributes which can be shown are reassigned.
+        If any of those attributes is mutable (e.g. a list), changes inside it
+        can't be noticed, so the value is expanded again each time,
+        although the values of the other attributes are still shared.
+        """
+        num_attributes = max(sizes['attributes'] for sizes in samples.values())
+        attributes = _stable_attributes(val, level, num_attributes)
+        if attributes is None:
+            return cls._expression(samples, val, level, info)
+
+        try:
+            cached = _stable_values.get(val)
+        except TypeError:
+            # Can't be weakly referenced
+            return cls._expression(samples, val, level, info)
+
+        signature = (level, _samples_key(samples))
+        if (cached is None or cached[0] != signature or
+                not _same_attributes(cached[1], attributes)):
+            cached = (signature, attributes, cls._expression(samples, val, level, info))
+            _stable_values[val] = cached
+        return cached[2]
+
+    @classmethod
+    def _sampled_series(cls, samples, series, level):
+        # type: (dict, Any, int) -> Optional[NodeValue]
+        """
+        The value of a pandas Series, with the rows for its repr and its children
+        found with one slice and one call to format the index.
+        Returns None if that isn't possible, e.g. because a different repr
+        has been registered, so that the Series is expanded as usual.
+        """
+        if not _default_series_repr(type(series)):
+            return None
+        try:
+            length = len(series)
+            if not length:
+                # The repr is different
+                return None
+            positions = _sampled_rows(samples, level, length)
+            sample = series.iloc[positions]
+            labels = format_pandas_index(sample.index)
+        except Exception:
+            return None
+        return cls._series_value(samples, level, series, length, positions, labels, sample.array)
+
+    @classmethod
+    def _sampled_columns(cls, samples, level, frame, length, indices):
+        # type: (dict, int, Any, int, List[int]) -> Optional[List[NodeValue]]
+        """
+        The values of the columns of a pandas DataFrame at the given indices,
+        as in _sampled_series, but from one slice of the sampled rows and
+        columns and one call to format the row index for all the columns.
+        """
+        if not length:
+            return None
+        try:
+            positions = _sampled_rows(samples, level, length)
+            block = frame.iloc[positions, indices]
+            labels = format_pandas_index(block.index)
+            columns = [block.iloc[:, j] for j in range(len(indices))]
+        except Exception:
+            return None
+        if not all(_default_series_repr(type(column)) for column in columns):
+            return None
+        return [cls._series_value(samples, level, column, length, positions, labels, column.array)
+                for column in columns]
+
+    @classmethod
+    def _series_value(cls, samples, level, series, length, positions, labels, values):
+        # type: (dict, int, Any, int, List[int], Sequence[str], Sequence[Any]) -> NodeValue
+        """
+        The value of a pandas Series with `length` rows, given the formatted index labels
+        and the values of the rows at the positions returned by _sampled_rows.
+        `series` only provides the type and dtype, so it can be a slice of the rows.
+        """
+        items = dict(zip(positions, zip(labels, values)))
+        maxparts = _repr_series_one_line.maxparts
+        result = cls(
+            _join_series_items(length, [items[i] for i in _sample_indices(length, maxparts)],
+                               maxparts, cheap_repr.max_level - 1),
+            type_registry[series],
+        )
+        result.set_meta('len', length)
+        add_child = partial(result.add_child, samples, level - 1)
+        add_child('dtype', series.dtype)
+        sample_type = 'big' if level >= 2 else 'small'
+        for i in _sample_indices(length, samples[sample_type]['pandas_rows']):
+            add_child(*items[i])
+        return result
+
+    @classmethod
+    def _expression(cls, samples, val, level, info):
+        # type: (dict, Any, int, ExpansionInfo) -> NodeValue
+        if info.series:
+            result = cls._sampled_series(samples, val, level)
+            if result is not None:
+                return result
+
         result = cls(cheap_repr(val), type_registry[val])
-        if isinstance(val, (TypeRegistry.basic_types, BirdsEye)):
+        if info.basic:
             return result
 
         length = None
-        if not isinstance(val, QuerySet):  # len triggers a database query
+        if not info.queryset:  # len triggers a database query
             try:
                 length = len(val)
             except:
@@ -989,14 +1913,14 @@ class NodeValue(object):
             else:
                 result.set_meta('len', length)
 
-        if isinstance(val, ModuleType):
+        if info.module:
             level = min(level, 2)
 
         add_child = partial(result.add_child, samples, level - 1)
 
-        if isinstance(val, (Series, ndarray)):
+        if info.series or info.ndarray:
             attrs = ['dtype']
-            if isinstance(val, ndarray):
+            if info.ndarray:
                 attrs.append('shape')
             for name in attrs:
                 try:
@@ -1006,17 +1930,18 @@ class NodeValue(object):
                 else:
                     add_child(name, attr)
 
-        if level >= 3 or level >= 2 and isinstance(val, Series):
+        if level >= 3 or level >= 2 and info.series:
             sample_type = 'big'
         else:
             sample_type = 'small'
 
+        all_samples = samples
         samples = samples[sample_type]
 
         # Always expand DataFrames and Series regardless of level to
         # make the table view of DataFrames work
 
-        if isinstance(val, DataFrame):
+        if info.dataframe:
             meta = {}
             result.set_meta('dataframe', meta)
 
@@ -1031,42 +1956,63 @@ class NodeValue(object):
             if num_cols > max_cols + 2:
                 meta['col_break'] = max_cols // 2
 
-            indices = set(_sample_indices(num_cols, max_cols))
-            for i, (formatted_name, label) in enumerate(zip(format_pandas_index(val.columns),
-                                                            val.columns)):
-                if i in indices:
+            # Only format the names of the sampled columns. Each column is a child
+            # with the right length and repr, found from one slice of the sampled
+            # rows and columns if possible, or else from all its rows.
+            indices = list(_sample_indices(num_cols, max_cols))
+            names = format_pandas_index(columns[indices])
+            children = cls._sampled_columns(all_samples, level - 1, val, length, indices)
+            if children is None:
+                for i, formatted_name in zip(indices, names):
                     add_child(formatted_name, val.iloc[:, i])
+            else:
+                result.children = list(zip(names, children)) or None
 
             return result
 
-        if isinstance(val, Series):
-            for i in _sample_indices(length, samples['pandas_rows']):
-                try:
-                    k = format_pandas_index(val.index[i:i + 1])[0]
-                    v = val.iloc[i]
-                except:
-                    pass
-                else:
-                    add_child(k, v)
+        if info.series:
+            for k, v in _series_items(val, samples['pandas_rows']):
+                add_child(k, v)
             return result
 
-        if level <= 0 or isinstance(val, (str, bytes, range)):
+        if level <= 0 or info.atomic:
+            return result
+
+        if info.expander:
+            try:
+                info.expander(val, add_child, samples)
+            except Exception as e:
+                # Keep the children added before the error
+                warnings.warn('Exception in expander for %s: %s'
+                              % (safe_qualname(type(val)), exception_string(e)))
             return result
 
-        if isinstance(val, (Sequence, ndarray)) and length is not None:
-            for i in _sample_indices(length, samples['list']):
+        if info.sequence and length is not None:
+            indices = list(_sample_indices(length, samples['list']))
+            rows = None
+            if info.ndarray:
                 try:
-                    v = val[i]
+                    # One copy of the sampled rows instead of indexing each one
+                    rows = val[indices]
                 except:
                     pass
-                else:
+            if rows is not None:
+                for i, v in zip(indices, rows):
                     add_child(str(i), v)
-
-        if isinstance(val, Mapping):
+            else:
+                for i in indices:
+                    try:
+                        v = val[i]
+                    except:
+                        pass
+                    else:
+                        add_child(str(i), v)
+
+        if info.mapping:
             for k, v in islice(_safe_iter(val, iteritems), samples['dict']):
-                add_child(cheap_repr(k), v)
+                add_child(_repr_value(k), v)
 
-        if isinstance(val, Set):
+        if info.set:
             vals = _safe_iter(val)
             num_items = samples['set']
             if length is None or length > num_items + 2:
@@ -1084,7 +2030,7 @@ class NodeValue(object):
                     continue
                 add_child(str(k), v)
         else:
-            for s in sorted(getattr(type(val), '__slots__', None) or ()):
+            for s in info.slots:
                 try:
                     attr = getattr(val, s)
                 except AttributeError:
@@ -1093,7 +2039,6 @@ class NodeValue(object):
                     add_child(str(s), attr)
         return result
 
-
 def iteritems(obj):
     return getattr(obj, "iteritems", obj.items)()
 
@@ -1106,6 +2051,29 @@ def _safe_iter(val, f=lambda x: x):
         pass
 
 
+def _end_lineno(traced_file, func_node):
+    # type: (TracedFile, ast.FunctionDef) -> int
+    """
+    Returns the number of the line after the definition of the given function.
+    Like inspect.getsourcelines, comments after the body are included
+    if they're indented at least as much as the body.
+    """
+    lineno = func_node.last_token.end[0]
+    tokens = traced_file.tokens.tokens
+    indent = tokens[func_node.body[0].first_token.index - 1]
+    if indent.type != tokenize.INDENT:
+        # The body is on the same line as the def
+        return lineno + 1
+
+    for tok in tokens[func_node.last_token.index + 1:]:
+        if tok.type == tokenize.COMMENT:
+            if tok.start[1] >= indent.end[1]:
+                lineno = tok.start[0]
+        elif tok.type not in (tokenize.NEWLINE, tokenize.NL):
+            break
+    return lineno + 1
+
+
 def _sample_indices(length, max_length):
     if length <= max_length + 2:
         return range(length)
@@ -1115,28 +2083,121 @@ def _sample_indices(length, max_length):
                            length))
 
 
-@try_register_repr('numpy', 'int64')
+def _sampled_rows(samples, level, length):
+    # type: (dict, int, int) -> List[int]
+    """
+    The positions of the rows of a pandas Series with the given length which are
+    needed for both its repr and its children when it's expanded to the given level.
+    """
+    sample_type = 'big' if level >= 2 else 'small'
+    return sorted(set(chain(
+        _sample_indices(length, samples[sample_type]['pandas_rows']),
+        _sample_indices(length, _repr_series_one_line.maxparts),
+    )))
+
+
+def _series_items(series, max_length):
+    # type: (Any, int) -> List[Tuple[str, Any]]
+    """
+    Formatted index labels and values of a sample of the rows of a pandas Series,
+    found with one slice rather than row by row.
+    """
+    indices = list(_sample_indices(len(series), max_length))
+    try:
+        sample = series.iloc[indices]
+        return list(zip(format_pandas_index(sample.index), sample.array))
+    except Exception:
+        # e.g. an old version of pandas. Keep the rows that can be found.
+        items = []
+        for i in indices:
+            try:
+                items.append((format_pandas_index(series.index[i:i + 1])[0], series.iloc[i]))
+            except Exception:
+                pass
+        return items
+
+
+def _repr_opaque(x, _helper):
+    return '<%s instance at %#x>' % (type(x).__name__, id(x))
+
+
+def _repr_value(val):
+    # type: (Any) -> str
+    """
+    cheap_repr(val), except for opaque values, see register_opaque.
+    """
+    if _expansion_info(type(val)).opaque:
+        return _repr_opaque(val, None)
+    return cheap_repr(val)
+
+
 def _repr_numpy_int(x, _helper):
     return repr(int(x))
 
 
-@try_register_repr('pandas', 'Series')
+library_types.reprs['numpy_int64'] = _repr_numpy_int
+
+
 def _repr_series_one_line(x, helper):
     n = len(x)
     if n == 0:
         return repr(x)
-    newlevel = helper.level - 1
-    pieces = []
     maxparts = _repr_series_one_line.maxparts
-    for i in _sample_indices(n, maxparts):
-        k = format_pandas_index(x.index[i:i + 1])[0]
-        v = x.iloc[i]
-        pieces.append('%s = %s' % (k, cheap_repr(v, newlevel)))
-    if n > maxparts + 2:
+    return _join_series_items(n, _series_items(x, maxparts), maxparts, helper.level - 1)
+
+
+def _join_series_items(length, items, maxparts, level):
+    # type: (int, List[Tuple[str, Any]], int, int) -> str
+    pieces = ['%s = %s' % (k, cheap_repr(v, level)) for k, v in items]
+    if length > maxparts + 2:
         pieces.insert(maxparts // 2, '...')
     return '; '.join(pieces)
 
 
+def _default_series_repr(cls):
+    # type: (type) -> bool
+    """
+    Whether cheap_repr would use _repr_series_one_line for instances of cls,
+    so that NodeValue can build the same repr from rows that it already has.
+    """
+    for klass in inspect.getmro(cls):
+        if klass in suppressed_classes:
+            return False
+        func = repr_registry.get(klass)
+        if func:
+            return func is _repr_series_one_line
+    return False
+
+
+library_types.reprs['Series'] = _repr_series_one_line
+
+
+def can_exit_early(loop):
+    # type: (ast.For) -> bool
+    """
+    Return True if the body of this loop contains a statement or expression
+    which may stop the loop before its iterator is exhausted.
+    Exceptions from other expressions aren't considered.
+    """
+    return any(_exits_loop(node, True) for node in loop.body)
+
+
+def _exits_loop(node, can_break):
+    # type: (ast.AST, bool) -> bool
+    if isinstance(node, (ast.Return, ast.Raise, ast.Yield, ast.YieldFrom)):
+        return True
+    if isinstance(node, ast.Break):
+        return can_break
+    if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Lambda)):
+        return False
+    if isinstance(node, (ast.For, ast.AsyncFor, ast.While)):
+        # A break in the body of an inner loop only stops that loop
+        inner_body = set(map(id, node.body))
+        return any(_exits_loop(child, can_break and id(child) not in inner_body)
+                   for child in ast.iter_child_nodes(node))
+    return any(_exits_loop(child, can_break) for child in ast.iter_child_nodes(node))
+
+
 def is_interesting_expression(node):
     # type: (ast.AST) -> bool
     """
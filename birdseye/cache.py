@@ -0,0 +1,262 @@
+"""
+A persistent cache of instrumented code, similar to __pycache__.
+Parsing, instrumenting and compiling a file, and finding the tokens of its nodes,
+happens again in every new process that traces it, which adds noticeable startup
+time for big modules and short-lived processes. A CodeCache stores the results
+on disk so that they can be loaded instead while the file hasn't changed.
+
+The cache is only used if the environment variable BIRDSEYE_CACHE_DIR
+is set to the directory to keep it in, or if it's enabled explicitly:
+
+    from birdseye import eye
+    from birdseye.cache import CodeCache
+
+    eye.code_cache = CodeCache()  # in ~/.birdseye_cache by default
+
+Entries contain code which is run by the traced program, so like __pycache__,
+the directory must only be writable by users trusted to run code.
+Entries are stored with marshal rather than pickle, so that at least
+reading them doesn't run arbitrary code.
+
+Entries are keyed by the source, filename and compiler flags of the file,
+the Python and birdseye versions, and the tracer's class along with
+the size and modification time of the files defining it, so changing any of these
+gives a new entry. Entries that haven't been used recently are deleted
+when the cache grows beyond max_size bytes.
+
+The cache also remembers the IDs of Function rows in each database,
+so that tracing unchanged code doesn't need to look them up again.
+"""
+
+import hashlib
+import marshal
+import os
+import sys
+import tempfile
+import weakref
+from threading import Lock
+
+from birdseye import __version__
+
+from typing import Any, Dict, Optional, Set
+
+_suffix = '.birdseye-cache'
+
+# Names of the hook functions in code that has been loaded or stored by this process
+# and is still in use, see CodeCache.release_names.
+# The same cache entry can't be used by two tracers at once, because they would
+# overwrite each other's hooks in the globals of the traced module.
+_names_in_use = set()  # type: Set[str]
+_names_lock = Lock()
+
+
+class CodeCache(object):
+    def __init__(self, directory=None, max_size=100 * 1024 * 1024):
+        self.directory = directory or os.environ.get('BIRDSEYE_CACHE_DIR') or os.path.join(
+            os.path.expanduser('~'), '.birdseye_cache')
+        self.max_size = max_size
+        self._class_keys = {}  # type: Dict[type, str]
+
+    def load(self, tracer, source, filename, flags):
+        # type: (Any, str, str, int) -> Optional[dict]
+        """
+        Returns the data stored for the given file and tracer, or None.
+        The names in the data are claimed until release_names is called.
+        """
+        key = self._key(tracer, source, filename, flags)
+        path = self._path(key)
+        data = self._read(path, key)
+        if data is None or not _claim_names(data):
+            return None
+        return data
+
+    def store(self, tracer, source, filename, flags, data):
+        # type: (Any, str, str, int, dict) -> None
+        """
+        Stores data which must be supported by marshal and contain the key 'names',
+        a list of the names of hook functions used by the code,
+        unless there's already an entry for the file.
+        The names are claimed until release_names is called.
+        Errors writing to the cache are ignored.
+        """
+        _claim_names(data)
+        key = self._key(tracer, source, filename, flags)
+        path = self._path(key)
+        if os.path.exists(path):
+            # Another tracer in this process loaded it but couldn't use it,
+            # or another process stored it in the meantime
+            return
+        self._write(path, key, data)
+
+    @staticmethod
+    def release_names(owner, data):
+        # type: (Any, dict) -> None
+        """
+        Allows the names in data, which was returned by load or passed to store,
+        to be used again once `owner`, the object using them, is garbage collected.
+        """
+        weakref.finalize(owner, _release_names, list(data['names']))
+
+    def load_function_ids(self, db_key):
+        # type: (str) -> Dict[str, int]
+        """
+        Returns a dict mapping hashes of functions to their IDs
+        in the database identified by db_key.
+        """
+        key = self._function_ids_key(db_key)
+        return self._read(self._path(key), key) or {}
+
+    def store_function_ids(self, db_key, function_ids):
+        # type: (str, Dict[str, int]) -> None
+        """
+        Adds the given hashes and IDs to those stored for the database identified by db_key.
+        """
+        key = self._function_ids_key(db_key)
+        path = self._path(key)
+        data = self._read(path, key) or {}
+        if function_ids.items() <= data.items():
+            return
+        data.update(function_ids)
+        self._write(path, key, data)
+
+    def clear(self):
+        """
+        Deletes all entries.
+        """
+        for path, _ in self._entries():
+            self._remove(path)
+
+    def _key(self, tracer, source, filename, flags):
+        # type: (Any, str, str, int) -> str
+        cls = type(tracer)
+        class_key = self._class_keys.get(cls)
+        if class_key is None:
+            class_key = self._class_keys[cls] = _class_key(cls)
+        parts = [
+            sys.implementation.cache_tag,
+            sys.version,
+            __version__,
+            class_key,
+            filename,
+            str(flags),
+            source,
+        ]
+        return hashlib.sha256('\0'.join(parts).encode('utf8', 'surrogatepass')).hexdigest()
+
+    @staticmethod
+    def _function_ids_key(db_key):
+        # type: (str) -> str
+        return hashlib.sha256(('functions\0' + db_key).encode('utf8')).hexdigest()
+
+    def _path(self, key):
+        # type: (str) -> str
+        return os.path.join(self.directory, key + _suffix)
+
+    def _read(self, path, key):
+        # type: (str, str) -> Any
+        try:
+            with open(path, 'rb') as f:
+                entry = marshal.load(f)
+            if entry['key'] != key:
+                raise ValueError('Wrong key in %s' % path)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # A corrupt or incompatible entry
+            self._remove(path)
+            return None
+
+        try:
+            # Mark the entry as recently used
+            os.utime(path)
+        except OSError:
+            pass
+        return entry['data']
+
+    def _write(self, path, key, data):
+        # type: (str, str, Any) -> None
+        try:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    marshal.dump(dict(key=key, data=data), f)
+                # Readers never see a partially written entry
+                os.replace(temp_path, path)
+            except BaseException:
+                self._remove(temp_path)
+                raise
+            self._prune()
+        except Exception:
+            pass
+
+    def _entries(self):
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        result = []
+        for name in names:
+            if not name.endswith(_suffix):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                result.append((path, os.stat(path)))
+            except OSError:
+                pass
+        return result
+
+    def _prune(self):
+        entries = self._entries()
+        total = sum(stat.st_size for _, stat in entries)
+        if total <= self.max_size:
+            return
+
+        # Delete the least recently used entries first
+        entries.sort(key=lambda entry: entry[1].st_mtime)
+        for path, stat in entries:
+            if total <= self.max_size:
+                break
+            self._remove(path)
+            total -= stat.st_size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _class_key(cls):
+    # type: (type) -> str
+    """
+    Identifies the tracer class and the versions of the files defining it
+    and its base classes, which determine how code is instrumented.
+    """
+    parts = []
+    for klass in cls.__mro__:
+        parts.append('%s.%s' % (klass.__module__, klass.__qualname__))
+        filename = getattr(sys.modules.get(klass.__module__), '__file__', None)
+        if filename:
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            parts.append('%s:%s:%s' % (filename, stat.st_size, stat.st_mtime_ns))
+    return '\0'.join(parts)
+
+
+def _claim_names(data):
+    # type: (dict) -> bool
+    with _names_lock:
+        names = set(data['names'])
+        if names & _names_in_use:
+            return False
+        _names_in_use.update(names)
+        return True
+
+
+def _release_names(names):
+    with _names_lock:
+        _names_in_use.difference_update(names)
@@ -3,7 +3,9 @@ import json
 import os
 import sys
 from contextlib import contextmanager
-from typing import List
+from threading import Lock
+from typing import Dict, List, Optional
+from uuid import uuid4
 
 from humanize import naturaltime
 from littleutils import select_attrs, retry
@@ -35,11 +37,7 @@ DB_VERSION = 1
 
 class Database(object):
     def __init__(self, db_uri=None, _skip_version_check=False):
-        self.db_uri = db_uri = (
-                db_uri
-                or os.environ.get('BIRDSEYE_DB')
-                or os.path.join(os.path.expanduser('~'),
-                                '.birdseye.db'))
+        self.db_uri = db_uri = resolve_db_uri(db_uri)
 
         kwargs = dict(
             pool_recycle=280,
@@ -191,6 +189,7 @@ class Database(object):
         if not self.table_exists(Function):
             Base.metadata.create_all(engine)
             kv.version = DB_VERSION
+            kv.instance = uuid4().hex
         elif not self.table_exists(KeyValue) or int(kv.version) < DB_VERSION:
             sys.exit('The birdseye database schema is out of date. '
                      'Run "python -m birdseye.clear_db" to delete the existing tables.')
@@ -206,6 +205,20 @@ class Database(object):
             except AttributeError:
                 return self.engine.dialect.has_table(self.engine, table.__name__)
 
+    @property
+    def instance_id(self):
+        # type: () -> str
+        """
+        A random ID which changes when the tables are recreated, e.g. after
+        clearing the database, so that IDs of rows cached outside the database
+        can be recognised as stale.
+        """
+        kv = self.key_value_store
+        instance = kv.instance
+        if not instance:
+            kv.instance = instance = uuid4().hex
+        return instance
+
     def all_file_paths(self):
         # type: () -> List[str]
         with self.session_scope() as session:
@@ -218,6 +231,10 @@ class Database(object):
         return paths
 
     def clear(self):
+        with _databases_lock:
+            for key, db in list(_databases.items()):
+                if db is self:
+                    del _databases[key]
         for model in [self.Call, self.Function, self._KeyValue]:
             if self.table_exists(model):
                 model.__table__.drop(self.engine)
@@ -244,5 +261,31 @@ class Database(object):
         return retry_db(wrapper)
 
 
+_databases = {}  # type: Dict[str, Database]
+_databases_lock = Lock()
+
+
+def resolve_db_uri(db_uri=None):
+    # type: (Optional[str]) -> str
+    return (db_uri
+            or os.environ.get('BIRDSEYE_DB')
+            or os.path.join(os.path.expanduser('~'),
+                            '.birdseye.db'))
+
+
+def get_database(db_uri=None):
+    # type: (Optional[str]) -> Database
+    """
+    Returns a Database shared by everything in this process that uses the same URI,
+    so that the tables are only checked or created once.
+    """
+    db_uri = resolve_db_uri(db_uri)
+    with _databases_lock:
+        db = _databases.get(db_uri)
+        if db is None:
+            db = _databases[db_uri] = Database(db_uri)
+        return db
+
+
 # Based on https://docs.sqlalchemy.org/en/latest/errors.html#error-dbapi
 retry_db = retry(3, (InterfaceError, OperationalError, InternalError, ProgrammingError))
@@ -0,0 +1,97 @@
+"""
+The governor limits the overhead that tracing adds to each function.
+BirdsEye measures how much time its hooks take during each traced call
+and reports it to the governor, which decides whether future calls
+of that function are traced:
+
+    from birdseye import eye
+    from birdseye.governor import OverheadGovernor
+
+    eye.governor = OverheadGovernor(max_overhead=0.05, cooldown=60)
+
+The governor must be set before decorating functions,
+since functions decorated earlier aren't governed.
+"""
+
+from threading import Lock
+from time import perf_counter
+
+
+class _FunctionStats(object):
+    __slots__ = ('window_start', 'calls', 'runtime', 'overhead')
+
+    def __init__(self, now):
+        self.window_start = now
+        self.calls = 0
+        self.runtime = 0.0
+        self.overhead = 0.0
+
+
+class OverheadGovernor(object):
+    """
+    Stops tracing a function for `cooldown` seconds whenever, within the last
+    `window` seconds, either:
+
+    - the time spent in tracing hooks exceeded `max_overhead` times
+      the time the function spent doing its own work, or
+    - the function was traced more than `max_calls_per_second` times per second.
+
+    Either limit can be set to None to disable it. While a function is throttled,
+    calls go straight to the original uninstrumented function.
+    """
+
+    window = 1.0
+
+    def __init__(self, max_overhead=0.05, max_calls_per_second=None, cooldown=10.0):
+        self.max_overhead = max_overhead
+        self.max_calls_per_second = max_calls_per_second
+        self.cooldown = cooldown
+        self._lock = Lock()
+
+        # Keys are the code objects of traced functions
+        self._stats = {}  # type: dict
+        self._throttled_until = {}  # type: dict
+
+    def allow(self, code):
+        """
+        Returns True if a call to the function with the given code should be traced.
+        """
+        until = self._throttled_until.get(code)
+        if until is None:
+            return True
+        if perf_counter() < until:
+            return False
+        self._throttled_until.pop(code, None)
+        return True
+
+    def record_call(self, code, runtime, overhead):
+        """
+        Called at the end of each traced call with the total time of the call
+        and the part of that time spent in the tracer's hooks, both in seconds.
+        """
+        now = perf_counter()
+        with self._lock:
+            stats = self._stats.get(code)
+            if stats is None or now - stats.window_start >= self.window:
+                stats = self._stats[code] = _FunctionStats(now)
+
+            stats.calls += 1
+            stats.runtime += runtime
+            stats.overhead += overhead
+
+            own_time = stats.runtime - stats.overhead
+            too_slow = (self.max_overhead is not None and
+                        stats.overhead > self.max_overhead * own_time)
+            too_often = (self.max_calls_per_second is not None and
+                         stats.calls > self.max_calls_per_second * self.window)
+            if too_slow or too_often:
+                self._throttled_until[code] = now + self.cooldown
+                del self._stats[code]
+
+    def reset(self):
+        """
+        Forget all measurements and resume tracing every function.
+        """
+        with self._lock:
+            self._stats.clear()
+            self._throttled_until.clear()
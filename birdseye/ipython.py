@@ -11,7 +11,8 @@ from jinja2 import Environment, PackageLoader, select_autoescape
 from traitlets import Unicode, Int, Bool
 from werkzeug.local import LocalProxy
 
-from birdseye.bird import PY2, Database
+from birdseye.bird import PY2
+from birdseye.db import Database
 from birdseye import server, eye
 
 try:
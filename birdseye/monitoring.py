@@ -0,0 +1,344 @@
+"""
+An alternative to the AST modifications in tracer.py for Python 3.12+,
+based on sys.monitoring (PEP 669). The original code of a function runs unmodified
+and the interpreter reports the start and end of each call and each line that runs,
+which is enough to call the statement and call hooks of a TreeTracerBase,
+but not to observe the values of expressions.
+
+Used by TreeTracerBase.trace_function when expressions=False.
+In this mode, compared to the usual tracing:
+
+- before_stmt is called when the first line of a statement starts running,
+  and after_stmt when execution moves to a statement outside of it.
+- A loop written on one line, e.g. `for x in xs: total += x`, never leaves that line,
+  so its iterations are found from the jumps of its bytecode instead.
+- before_expr is only called for the tests of while loops,
+  and after_expr is never called.
+- Only the code of the function itself is monitored, not comprehensions,
+  class bodies, or other nested functions within it.
+"""
+
+import ast
+import dis
+import sys
+from collections import defaultdict
+from threading import Lock
+
+from typing import Dict, List, Optional, FrozenSet, Tuple
+
+from types import CodeType
+
+from birdseye.utils import first_lineno
+
+monitoring = getattr(sys, 'monitoring', None)
+
+# True if this Python has sys.monitoring
+available = monitoring is not None
+
+# sys.monitoring.DEBUGGER_ID, COVERAGE_ID, PROFILER_ID and OPTIMIZER_ID
+# are reserved for other kinds of tools
+_TOOL_IDS = (3, 4)
+
+
+class _MonitoredCode(object):
+    __slots__ = ('tracer', 'enter_node', 'statements_by_line', 'loop_edges', 'deferred')
+
+    def __init__(self, tracer, enter_node, statements_by_line, loop_edges, deferred):
+        self.tracer = tracer
+        self.enter_node = enter_node
+
+        # Statements in the order that they start on each line
+        self.statements_by_line = statements_by_line  # type: Dict[int, List[ast.stmt]]
+
+        # Offsets of the instructions which start another iteration of a loop
+        # written on one line, mapped to the loop and, for the FOR_ITER of a for loop,
+        # the offset it continues at when the iterator isn't exhausted.
+        # For a while loop it's the jump back to the start of its body.
+        self.loop_edges = loop_edges  # type: Dict[int, Tuple[ast.stmt, Optional[int]]]
+
+        # Statements on the first line of a one line for loop inside it,
+        # which are only started when the loop gets another item
+        self.deferred = deferred  # type: FrozenSet[ast.stmt]
+
+
+class MonitoringEngine(object):
+    """
+    Registers the callbacks for a sys.monitoring tool and dispatches the events
+    of monitored code objects to the hooks of the tracers that own them.
+    There is only one instance, see monitor().
+    """
+
+    def __init__(self):
+        for tool_id in _TOOL_IDS:
+            if monitoring.get_tool(tool_id) is None:
+                break
+        else:
+            raise RuntimeError('No sys.monitoring tool id is available for birdseye')
+
+        self.tool_id = tool_id
+        self.codes = {}  # type: Dict[CodeType, _MonitoredCode]
+
+        events = monitoring.events
+        monitoring.use_tool_id(tool_id, 'birdseye')
+        for event, callback in [
+            (events.PY_START, self._py_start),
+            (events.LINE, self._line),
+            (events.PY_RETURN, self._py_return),
+            (events.JUMP, self._jump),
+            (events.RAISE, self._raise),
+            (events.PY_UNWIND, self._py_unwind),
+        ] + [(event, self._branch) for event in _branch_events()]:
+            monitoring.register_callback(tool_id, event, callback)
+
+        # These can't be enabled for specific code objects,
+        # so the callbacks run for exceptions anywhere and ignore most of them
+        monitoring.set_events(tool_id, events.RAISE | events.PY_UNWIND)
+
+    def monitor(self, tracer, traced_file, code):
+        """
+        Start sending the events of `code`, which must have been compiled
+        from traced_file.root, to the hooks of `tracer`.
+        """
+        func_node = traced_file.function_node(code)
+        statements_by_line = defaultdict(list)  # type: Dict[int, List[ast.stmt]]
+        for stmt in _statements(func_node.body, frozenset()):
+            statements_by_line[first_lineno(stmt)].append(stmt)
+        for statements in statements_by_line.values():
+            statements.sort(key=lambda s: (s.lineno, s.col_offset))
+
+        loop_edges, deferred = _one_line_loops(code, statements_by_line)
+        self.codes[code] = _MonitoredCode(tracer, func_node.body[0], dict(statements_by_line),
+                                          loop_edges, deferred)
+        events = monitoring.events
+        local_events = events.PY_START | events.LINE | events.PY_RETURN
+        if loop_edges:
+            local_events |= events.JUMP
+            for event in _branch_events():
+                local_events |= event
+        monitoring.set_local_events(self.tool_id, code, local_events)
+
+    def _py_start(self, code, _offset):
+        info = self.codes.get(code)
+        if info is None:
+            return
+        info.tracer._enter_call(info.enter_node, sys._getframe(1))
+
+    def _line(self, code, line_number):
+        info = self.codes.get(code)
+        if info is None:
+            return monitoring.DISABLE
+
+        statements = info.statements_by_line.get(line_number)
+        if not statements:
+            # e.g. the second line of a statement spanning several lines
+            return monitoring.DISABLE
+
+        tracer = info.tracer
+        frame = sys._getframe(1)
+        frame_info = tracer.stack.get(frame)
+        if frame_info is None:
+            return None
+
+        statement_stack = frame_info.statement_stack
+        for node in statements:
+            if node in statement_stack:
+                # Lines of a statement that's already running, e.g. because it spans
+                # several lines, don't start it again, but going back to the
+                # first line of a loop means that the loop is continuing
+                if isinstance(node, (ast.For, ast.While)):
+                    self._finish_statements(tracer, frame_info, node)
+                    if isinstance(node, ast.While):
+                        tracer.before_expr(node.test, frame)
+                continue
+
+            if node not in info.deferred:
+                self._start_statement(tracer, frame_info, node)
+        return None
+
+    def _start_statement(self, tracer, frame_info, node):
+        self._finish_statements(tracer, frame_info, node)
+        frame_info.statement_stack.append(node)
+        if isinstance(node, ast.Return):
+            frame_info.return_node = node
+        tracer.before_stmt(node, frame_info.frame)
+        if isinstance(node, ast.While):
+            tracer.before_expr(node.test, frame_info.frame)
+
+    def _jump(self, code, offset, destination):
+        return self._loop_edge(code, offset, destination)
+
+    def _branch(self, code, offset, destination):
+        return self._loop_edge(code, offset, destination)
+
+    def _loop_edge(self, code, offset, destination):
+        info = self.codes.get(code)
+        if info is None:
+            return monitoring.DISABLE
+        edge = info.loop_edges.get(offset)
+        if edge is None:
+            return monitoring.DISABLE
+
+        loop, continue_offset = edge
+        if continue_offset is not None and destination != continue_offset:
+            # The for loop is finished
+            return None
+
+        tracer = info.tracer
+        frame_info = tracer.stack.get(sys._getframe(2))
+        if frame_info is None or loop not in frame_info.statement_stack:
+            return None
+
+        # Start the next iteration like going back to the first line
+        # of a loop spanning several lines, see _line
+        self._finish_statements(tracer, frame_info, loop)
+        if isinstance(loop, ast.While):
+            tracer.before_expr(loop.test, frame_info.frame)
+        for node in info.statements_by_line[first_lineno(loop)]:
+            if loop in node._monitored_ancestors:
+                self._start_statement(tracer, frame_info, node)
+        return None
+
+    def _finish_statements(self, tracer, frame_info, node, exc_value=None):
+        """
+        Calls after_stmt for the running statements which don't contain `node`,
+        or all of them if `node` is None.
+        """
+        statement_stack = frame_info.statement_stack
+        ancestors = node._monitored_ancestors if node else frozenset()
+        while statement_stack and statement_stack[-1] is not node:
+            stmt = statement_stack[-1]
+            if stmt in ancestors:
+                break
+            statement_stack.pop()
+            tracer.after_stmt(stmt, frame_info.frame, exc_value,
+                              exc_value and exc_value.__traceback__, None)
+
+    def _frame_info(self, code):
+        info = self.codes.get(code)
+        if info is None:
+            return None, None
+        # Two frames up: this method, then the callback
+        return info.tracer, info.tracer.stack.get(sys._getframe(2))
+
+    def _py_return(self, code, _offset, return_value):
+        tracer, frame_info = self._frame_info(code)
+        if frame_info is None:
+            return
+        self._finish_statements(tracer, frame_info, None)
+        tracer._exit_call(frame_info, frame_info.return_node, return_value, None, None)
+
+    def _raise(self, code, _offset, exc_value):
+        tracer, frame_info = self._frame_info(code)
+        if frame_info is None or exc_value is frame_info.exc_value:
+            return
+        frame_info.exc_value = exc_value
+        statement_stack = frame_info.statement_stack
+        if statement_stack:
+            node = statement_stack.pop()
+            tracer.after_stmt(node, frame_info.frame, exc_value, exc_value.__traceback__, node)
+
+    def _py_unwind(self, code, _offset, exc_value):
+        tracer, frame_info = self._frame_info(code)
+        if frame_info is None:
+            return
+        self._finish_statements(tracer, frame_info, None, exc_value)
+        tracer._exit_call(frame_info, None, None, exc_value, exc_value.__traceback__)
+
+
+_engine = None  # type: Optional[MonitoringEngine]
+_engine_lock = Lock()
+
+
+def monitor(tracer, traced_file, code):
+    """
+    See MonitoringEngine.monitor. Only call this if `available` is True.
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = MonitoringEngine()
+        _engine.monitor(tracer, traced_file, code)
+
+
+def _branch_events():
+    events = monitoring.events
+    if hasattr(events, 'BRANCH_LEFT'):
+        # Python 3.14+
+        return [events.BRANCH_LEFT, events.BRANCH_RIGHT]
+    return [events.BRANCH]
+
+
+def _one_line_loops(code, statements_by_line):
+    # type: (CodeType, Dict[int, List[ast.stmt]]) -> Tuple[Dict[int, Tuple[ast.stmt, Optional[int]]], FrozenSet[ast.stmt]]
+    """
+    Returns the loop_edges and deferred statements of a _MonitoredCode.
+    """
+    loops = [
+        stmt
+        for line, statements in statements_by_line.items()
+        for stmt in statements
+        if isinstance(stmt, (ast.For, ast.While)) and first_lineno(stmt.body[0]) == line
+    ]
+    if not loops:
+        return {}, frozenset()
+
+    instructions = list(dis.get_instructions(code))
+    loop_edges = {}
+    deferred = set()
+    for loop in loops:
+        line = first_lineno(loop)
+        on_line = [
+            (i, instruction)
+            for i, instruction in enumerate(instructions)
+            if instruction.positions.lineno == line
+        ]
+        # Comprehensions are inlined since Python 3.12, so the same line may
+        # contain other loops, but they're always nested inside this one
+        if isinstance(loop, ast.For):
+            candidates = [(instruction.argval, i, instruction)
+                          for i, instruction in on_line
+                          if instruction.opname == 'FOR_ITER']
+            if not candidates:
+                continue
+            _, i, instruction = max(candidates)
+            loop_edges[instruction.offset] = (loop, instructions[i + 1].offset)
+            deferred.update(stmt for stmt in statements_by_line[line]
+                            if loop in stmt._monitored_ancestors)
+        else:
+            candidates = [(instruction.argval, instruction)
+                          for _, instruction in on_line
+                          if instruction.opname == 'JUMP_BACKWARD']
+            if not candidates:
+                continue
+            _, instruction = min(candidates)
+            loop_edges[instruction.offset] = (loop, None)
+    return loop_edges, frozenset(deferred)
+
+
+def _statements(body, ancestors):
+    # type: (List[ast.stmt], FrozenSet[ast.stmt]) -> List[ast.stmt]
+    """
+    Returns the statements in `body` and those nested inside them which belong
+    to the same code object, i.e. not the bodies of functions and classes.
+    Each statement gets the set of statements containing it as an attribute.
+    """
+    result = []
+    for stmt in body:
+        stmt._monitored_ancestors = ancestors
+        result.append(stmt)
+        if isinstance(stmt, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            continue
+        inner_ancestors = ancestors | {stmt}
+        for child in ast.iter_child_nodes(stmt):
+            if isinstance(child, ast.stmt):
+                continue
+            # e.g. except clauses and match cases
+            for grandchild in ast.iter_child_nodes(child):
+                if isinstance(grandchild, ast.stmt):
+                    result.extend(_statements([grandchild], inner_ancestors))
+        for field in ('body', 'orelse', 'finalbody'):
+            result.extend(_statements(
+                [s for s in getattr(stmt, field, ()) if isinstance(s, ast.stmt)],
+                inner_ancestors,
+            ))
+    return result
@@ -14,7 +14,7 @@ from littleutils import DecentJSONEncoder, withattrs, group_by_attr
 from werkzeug.routing import PathConverter
 
 from birdseye.db import Database
-from birdseye.utils import short_path, IPYTHON_FILE_PATH, fix_abs_path, is_ipython_cell
+from birdseye.utils import short_path, IPYTHON_FILE_PATH, fix_abs_path, is_ipython_cell, render_html_body
 
 app = Flask('birdseye')
 app.jinja_env.auto_reload = True
@@ -154,6 +154,10 @@ def get_calls(session, path, func_name, limit):
 def base_call_view(session, call_id, template):
     call = session.query(Call).filter_by(id=call_id).one()
     func = call.function
+    if func.html_body is None:
+        # Rendered on the first view instead of in the traced program,
+        # then stored when the session is committed
+        func.html_body = render_html_body(func.parsed_data['html'])
     return render_template(template,
                            short_path=basename(func.file),
                            call=call,
@@ -8,23 +8,30 @@ Most of the work is in TreeTracerBase.
 
 import ast
 import inspect
+import marshal
 import sys
-from collections import namedtuple, defaultdict
+from collections import defaultdict, namedtuple
 from copy import deepcopy
 from functools import partial, update_wrapper, wraps, lru_cache
 from itertools import takewhile
+from random import random
+from threading import Lock
 from types import FrameType, TracebackType, CodeType, FunctionType
 from uuid import uuid4
 
+from cached_property import cached_property
+
+from birdseye import monitoring
 from birdseye.utils import (
     is_lambda,
     read_source_file,
     is_ipython_cell,
     is_future_import,
+    first_lineno,
     PYPY,
 )
 
-from typing import List, Dict, Any, Optional, Tuple, Iterator, Callable, Union
+from typing import List, Dict, Any, Optional, Tuple, Iterator, Callable, Union, Set
 
 Loop = Union[ast.For, ast.While, ast.comprehension]
 
@@ -41,12 +48,24 @@ class TracedFile(object):
             - parent: parent of the node, so this node is a child node of its parent
     - tracer: instance of TreeTracerBase
     - code: executable code object compiled from the modified AST
+    - secondary_codes: code objects within `code` which don't get their own FrameInfo,
+                       i.e. comprehensions and class bodies, which are traced
+                       as part of the enclosing function or module
     """
 
     is_ipython_cell = False
 
-    def __init__(self, tracer, source, filename, flags):
-        # type: (TreeTracerBase, str, str, int) -> None
+    def __init__(self, tracer, source, filename, flags, cached=None):
+        # type: (TreeTracerBase, str, str, int, Optional[dict]) -> None
+        """
+        If `cached` is given, it's the result of cache_data() for the same
+        source in another process, and the code is taken from there
+        instead of being instrumented and compiled again.
+        The caller is responsible for anything that parse_extra would do.
+        """
+        self.tracer = tracer
+        self.flags = flags
+
         # Here the source code is parsed, modified, and compiled
         self.root = compile(source, filename, 'exec', ast.PyCF_ONLY_AST | flags, dont_inherit=True)  # type: ast.Module
 
@@ -54,30 +73,116 @@ class TracedFile(object):
 
         self.set_basic_node_attributes()
 
-        new_root = tracer.parse_extra(self.root, source, filename)
-        if new_root is not None:
-            self.root = new_root
-
-        self.set_basic_node_attributes()
-        self.set_enter_call_nodes()
+        self._replaced_root = False
+        if cached is None:
+            new_root = tracer.parse_extra(self.root, source, filename)
+            if new_root is not None:
+                self.root = new_root
+                self._replaced_root = True
 
-        self.trace_methods = {
-            f: "_treetrace_hidden_" + uuid4().hex
-            for f in [
-                TreeTracerBase._treetrace_hidden_with_stmt,
-                TreeTracerBase._treetrace_hidden_before_expr,
-                TreeTracerBase._treetrace_hidden_after_expr,
-            ]
-        }
+            self.set_basic_node_attributes()
 
-        new_root = deepcopy(self.root)
-        new_root = _NodeVisitor(self).visit(new_root)
+        self.set_enter_call_nodes()
+        self.set_exit_call_nodes()
+
+        trace_methods = [
+            TreeTracerBase._treetrace_hidden_enter_call,
+            TreeTracerBase._treetrace_hidden_before_stmt,
+            TreeTracerBase._treetrace_hidden_after_stmt,
+            TreeTracerBase._treetrace_hidden_stmt_exception,
+            TreeTracerBase._treetrace_hidden_before_expr,
+            TreeTracerBase._treetrace_hidden_after_expr,
+        ]
+
+        if cached is None:
+            # Name of the local (or global, at module level) variable holding
+            # the FrameInfo of the current call, which is passed to every hook
+            self.frame_info_name = "_treetrace_hidden_" + uuid4().hex
+
+            self.trace_methods = {
+                f: "_treetrace_hidden_" + uuid4().hex
+                for f in trace_methods
+            }
+
+            new_root = deepcopy(self.root)
+            new_root = _NodeVisitor(self).visit(new_root)
+
+            self.code = compile(new_root, filename, "exec", dont_inherit=True, flags=flags)  # type: CodeType
+        else:
+            self.frame_info_name = cached['frame_info_name']
+            self.trace_methods = {f: cached['trace_methods'][f.__name__] for f in trace_methods}
+            self.code = marshal.loads(cached['code'])
 
-        self.code = compile(new_root, filename, "exec", dont_inherit=True, flags=flags)  # type: CodeType
-        self.tracer = tracer
+        self.secondary_codes = set(_secondary_codes(self.code))
+        tracer.secondary_codes.update(self.secondary_codes)
         self.source = source
         self.filename = filename
 
+    def cache_data(self):
+        # type: () -> Optional[dict]
+        """
+        Returns the data needed by TracedFile(..., cached=data) to recreate this file
+        without instrumenting the source again, or None if that's not possible.
+        `names` lists the hidden names used in the code.
+        """
+        if self._replaced_root:
+            return None
+        return dict(
+            code=marshal.dumps(self.code),
+            frame_info_name=self.frame_info_name,
+            trace_methods={f.__name__: name for f, name in self.trace_methods.items()},
+            names=[self.frame_info_name] + list(self.trace_methods.values()),
+        )
+
+    @cached_property
+    def uninstrumented_code(self):
+        # type: () -> CodeType
+        """
+        Code compiled from the original AST, used when tracing with sys.monitoring
+        """
+        return compile(self.root, self.filename, "exec", dont_inherit=True, flags=self.flags)
+
+    def find_codes(self, firstlineno, name, instrumented=True):
+        # type: (int, str, bool) -> List[CodeType]
+        """
+        Returns the code objects nested anywhere in self.code, or uninstrumented_code
+        if instrumented is false, with the given co_firstlineno and co_name.
+        """
+        if instrumented:
+            index = self._code_index
+        else:
+            index = self._uninstrumented_code_index
+        return index.get((firstlineno, name), [])
+
+    @cached_property
+    def _code_index(self):
+        # type: () -> Dict[Tuple[int, str], List[CodeType]]
+        return _code_index(self.code)
+
+    @cached_property
+    def _uninstrumented_code_index(self):
+        # type: () -> Dict[Tuple[int, str], List[CodeType]]
+        return _code_index(self.uninstrumented_code)
+
+    def function_node(self, code):
+        # type: (CodeType) -> ast.FunctionDef
+        """
+        Returns the node of the function definition that was compiled to the given code.
+        """
+        try:
+            return self._function_nodes[code.co_firstlineno, code.co_name]
+        except KeyError:
+            raise ValueError('Could not find the definition of %s' % code.co_name)
+
+    @cached_property
+    def _function_nodes(self):
+        # type: () -> Dict[Tuple[int, str], ast.FunctionDef]
+        return {
+            (first_lineno(node), node.name): node
+            for node in self.nodes
+            if isinstance(node, ast.FunctionDef)
+        }
+
     def set_basic_node_attributes(self):
         self.nodes = []  # type: List[ast.AST]
         for node in ast.walk(self.root):  # type: ast.AST
@@ -102,13 +207,26 @@ class TracedFile(object):
                         stmt._enter_call_node = True
                         break
 
+    def set_exit_call_nodes(self):
+        # The call may end after any statement directly in the body of a function
+        # or module, and certainly does after the last one
+        for node in self.nodes:
+            if isinstance(node, (ast.Module, ast.FunctionDef)):
+                for stmt in node.body:
+                    stmt._maybe_exit_call_node = True
+                node.body[-1]._exit_call_node = True
+
 
 class FrameInfo(object):
     """
     Contains extra data about an execution frame.
     Can be obtained from the stack attribute of a TreeTracerBase instance
     """
-    def __init__(self):
+    def __init__(self, frame=None):
+        # type: (Optional[FrameType]) -> None
+        # The frame being traced, or None once the call has finished
+        self.frame = frame
+
         # Stack of statements currently being executed
         self.statement_stack = []  # type: List[ast.stmt]
 
@@ -159,8 +277,16 @@ class TreeTracerBase(object):
         # Mapping from frames of execution being traced to FrameInfo objects
         # for extra metadata.
         self.stack = {}  # type: Dict[FrameType, FrameInfo]
-        self.main_to_secondary_frames = defaultdict(list)
-        self.secondary_to_main_frames = {}
+
+        # See TracedFile.secondary_codes
+        self.secondary_codes = set()  # type: Set[CodeType]
+
+        # Code of the functions which __call__ puts between a traced function
+        # and its caller, whose frames are skipped when finding the caller
+        self.wrapper_codes = set()  # type: Set[CodeType]
+
+        # Default for the `lazy` argument of __call__
+        self.lazy = False
 
     @lru_cache()
     def compile(self, source, filename, flags=0):
@@ -174,25 +300,20 @@ class TreeTracerBase(object):
             for f, name in traced_file.trace_methods.items()
         }
 
-    def trace_function(self, func):
-        # type: (FunctionType) -> FunctionType
+    def trace_function(self, func, expressions=True):
+        # type: (FunctionType, bool) -> FunctionType
         """
         Returns a version of the passed function with the AST modified to
         trigger the tracing hooks.
-        """
-        if not isinstance(func, FunctionType):
-            raise ValueError('You can only trace user-defined functions. '
-                             'The birdseye decorator must be applied first, '
-                             'at the bottom of the list.')
 
-        try:
-            if inspect.iscoroutinefunction(func) or inspect.isasyncgenfunction(func):
-                raise ValueError('You cannot trace async functions')
-        except AttributeError:
-            pass
+        If expressions is False and sys.monitoring is available (Python 3.12+),
+        the returned function runs the original code instead, and the statement
+        and call hooks are triggered by sys.monitoring events,
+        without observing the values of expressions (see birdseye.monitoring).
+        """
+        use_monitoring = not expressions and monitoring.available
 
-        if is_lambda(func):
-            raise ValueError('You cannot trace lambdas')
+        self._check_traceable(func)
 
         filename = inspect.getsourcefile(func)  # type: str
 
@@ -212,26 +333,12 @@ class TreeTracerBase(object):
         # e.g. enclosing functions and classes or __future__ imports
         traced_file = self.compile(source, filename, flags)
 
-        if func.__dict__:
-            raise ValueError('The birdseye decorator must be applied first, '
-                             'at the bottom of the list.')
-
-        # Then we have to recursively search through the newly compiled
-        # code to find the code we actually want corresponding to this function
-        code_options = []  # type: List[CodeType]
-
-        def find_code(root_code):
-            # type: (CodeType) -> None
-            for const in root_code.co_consts:  # type: CodeType
-                if not inspect.iscode(const):
-                    continue
-                matches = (const.co_firstlineno == func.__code__.co_firstlineno and
-                           const.co_name == func.__code__.co_name)
-                if matches:
-                    code_options.append(const)
-                find_code(const)
-
-        find_code(traced_file.code)
+        # Then we have to find the code we actually want corresponding to this function
+        # in the newly compiled code
+        code_options = traced_file.find_codes(
+            func.__code__.co_firstlineno, func.__code__.co_name,
+            instrumented=not use_monitoring,
+        )
 
         if len(code_options) > 1:
             # Currently lambdas aren't allowed anyway, but should be in the future
@@ -239,10 +346,13 @@ class TreeTracerBase(object):
             raise ValueError("Failed to trace lambda. Convert the function to a def.")
         new_func_code = code_options[0]  # type: CodeType
 
-        # Give the new function access to the hooks
-        # We have to use the original __globals__ and not a copy
-        # because it's the actual module namespace that may get updated by other code
-        func.__globals__.update(self._trace_methods_dict(traced_file))
+        if use_monitoring:
+            monitoring.monitor(self, traced_file, new_func_code)
+        else:
+            # Give the new function access to the hooks
+            # We have to use the original __globals__ and not a copy
+            # because it's the actual module namespace that may get updated by other code
+            func.__globals__.update(self._trace_methods_dict(traced_file))
 
         # http://stackoverflow.com/a/13503277/2482744
         # noinspection PyArgumentList
@@ -252,8 +362,32 @@ class TreeTracerBase(object):
         new_func.traced_file = traced_file
         return new_func
 
-    def __call__(self, func=None, optional=False):
-        # type: (FunctionType, bool) -> Callable
+    @staticmethod
+    def _check_traceable(func):
+        # type: (FunctionType) -> None
+        """
+        Raises a ValueError if func can't be traced, without doing any expensive work.
+        """
+        if not isinstance(func, FunctionType):
+            raise ValueError('You can only trace user-defined functions. '
+                             'The birdseye decorator must be applied first, '
+                             'at the bottom of the list.')
+
+        try:
+            if inspect.iscoroutinefunction(func) or inspect.isasyncgenfunction(func):
+                raise ValueError('You cannot trace async functions')
+        except AttributeError:
+            pass
+
+        if is_lambda(func):
+            raise ValueError('You cannot trace lambdas')
+
+        if func.__dict__:
+            raise ValueError('The birdseye decorator must be applied first, '
+                             'at the bottom of the list.')
+
+    def __call__(self, func=None, optional=False, sample_rate=None, when=None, expressions=True, lazy=None):
+        # type: (FunctionType, bool, Optional[float], Optional[Callable[..., bool]], bool, Optional[bool]) -> Callable
         """
         Decorator which returns a (possibly optionally) traced function.
         This decorator can be called with or without arguments.
@@ -263,119 +397,263 @@ class TreeTracerBase(object):
         but with an additional optional parameter trace_call, default False.
         If trace_call is false, the underlying untraced function is used.
         If true, the traced version is used.
+        If sample_rate is given, each call is traced with that probability
+        (a number between 0 and 1). If `when` is given, it's called with the same
+        arguments as the function and each call is only traced if it returns true.
+        Both can be combined, and an explicit trace_call argument takes precedence.
+        If expressions=False, the values of expressions aren't traced,
+        which is much faster in Python 3.12+, see trace_function.
+        If lazy=True, the function isn't instrumented until the first call
+        that may be traced, so that decorating functions which are never called
+        costs almost nothing. The default is the `lazy` attribute of the tracer.
         """
         if inspect.isclass(func):
             raise TypeError('Decorating classes is no longer supported')
 
-        if func:
-            # The decorator has been called without arguments/parentheses,
-            # e.g.
-            # @eye
-            # def ...
-            return self.trace_function(func)
-
-        # The decorator has been called with arguments/parentheses,
-        # e.g.
-        # @eye(...)
-        # def ...
-        # We must return a decorator
+        if sample_rate is not None and not 0 <= sample_rate <= 1:
+            raise ValueError('sample_rate must be between 0 and 1')
 
-        if not optional:
-            return self.trace_function
+        if lazy is None:
+            lazy = self.lazy
 
         def decorator(actual_func):
 
-            traced = self.trace_function(actual_func)
+            def instrument():
+                # type: () -> Tuple[FunctionType, Callable[..., bool]]
+                if expressions:
+                    traced = self.trace_function(actual_func)
+                else:
+                    traced = self.trace_function(actual_func, expressions=False)
+                should_trace = self._call_filter(traced, optional, sample_rate, when)
+                if should_trace is None and optional:
+                    should_trace = _never
+                return traced, should_trace
+
+            if lazy:
+                return self._lazy_function(actual_func, instrument, optional,
+                                           sample_rate is None and when is None)
+
+            traced, should_trace = instrument()
+            if should_trace is None:
+                return traced
 
             @wraps(actual_func)
             def wrapper(*args, **kwargs):
-                trace_call = kwargs.pop('trace_call', False)
+                trace_call = kwargs.pop('trace_call', None) if optional else None
+                if trace_call is None:
+                    trace_call = should_trace(*args, **kwargs)
                 if trace_call:
                     f = traced
                 else:
                     f = actual_func
                 return f(*args, **kwargs)
 
+            self.wrapper_codes.add(wrapper.__code__)
             return wrapper
 
+        if func:
+            # The decorator has been called without arguments/parentheses,
+            # e.g.
+            # @eye
+            # def ...
+            return decorator(func)
+
+        # The decorator has been called with arguments/parentheses,
+        # e.g.
+        # @eye(...)
+        # def ...
+        # We must return a decorator
         return decorator
 
-    def _main_frame(self, node):
-        # type: (ast.AST) -> Optional[FrameType]
-        frame = sys._getframe(2 + PYPY)
-        result = self.secondary_to_main_frames.get(frame)
-        if result:
-            return result
-
-        original_frame = frame
-
-        # Generator expressions are not attached to the original frame
-        # They may or may not run within that frame
-        # Don't cache a main frame for them or any frame within
-        in_genexpr = False
-
-        while frame.f_code.co_name in ('<listcomp>', '<dictcomp>', '<setcomp>', '<genexpr>'):
-            if frame.f_code.co_name == '<genexpr>':
-                in_genexpr = True
-                # If not currently called from the frame which defined it...
-                if frame.f_code not in frame.f_back.f_code.co_consts:
-                    return None
-            frame = frame.f_back
-
-        for node in ancestors(node):
-            if isinstance(node, (ast.FunctionDef, ast.Lambda)):
-                break
+    def _lazy_function(self, actual_func, instrument, optional, unfiltered):
+        # type: (FunctionType, Callable[[], Tuple[FunctionType, Optional[Callable[..., bool]]]], bool, bool) -> Callable
+        """
+        Returns a trampoline which calls instrument() to get the traced function
+        and the result of _call_filter the first time it's needed, see __call__.
+        If unfiltered is true, i.e. there's no sample_rate or `when`,
+        optional functions are only instrumented when called with trace_call=True.
+        """
+        self._check_traceable(actual_func)
+        instrumented = []  # type: List[Tuple[FunctionType, Optional[Callable[..., bool]]]]
+        lock = Lock()
+
+        @wraps(actual_func)
+        def trampoline(*args, **kwargs):
+            trace_call = kwargs.pop('trace_call', None) if optional else None
+            if optional and not trace_call and (trace_call is not None or unfiltered):
+                return actual_func(*args, **kwargs)
+
+            if not instrumented:
+                with lock:
+                    if not instrumented:
+                        instrumented.append(instrument())
+            traced, should_trace = instrumented[0]
+
+            if trace_call or should_trace is None or should_trace(*args, **kwargs):
+                f = traced
+            else:
+                f = actual_func
+            return f(*args, **kwargs)
 
-            if isinstance(node, ast.ClassDef):
-                frame = frame.f_back
+        self.wrapper_codes.add(trampoline.__code__)
+        return trampoline
 
-        if frame.f_code.co_name == '<lambda>':
-            return None
+    def _call_filter(self, traced, optional, sample_rate, when):
+        # type: (FunctionType, bool, Optional[float], Optional[Callable[..., bool]]) -> Optional[Callable[..., bool]]
+        """
+        Returns a function which decides at the start of each call whether to use
+        the traced version of a function, see __call__.
+        Returns None if there's nothing to decide, i.e. all calls should be traced,
+        or none should unless optional=True and trace_call=True.
+        """
+        if sample_rate is None:
+            return when
+
+        if when is None:
+            return lambda *_, **__: random() < sample_rate
 
-        if not in_genexpr:
-            self.secondary_to_main_frames[original_frame] = frame
-            self.main_to_secondary_frames[frame].append(original_frame)
-        return frame
+        return lambda *args, **kwargs: random() < sample_rate and when(*args, **kwargs)
 
-    def _treetrace_hidden_with_stmt(self, traced_file, _tree_index):
-        # type: (TracedFile, int) -> _StmtContext
+    def _treetrace_hidden_enter_call(self, traced_file, _tree_index):
+        # type: (TracedFile, int) -> FrameInfo
         """
-        Called directly from the modified code.
-        Every statement in the original code becomes:
+        Called directly from the modified code at the start of each function
+        and module. The returned FrameInfo is stored in a variable
+        which is passed to all the other hooks:
 
-        with _treetrace_hidden_with_stmt(...):
-            <statement>
+        _treetrace_hidden_<frame_info_name> = _treetrace_hidden_enter_call(_tree_index)
+        """
+        node = traced_file.nodes[_tree_index]
+        frame = sys._getframe(1 + PYPY)
+        frame_info = self._enter_call(node, frame)
+        if isinstance(node.parent, ast.Module) and frame.f_globals is not frame.f_locals:
+            # Comprehensions and functions look up the variable in the globals
+            frame.f_globals[traced_file.frame_info_name] = frame_info
+        return frame_info
+
+    def _treetrace_hidden_before_stmt(self, traced_file, frame_info, _tree_index):
+        # type: (TracedFile, Optional[FrameInfo], int) -> None
+        """
+        Called directly from the modified code before each statement,
+        see _NodeVisitor.visit_stmt.
         """
+        if frame_info is None:
+            return
         node = traced_file.nodes[_tree_index]
-        assert isinstance(node, ast.stmt)
-        frame = self._main_frame(node)
-        return _StmtContext(self, node, frame)
+        del frame_info.expression_stack[:]
+        frame_info.statement_stack.append(node)
+        self.before_stmt(node, frame_info.frame)
+
+    def _treetrace_hidden_after_stmt(self, traced_file, frame_info, _tree_index):
+        # type: (TracedFile, Optional[FrameInfo], int) -> None
+        """
+        Called directly from the modified code after each statement,
+        in a `finally` block so that it also runs after return, break, and continue.
+        """
+        if frame_info is None:
+            return
+        node = traced_file.nodes[_tree_index]
+        statement_stack = frame_info.statement_stack
+        # Otherwise the statement raised an exception and has already been
+        # handled by _treetrace_hidden_stmt_exception
+        if statement_stack and statement_stack[-1] is node:
+            self._after_stmt(node, frame_info, None, None)
+
+    def _treetrace_hidden_stmt_exception(self, traced_file, frame_info, _tree_index):
+        # type: (TracedFile, Optional[FrameInfo], int) -> bool
+        """
+        Called directly from the modified code when a statement raises an exception.
+        Returns True if the exception should be suppressed.
+        """
+        if frame_info is None:
+            return False
+        node = traced_file.nodes[_tree_index]
+        _, exc_val, exc_tb = sys.exc_info()
+        return bool(self._after_stmt(node, frame_info, exc_val, exc_tb))
+
+    def _after_stmt(self, node, frame_info, exc_val, exc_tb):
+        # type: (ast.stmt, FrameInfo, Optional[BaseException], Optional[TracebackType]) -> Optional[bool]
+        frame = frame_info.frame
+        frame_info.statement_stack.pop()
+
+        exc_node = None  # type: Optional[Union[ast.expr, ast.stmt]]
+        if exc_val and exc_val is not frame_info.exc_value:
+            exc_node = node
+            frame_info.exc_value = exc_val
+
+            # Call the after_expr hook if the exception was raised by an expression
+            expression_stack = frame_info.expression_stack
+            if expression_stack:
+                exc_node = expression_stack[-1]
+                self._after_expr(exc_node, frame, None, exc_val, exc_tb)
 
-    def _treetrace_hidden_before_expr(self, traced_file, _tree_index):
-        # type: (TracedFile, int) -> ast.expr
+        result = self.after_stmt(node, frame, exc_val, exc_tb, exc_node)
+
+        if isinstance(node, ast.Return):
+            frame_info.return_node = node
+
+        return_node = frame_info.return_node
+        exiting = (getattr(node, '_maybe_exit_call_node', False) and
+                   (getattr(node, '_exit_call_node', False) or
+                    exc_val or
+                    return_node))
+        if exiting:
+            return_value = None
+            if return_node and return_node.value and not exc_val:
+                return_value = frame_info.expression_values[return_node.value]
+            self._exit_call(frame_info, return_node, return_value, exc_val, exc_tb)
+
+        return result
+
+    def _exit_call(self, frame_info, return_node, return_value, exc_val, exc_tb):
+        # type: (FrameInfo, Optional[ast.Return], Any, Optional[BaseException], Optional[TracebackType]) -> None
+        frame = frame_info.frame
+        caller_frame, call_node = self._get_caller_stuff(frame)
+        self.exit_call(ExitCallInfo(call_node,
+                                    return_node,
+                                    caller_frame,
+                                    frame,
+                                    return_value,
+                                    exc_val,
+                                    exc_tb
+                                    ))
+
+        del self.stack[frame]
+
+        # Generator expressions from this frame may still run after this,
+        # but they shouldn't be traced. A module's FrameInfo also stays
+        # in its globals, so don't let it keep values alive.
+        frame_info.frame = None
+        frame_info.expression_values.clear()
+
+    def _treetrace_hidden_before_expr(self, traced_file, frame_info, _tree_index):
+        # type: (TracedFile, Optional[FrameInfo], int) -> ast.expr
         """
         Called directly from the modified code before an expression is
         evaluated.
         """
         node = traced_file.nodes[_tree_index]
         assert isinstance(node, ast.expr)
-        frame = self._main_frame(node)
-        if frame is None:
+
+        # frame_info is None inside lambdas, and its frame is None
+        # for generator expressions which have outlived their frame
+        if frame_info is None or frame_info.frame is None:
             return node
 
-        frame_info = self.stack[frame]
         frame_info.expression_stack.append(node)
 
-        self.before_expr(node, frame)
+        self.before_expr(node, frame_info.frame)
         return node
 
-    def _treetrace_hidden_after_expr(self, _, node, value):
-        # type: (TracedFile, ast.expr, Any) -> Any
+    def _treetrace_hidden_after_expr(self, _, frame_info, node, value):
+        # type: (TracedFile, Optional[FrameInfo], ast.expr, Any) -> Any
         """
         Called directly from the modified code after an expression is
         evaluated.
         """
-        frame = self._main_frame(node)
+        if frame_info is None:
+            return value
+        frame = frame_info.frame
         if frame is None:
             return value
 
@@ -392,19 +670,30 @@ class TreeTracerBase(object):
         return self.after_expr(node, frame, value, exc_value, exc_tb)
 
     def _enter_call(self, enter_node, current_frame):
-        # type: (ast.AST, FrameType) -> None
+        # type: (ast.AST, FrameType) -> FrameInfo
         caller_frame, call_node = self._get_caller_stuff(current_frame)
-        self.stack[current_frame] = FrameInfo()
+        frame_info = self.stack[current_frame] = FrameInfo(current_frame)
         self.enter_call(EnterCallInfo(call_node, enter_node, caller_frame, current_frame))
+        return frame_info
 
     def _get_caller_stuff(self, frame):
         # type: (FrameType) -> Tuple[FrameType, Optional[Union[ast.expr, ast.stmt]]]
         caller_frame = frame.f_back
+        while caller_frame.f_code in self.wrapper_codes:
+            caller_frame = caller_frame.f_back
+
+        # Find the function or module containing the comprehension
+        # or class body that the call was made from, if any
+        while caller_frame.f_code in self.secondary_codes:
+            # Generator expressions may be iterated outside the frame that defined them
+            if (caller_frame.f_code.co_name == '<genexpr>' and
+                    caller_frame.f_code not in caller_frame.f_back.f_code.co_consts):
+                break
+            caller_frame = caller_frame.f_back
+
         call_node = None
-        main_frame = self.secondary_to_main_frames.get(caller_frame)
-        if main_frame:
-            caller_frame = main_frame
-            frame_info = self.stack[caller_frame]
+        frame_info = self.stack.get(caller_frame)
+        if frame_info:
             expression_stack = frame_info.expression_stack
             if expression_stack:
                 call_node = expression_stack[-1]
@@ -472,6 +761,18 @@ class TreeTracerBase(object):
         Called before the AST (root) is modified to let subclasses make additional changes first.
         """
 
+    def needs_expr_hooks(self, node):
+        # type: (ast.expr) -> bool
+        """
+        Called for each expression node when the AST is modified, after parse_extra.
+        Return False to leave the expression as it is, so that before_expr and
+        after_expr are never called for it, which makes the traced code faster.
+        The node's children are still considered separately.
+        Any node whose value might be needed later (e.g. the value of a return statement,
+        which is passed to exit_call) must return True.
+        """
+        return True
+
 
 class _NodeVisitor(ast.NodeTransformer):
     """
@@ -481,12 +782,33 @@ class _NodeVisitor(ast.NodeTransformer):
     def __init__(self, traced_file):
         self.traced_file = traced_file
 
+    # Lambdas and async functions don't get their own FrameInfo,
+    # and the FrameInfo of the enclosing function belongs to a different frame,
+    # so the code inside them isn't traced
+
+    def visit_Lambda(self, node):
+        # type: (ast.Lambda) -> ast.AST
+        result = self.generic_visit(node)
+        node.body = self._frame_info_remover().visit(node.body)
+        return result
+
+    def visit_AsyncFunctionDef(self, node):
+        # type: (ast.AsyncFunctionDef) -> ast.AST
+        result = self.generic_visit(node)
+        remover = self._frame_info_remover()
+        node.body = [remover.visit(stmt) for stmt in node.body]
+        return result
+
+    def _frame_info_remover(self):
+        return _FrameInfoRemover(self.traced_file.frame_info_name)
+
     def generic_visit(self, node):
         # type: (ast.AST) -> ast.AST
         if not getattr(node, '_visit_ignore', False):
             if (isinstance(node, ast.expr) and
                     not (hasattr(node, "ctx") and not isinstance(node.ctx, ast.Load)) and
-                    not isinstance(node, (getattr(ast, 'Starred', ()), ast.Slice))):
+                    not isinstance(node, (getattr(ast, 'Starred', ()), ast.Slice)) and
+                    self.traced_file.tracer.needs_expr_hooks(node)):
                 return self.visit_expr(node)
             if isinstance(node, ast.stmt):
                 return self.visit_stmt(node)
@@ -496,7 +818,7 @@ class _NodeVisitor(ast.NodeTransformer):
         # type: (ast.expr) -> ast.Call
         """
         each expression e gets wrapped like this:
-            _treetrace_hidden_after_expr(_treetrace_hidden_before_expr(_tree_index), e)
+            _treetrace_hidden_after_expr(frame_info, _treetrace_hidden_before_expr(frame_info, _tree_index), e)
 
         where the _treetrace_* functions are the corresponding methods with the
         TreeTracerBase and traced_file arguments already filled in (see _trace_methods_dict)
@@ -513,6 +835,7 @@ class _NodeVisitor(ast.NodeTransformer):
                 ctx=ast.Load(),
             ),
             args=[
+                self._frame_info(),
                 before_marker,
                 super(_NodeVisitor, self).generic_visit(node),
             ],
@@ -524,112 +847,162 @@ class _NodeVisitor(ast.NodeTransformer):
         return after_marker
 
     def visit_stmt(self, node):
-        # type: (ast.stmt) -> ast.With
+        # type: (ast.stmt) -> List[ast.stmt]
         """
         Every statement in the original code becomes:
 
-        with _treetrace_hidden_with_stmt(_tree_index):
+        _treetrace_hidden_before_stmt(frame_info, _tree_index)
+        try:
             <statement>
+        except:
+            if not _treetrace_hidden_stmt_exception(frame_info, _tree_index):
+                raise
+        finally:
+            _treetrace_hidden_after_stmt(frame_info, _tree_index)
 
-        where the _treetrace_hidden_with_stmt function is the the corresponding method with the
-        TreeTracerBase and traced_file arguments already filled in (see _trace_methods_dict)
-        """
-        context_expr = self._create_simple_marker_call(
-            super(_NodeVisitor, self).generic_visit(node),
-            TreeTracerBase._treetrace_hidden_with_stmt)
+        where the _treetrace_hidden_* functions are the corresponding methods with the
+        TreeTracerBase and traced_file arguments already filled in (see _trace_methods_dict).
+        The `except` clause is left out for statements which can't raise exceptions.
+
+        The first statement of each function and module is also preceded by:
 
-        wrapped = ast.With(
-            items=[ast.withitem(context_expr=context_expr)],
-            body=[node],
+        frame_info = _treetrace_hidden_enter_call(_tree_index)
+        """
+        before = ast.Expr(self._create_simple_marker_call(
+            node, TreeTracerBase._treetrace_hidden_before_stmt))
+        after = ast.Expr(self._create_simple_marker_call(
+            node, TreeTracerBase._treetrace_hidden_after_stmt))
+
+        handlers = []
+        if not isinstance(node, _STATEMENTS_WITHOUT_EXCEPTIONS):
+            handlers.append(ast.ExceptHandler(
+                type=None,
+                name=None,
+                body=[ast.If(
+                    test=ast.UnaryOp(
+                        op=ast.Not(),
+                        operand=self._create_simple_marker_call(
+                            node, TreeTracerBase._treetrace_hidden_stmt_exception),
+                    ),
+                    body=[ast.Raise(exc=None, cause=None)],
+                    orelse=[],
+                )],
+            ))
+
+        wrapped = ast.Try(
+            body=[super(_NodeVisitor, self).generic_visit(node)],
+            handlers=handlers,
+            orelse=[],
+            finalbody=[after],
         )
-        ast.copy_location(wrapped, node)
-        ast.fix_missing_locations(wrapped)
-        return wrapped
+
+        result = [before, wrapped]
+
+        if getattr(node, '_enter_call_node', False):
+            result.insert(0, ast.Assign(
+                targets=[ast.Name(id=self.traced_file.frame_info_name, ctx=ast.Store())],
+                value=ast.Call(
+                    func=ast.Name(
+                        id=self.traced_file.trace_methods[
+                            TreeTracerBase._treetrace_hidden_enter_call
+                        ],
+                        ctx=ast.Load(),
+                    ),
+                    args=[ast.Constant(node._tree_index)],
+                    keywords=[],
+                ),
+            ))
+
+        for stmt in result:
+            ast.copy_location(stmt, node)
+            ast.fix_missing_locations(stmt)
+        return result
+
+    def _frame_info(self):
+        # type: () -> ast.Name
+        return ast.Name(id=self.traced_file.frame_info_name, ctx=ast.Load())
 
     def _create_simple_marker_call(self, node, func):
         # type: (ast.AST, Callable) -> ast.Call
         """
-        Returns a Call node representing `func(node._tree_index)`
+        Returns a Call node representing `func(frame_info, node._tree_index)`
         where node._tree_index is a numerical literal which allows the node object
         to be retrieved later through the nodes attribute of a TracedFile.
         """
         return ast.Call(
             func=ast.Name(id=self.traced_file.trace_methods[func], ctx=ast.Load()),
-            args=[ast.Constant(node._tree_index)],
+            args=[self._frame_info(), ast.Constant(node._tree_index)],
             keywords=[],
         )
 
 
-class _StmtContext(object):
-    __slots__ = ('tracer', 'node', 'frame')
+class _FrameInfoRemover(ast.NodeTransformer):
+    """
+    Replaces references to the FrameInfo variable with None in already
+    modified code, which tells the hooks not to trace those nodes.
+    """
 
-    def __init__(self, tracer, node, frame):
-        # type: (TreeTracerBase, ast.stmt, FrameType) -> None
-        self.tracer = tracer
-        self.node = node
-        self.frame = frame
+    def __init__(self, name):
+        self.name = name
 
-    def __enter__(self):
-        tracer = self.tracer
-        node = self.node
-        frame = self.frame
-        if getattr(node, '_enter_call_node', False):
-            tracer._enter_call(node, frame)
-        frame_info = tracer.stack[frame]
-        frame_info.expression_stack = []
-        frame_info.statement_stack.append(node)
-        tracer.before_stmt(node, frame)
+    def visit_Name(self, node):
+        # type: (ast.Name) -> ast.AST
+        if node.id == self.name and isinstance(node.ctx, ast.Load):
+            return ast.copy_location(ast.Constant(None), node)
+        return node
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        # type: (Type[Exception], Exception, TracebackType) -> bool
-        node = self.node
-        tracer = self.tracer
-        frame = self.frame
-        frame_info = tracer.stack[frame]
+    def visit_FunctionDef(self, node):
+        # type: (ast.FunctionDef) -> ast.FunctionDef
+        # The body of a nested function uses its own FrameInfo,
+        # only the parts evaluated when it's defined are affected
+        node.decorator_list = [self.visit(d) for d in node.decorator_list]
+        node.args = self.visit(node.args)
+        if node.returns:
+            node.returns = self.visit(node.returns)
+        return node
 
-        frame_info.statement_stack.pop()
 
-        exc_node = None  # type: Optional[Union[ast.expr, ast.stmt]]
-        if exc_val and exc_val is not frame_info.exc_value:
-            exc_node = node
-            frame_info.exc_value = exc_val
+# These don't need to be wrapped in try/except
+_STATEMENTS_WITHOUT_EXCEPTIONS = (ast.Pass, ast.Break, ast.Continue, ast.Global, ast.Nonlocal)
 
-            # Call the after_expr hook if the exception was raised by an expression
-            expression_stack = frame_info.expression_stack
-            if expression_stack:
-                exc_node = expression_stack[-1]
-                tracer._after_expr(exc_node, frame, None, exc_val, exc_tb)
 
-        result = tracer.after_stmt(node, frame, exc_val, exc_tb, exc_node)
+def _never(*_, **__):
+    return False
 
-        if isinstance(node, ast.Return):
-            frame_info.return_node = node
 
-        parent = node.parent  # type: ast.AST
-        return_node = frame_info.return_node
-        exiting = (isinstance(parent, (ast.FunctionDef, ast.Module)) and
-                   (node is parent.body[-1] or
-                    exc_val or
-                    return_node))
-        if exiting:
-            caller_frame, call_node = tracer._get_caller_stuff(frame)
-            return_value = None
-            if return_node and return_node.value and not exc_val:
-                return_value = frame_info.expression_values[return_node.value]
-            tracer.exit_call(ExitCallInfo(call_node,
-                                          return_node,
-                                          caller_frame,
-                                          frame,
-                                          return_value,
-                                          exc_val,
-                                          exc_tb
-                                          ))
-
-            del tracer.stack[frame]
-            for secondary_frame in self.tracer.main_to_secondary_frames.pop(frame):
-                del self.tracer.secondary_to_main_frames[secondary_frame]
+def _code_index(root_code):
+    # type: (CodeType) -> Dict[Tuple[int, str], List[CodeType]]
+    """
+    Maps (co_firstlineno, co_name) to the code objects nested anywhere within root_code.
+    """
+    index = defaultdict(list)  # type: Dict[Tuple[int, str], List[CodeType]]
 
-        return result
+    def add_codes(code):
+        # type: (CodeType) -> None
+        for const in code.co_consts:
+            if inspect.iscode(const):
+                index[const.co_firstlineno, const.co_name].append(const)
+                add_codes(const)
+
+    add_codes(root_code)
+    return dict(index)
+
+
+def _secondary_codes(root_code):
+    # type: (CodeType) -> Iterator[CodeType]
+    """
+    Yields the code objects of comprehensions and class bodies within root_code.
+    Class bodies are the only nested code objects which don't
+    get their own local namespace like functions.
+    """
+    for const in root_code.co_consts:
+        if not inspect.iscode(const):
+            continue
+        if (const.co_name in ('<listcomp>', '<dictcomp>', '<setcomp>', '<genexpr>') or
+                not const.co_flags & inspect.CO_NEWLOCALS):
+            yield const
+        for code in _secondary_codes(const):
+            yield code
 
 
 def ancestors(node):
@@ -5,6 +5,7 @@ import ntpath
 import os
 import sys
 import token
+from collections import namedtuple
 
 from littleutils import strip_required_prefix
 
@@ -122,6 +123,12 @@ def source_without_decorators(tokens, function_node):
     return startpos, source
 
 
+def first_lineno(stmt):
+    # type: (ast.stmt) -> int
+    # The code of a decorated function or class starts at the first decorator
+    return min([stmt.lineno] + [d.lineno for d in getattr(stmt, 'decorator_list', ())])
+
+
 def prn(*args):
     for arg in args:
         print(arg)
@@ -160,8 +167,84 @@ html_escape_table = {
 }
 
 
+_html_escape_translation = str.maketrans(html_escape_table)
+
+
 def html_escape(text):
-    return "".join(html_escape_table.get(c, c) for c in text)
+    return text.translate(_html_escape_translation)
+
+
+HTMLPosition = namedtuple('HTMLPosition', 'index is_start depth html')
+
+
+def render_html_body(html_data):
+    # type: (dict) -> str
+    """
+    Renders the HTML of a function from the data produced by BirdsEye._html_data:
+    the source code with a <span> around each node that can be inspected.
+
+    The algorithm for generating the HTML works as follows. We generate a list
+    of HTMLPositions, which are essentially places to insert HTML into the source plus some
+    metadata. The order of the fields of HTMLPosition ensure that when the list is sorted,
+    the resulting HTML is valid and correct. Specifically, the fields are:
+
+      1. index: the index in the source string where the HTML would be inserted
+      2. is_start: Indicates if this piece of HTML is the start of a tag, rather than the end.
+         Ends should appear first, so that the resulting HTML looks like:
+            <span> ... </span><span> ... </span>
+         rather than:
+            <span> ... <span></span> ... </span>
+         (I think this might actually be unnecessary, since I can't think of any cases of two
+          expressions right next to each other with nothing in between)
+      3. depth: the depth of the corresponding node in the AST. We want the start of a tag from
+         a node to appear before the start of a tag nested within, e.g. `foo()` should become:
+            <span [for foo()]><span [for foo]>foo</span>()</span>
+         rather than:
+            <span [for foo]><span [for foo()]>foo</span>()</span>
+      4. html: the actual HTML to insert. Not important for ordering.
+
+    Mostly the list contains pairs of HTMLPositions corresponding to AST nodes, one for the
+    start and one for the end.
+
+    After the list is sorted, the HTML generated is essentially:
+
+    source[0:positions[0].index] + positions[0].html + source[positions[0].index:positions[1].index] + positions[1].html + ...
+    """
+    source = html_data['source']
+    positions = []  # type: List[HTMLPosition]
+
+    for tree_index, classes, depth, start, end in html_data['nodes']:
+        # noinspection PyArgumentList
+        positions.extend(map(
+            HTMLPosition,
+            [start, end],
+            [True, False],  # is_start
+            [depth, depth],
+            ['<span data-index="%s" class="%s">' % (tree_index, classes),
+             '</span>']))
+
+    # Separate comprehensions onto their own lines, see BirdsEye._separate_comprehensions
+    for index in html_data['breaks']:
+        positions.append(HTMLPosition(index, True, 0, '\n '))
+
+    # Nodes may extend beyond the lines being shown
+    positions = [position for position in positions
+                 if 0 <= position.index <= len(source)]
+
+    # This just makes the loop below simpler
+    positions.append(HTMLPosition(len(source), False, 0, ''))
+
+    positions.sort()
+
+    html_parts = []
+    start = 0
+    for position in positions:
+        html_parts.append(html_escape(source[start:position.index]))
+        html_parts.append(position.html)
+        start = position.index
+    html_body = ''.join(html_parts)
+
+    return html_body.strip('\n')
 
 
 def format_pandas_index(index):
@@ -0,0 +1 @@
+__version__ = '0.1.dev1+gcfcd3beee.d20261018'
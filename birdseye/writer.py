@@ -0,0 +1,174 @@
+"""
+Writers take the data collected for finished calls (CallRecords) and
+store them in the database. A BirdsEye instance uses the writer in its
+`writer` attribute, which by default is a CallWriter that writes each call
+immediately. Use a BackgroundCallWriter to take the database work
+off the threads being traced:
+
+    from birdseye import eye
+    from birdseye.writer import BackgroundCallWriter
+
+    eye.writer = BackgroundCallWriter(eye)
+"""
+
+import atexit
+import os
+import queue
+import sys
+import traceback
+import weakref
+from collections import namedtuple
+from threading import Lock, Thread
+from time import monotonic
+
+# Everything needed to store a finished call, see BirdsEye.exit_call.
+# `iteration` is the top level Iteration of the call, which is only
+# serialized to JSON when the call is actually written, and the ID of the
+# function in the database is only looked up then too.
+# `truncated` means some values were left out to stay within the limits of the tracer.
+CallRecord = namedtuple('CallRecord', 'id function_hash arguments return_value '
+                                      'exception traceback iteration start_time truncated')
+
+
+class CallWriter(object):
+    """
+    Writes each call to the database as soon as it finishes,
+    on the thread that made the call.
+    """
+
+    def __init__(self, tracer):
+        self.tracer = tracer
+
+        # Number of calls stored in the database by this writer
+        self.written = 0
+
+        # Number of calls which were discarded without being stored,
+        # e.g. because the queue was full
+        self.dropped = 0
+
+    def add_call(self, record):
+        # type: (CallRecord) -> None
+        self.tracer._write_calls([record])
+        self.written += 1
+
+    def flush(self):
+        """
+        Block until every call added so far has been written.
+        """
+
+    def close(self):
+        """
+        Write any remaining calls and stop accepting new ones.
+        """
+
+
+_FLUSH = object()
+_STOP = object()
+
+
+class BackgroundCallWriter(CallWriter):
+    """
+    Puts finished calls in a queue which is consumed by a background thread.
+    The thread serializes the calls and inserts them in batches of up to
+    max_batch_size calls per transaction, waiting at most flush_interval seconds
+    to fill a batch. If the queue already contains max_queue_size calls,
+    new calls are dropped instead of blocking the traced program.
+    Remaining calls are written when the interpreter exits.
+    A child process created by os.fork() gets a new queue and thread.
+    """
+
+    def __init__(self, tracer, max_batch_size=100, flush_interval=1.0, max_queue_size=10000):
+        super(BackgroundCallWriter, self).__init__(tracer)
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self.max_queue_size = max_queue_size
+        self._closed = False
+        self._start()
+        atexit.register(self.close)
+
+        if hasattr(os, 'register_at_fork'):
+            ref = weakref.ref(self)
+
+            def after_fork():
+                writer = ref()
+                if writer is not None:
+                    writer._after_fork()
+
+            os.register_at_fork(after_in_child=after_fork)
+
+    def _start(self):
+        self._queue = queue.Queue(maxsize=self.max_queue_size)
+        self._lock = Lock()
+        self._thread = Thread(target=self._run, name='birdseye-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _after_fork(self):
+        # Only the forking thread exists in the child, so the writer thread
+        # is gone and its locks may be held forever. Calls still in the queue
+        # belong to the parent, which writes them itself.
+        self.written = self.dropped = 0
+        if not self._closed:
+            self._start()
+
+    def add_call(self, record):
+        # type: (CallRecord) -> None
+        if not self._closed:
+            try:
+                self._queue.put_nowait(record)
+                return
+            except queue.Full:
+                pass
+        self._count_dropped(1)
+
+    def _count_dropped(self, n):
+        with self._lock:
+            self.dropped += n
+
+    def flush(self):
+        if self._thread.is_alive():
+            self._queue.put(_FLUSH)
+            self._queue.join()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch = []
+            item = self._queue.get()
+            deadline = monotonic() + self.flush_interval
+            while True:
+                if item is _STOP:
+                    stop = True
+                elif item is not _FLUSH:
+                    batch.append(item)
+                if stop or item is _FLUSH or len(batch) >= self.max_batch_size:
+                    break
+                timeout = deadline - monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                else:
+                    # Every item but the first is marked done here
+                    # so that the first stays pending until the batch is written
+                    self._queue.task_done()
+
+            try:
+                if batch:
+                    self.tracer._write_calls(batch)
+                    self.written += len(batch)
+            except Exception:
+                self._count_dropped(len(batch))
+                traceback.print_exc(file=sys.stderr)
+            finally:
+                self._queue.task_done()
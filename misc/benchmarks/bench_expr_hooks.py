@@ -0,0 +1,80 @@
+"""
+Counts the expression hooks called while running test_scripts/gold.py,
+with and without BirdsEye.needs_expr_hooks skipping expressions
+whose values are never recorded.
+
+Usage:
+
+    python misc/benchmarks/bench_expr_hooks.py
+"""
+
+import os
+import re
+from collections import Counter
+from timeit import default_timer
+
+from birdseye.bird import BirdsEye
+from birdseye.tracer import TreeTracerBase
+from birdseye.writer import CallWriter
+
+counts = Counter()
+
+
+def counting(name):
+    original = getattr(TreeTracerBase, name)
+
+    def wrapper(*args):
+        counts[name] += 1
+        return original(*args)
+
+    return wrapper
+
+
+# TracedFile looks these up when it's created, so they must be replaced first
+for _name in ['_treetrace_hidden_before_stmt',
+              '_treetrace_hidden_before_expr',
+              '_treetrace_hidden_after_expr']:
+    setattr(TreeTracerBase, _name, counting(_name))
+
+
+class _NullWriter(CallWriter):
+    def add_call(self, record):
+        pass
+
+
+class UnprunedBirdsEye(BirdsEye):
+    def needs_expr_hooks(self, node):
+        return True
+
+
+def run(tracer_class):
+    tracer = tracer_class('sqlite://')
+    tracer.writer = _NullWriter(tracer)
+
+    filename = os.path.join(os.path.dirname(__file__), '..', '..', 'test_scripts', 'gold.py')
+    filename = os.path.abspath(filename)
+    with open(filename) as f:
+        # Trace every function with this tracer instead of the global eye
+        source = re.sub(r'^ *@eye\n', '', f.read(), flags=re.MULTILINE)
+    source = source.replace('from birdseye import eye', '')
+
+    counts.clear()
+    start = default_timer()
+    namespace = {'__name__': 'gold'}
+    tracer.exec_string(source, filename, namespace, namespace, deep=True)
+    return dict(counts), default_timer() - start
+
+
+def main():
+    print('%-18s %10s %12s %14s %10s' % ('', 'statements', 'expr hooks', 'per statement', 'seconds'))
+    for tracer_class in [UnprunedBirdsEye, BirdsEye]:
+        result, seconds = run(tracer_class)
+        statements = result['_treetrace_hidden_before_stmt']
+        hooks = (result['_treetrace_hidden_before_expr'] +
+                 result['_treetrace_hidden_after_expr'])
+        print('%-18s %10d %12d %14.2f %10.3f' % (
+            tracer_class.__name__, statements, hooks, hooks / statements, seconds))
+
+
+if __name__ == '__main__':
+    main()
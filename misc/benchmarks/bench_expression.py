@@ -0,0 +1,65 @@
+"""
+Measures the time taken by NodeValue.expression to record a mix of
+values of different types, as happens for every expression in a traced
+function, including a class with a custom expander and modules,
+classes and functions.
+
+Usage:
+
+    python misc/benchmarks/bench_expression.py
+"""
+
+import json
+import os
+from collections import OrderedDict
+from time import perf_counter
+
+from birdseye.bird import NodeValue, eye, register_expander
+
+
+class Plain(object):
+    def __init__(self, i):
+        self.i = i
+        self.name = 'plain%s' % i
+
+
+class Slotted(object):
+    __slots__ = ('a', 'b')
+
+    def __init__(self, i):
+        self.a = i
+        self.b = str(i)
+
+
+class Custom(object):
+    def __init__(self, i):
+        self.i = i
+        self.data = list(range(50))
+
+
+@register_expander(Custom)
+def expand_custom(val, add_child, samples):
+    add_child('i', val.i)
+
+
+values = [
+    1, 2.5, None, True, 'string', b'bytes', range(10),
+    [1, 2, 3], (4, 5), {'a': 1, 'b': [2]}, {1, 2}, frozenset([3]),
+    OrderedDict(x=1), Plain(1), Slotted(2), Custom(3),
+    json, os, OrderedDict, Plain, json.dumps, len,
+]
+repeat = 2000
+
+
+def main():
+    for level in [3, 1]:
+        start = perf_counter()
+        for _ in range(repeat):
+            for val in values:
+                NodeValue.expression(eye.num_samples, val, level)
+        elapsed = perf_counter() - start
+        print('level %s %8.2f us per value' % (level, elapsed / repeat / len(values) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
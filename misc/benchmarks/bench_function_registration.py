@@ -0,0 +1,44 @@
+"""
+Measures the time taken to store the functions of a module with many
+traced functions in the database, the first time and when the IDs
+are already in the code cache, as in a later run of the same program.
+
+Usage:
+
+    python misc/benchmarks/bench_function_registration.py
+"""
+
+import os
+from tempfile import mkdtemp
+from time import perf_counter
+
+from birdseye import cache
+from birdseye.bird import BirdsEye
+from birdseye.cache import CodeCache
+
+num_functions = 200
+source = ''.join('def f%s(x):\n    return x + %s\n\n' % (i, i)
+                 for i in range(num_functions)) + 'f0(1)\n'
+
+
+def run(directory):
+    tracer = BirdsEye(os.path.join(directory, 'bench.db'))
+    tracer.code_cache = CodeCache(directory)
+    tracer.db  # Leave creating the tables out of the measurement
+    start = perf_counter()
+    tracer.exec_string(source, os.path.join(directory, 'bench_module.py'), deep=True)
+    return perf_counter() - start
+
+
+def main():
+    directory = mkdtemp()
+    print('%s functions' % num_functions)
+    print('%-8s %8.1f ms' % ('first', run(directory) * 1000))
+
+    # Pretend this is a new process
+    cache._names_in_use.clear()
+    print('%-8s %8.1f ms' % ('cached', run(directory) * 1000))
+
+
+if __name__ == '__main__':
+    main()
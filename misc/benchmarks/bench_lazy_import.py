@@ -0,0 +1,40 @@
+"""
+Measures the time taken to import a module with many functions decorated
+with @eye, compared with @eye(lazy=True) and no decorator at all.
+
+Usage:
+
+    python misc/benchmarks/bench_lazy_import.py
+"""
+
+import os
+import sys
+from importlib import import_module
+from tempfile import mkdtemp
+from time import perf_counter
+
+num_functions = 200
+directory = mkdtemp()
+sys.path.insert(0, directory)
+
+
+def write_module(name, decorator):
+    with open(os.path.join(directory, name + '.py'), 'w') as f:
+        f.write('from birdseye import eye\n\n')
+        for i in range(num_functions):
+            f.write('%s\ndef f%s(x):\n    return [y + %s for y in x]\n\n' % (decorator, i, i))
+
+
+def main():
+    import birdseye.bird  # Leave importing birdseye out of the measurement
+
+    print('%s functions' % num_functions)
+    for name, decorator in [('untraced', ''), ('eager', '@eye'), ('lazy', '@eye(lazy=True)')]:
+        write_module(name, decorator)
+        start = perf_counter()
+        import_module(name)
+        print('%-8s %8.1f ms' % (name, (perf_counter() - start) * 1000))
+
+
+if __name__ == '__main__':
+    main()
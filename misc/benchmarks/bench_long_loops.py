@@ -0,0 +1,46 @@
+"""
+Measures the time BirdsEye spends per iteration of a long loop,
+most of whose iterations are discarded, so the values of expressions
+in them shouldn't be computed.
+
+Usage:
+
+    python misc/benchmarks/bench_long_loops.py
+"""
+
+from timeit import timeit
+
+from birdseye.bird import BirdsEye
+from birdseye.writer import CallWriter
+
+eye = BirdsEye('sqlite://')
+
+
+class _NullWriter(CallWriter):
+    # Leave the database out of the measurement
+    def add_call(self, record):
+        pass
+
+
+eye.writer = _NullWriter(eye)
+
+
+@eye
+def long_loop(rows):
+    total = 0
+    for row in rows:
+        name = row['name'].upper()
+        total += len(name) * row['count']
+    return total
+
+
+def main():
+    n = 20000
+    rows = [dict(name='row %s' % i, count=i, tags=list(range(10))) for i in range(n)]
+    number = 3
+    seconds = timeit(lambda: long_loop(rows), number=number)
+    print('%.2f us per iteration' % (seconds / number / n * 1e6))
+
+
+if __name__ == '__main__':
+    main()
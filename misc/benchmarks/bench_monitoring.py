@@ -0,0 +1,55 @@
+"""
+Compares the time taken by a traced function with full tracing
+and with @eye(expressions=False), which uses sys.monitoring in Python 3.12+.
+
+Usage:
+
+    python misc/benchmarks/bench_monitoring.py
+"""
+
+import sys
+from timeit import timeit
+
+from birdseye.bird import BirdsEye
+from birdseye.writer import CallWriter
+
+eye = BirdsEye('sqlite://')
+
+
+class _NullWriter(CallWriter):
+    # Leave the database out of the measurement
+    def add_call(self, record):
+        pass
+
+
+eye.writer = _NullWriter(eye)
+
+
+def work(n):
+    total = 0
+    for i in range(n):
+        if i % 3:
+            total += i * 2
+        else:
+            total -= len(str(i))
+    return total
+
+
+full = eye(work)
+light = eye(work, expressions=False)
+
+
+def main():
+    if sys.version_info < (3, 12):
+        print('sys.monitoring requires Python 3.12+, '
+              'expressions=False falls back to full tracing')
+
+    n = 1000
+    number = 20
+    for name, func in [('untraced', work), ('full', full), ('expressions=False', light)]:
+        seconds = timeit(lambda: func(n), number=number)
+        print('%-18s %8.2f ms per call' % (name, seconds / number * 1000))
+
+
+if __name__ == '__main__':
+    main()
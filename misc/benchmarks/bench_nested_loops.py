@@ -0,0 +1,57 @@
+"""
+Measures the time BirdsEye spends per recorded value in deeply nested loops,
+where finding the current iteration of each loop used to dominate.
+
+Usage:
+
+    python misc/benchmarks/bench_nested_loops.py
+"""
+
+from timeit import timeit
+
+from birdseye.bird import BirdsEye
+from birdseye.writer import CallWriter
+
+eye = BirdsEye('sqlite://')
+
+
+class _NullWriter(CallWriter):
+    # Leave the database out of the measurement
+    def add_call(self, record):
+        pass
+
+
+eye.writer = _NullWriter(eye)
+
+
+@eye
+def three_levels(n):
+    total = 0
+    for a in range(n):
+        for b in range(n):
+            for c in range(n):
+                total += a * b - c
+    return total
+
+
+@eye
+def four_levels(n):
+    total = 0
+    for a in range(n):
+        for b in range(n):
+            for c in range(n):
+                for d in range(n):
+                    total += a * b - c * d
+    return total
+
+
+def main():
+    for func, n, levels in [(three_levels, 20, 3), (four_levels, 9, 4)]:
+        number = 3
+        seconds = timeit(lambda: func(n), number=number)
+        print('%s: %.2f us per innermost iteration' % (
+            func.__name__, seconds / number / n ** levels * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+Measures the time taken to record wide and long pandas DataFrames,
+their columns, and a numpy array in a traced loop.
+
+Usage:
+
+    python misc/benchmarks/bench_pandas.py
+"""
+
+from timeit import timeit
+
+import numpy as np
+import pandas as pd
+
+from birdseye.bird import BirdsEye
+from birdseye.writer import CallWriter
+
+eye = BirdsEye('sqlite://')
+
+
+class _NullWriter(CallWriter):
+    # Leave the database out of the measurement
+    def add_call(self, record):
+        pass
+
+
+eye.writer = _NullWriter(eye)
+
+wide = pd.DataFrame(np.random.rand(50, 1000), columns=['c%s' % i for i in range(1000)])
+long = pd.DataFrame(np.random.rand(100000, 10), columns=['c%s' % i for i in range(10)])
+array = np.random.rand(10000, 3)
+
+
+@eye
+def summarise(frames, n):
+    totals = []
+    for i in range(n):
+        for frame in frames:
+            column = frame['c5']
+            totals.append(column.sum() + array[i].sum())
+    return totals
+
+
+def main():
+    number = 3
+    seconds = timeit(lambda: summarise([wide, long], 5), number=number)
+    print('summarise: %.1f ms per call' % (seconds / number * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+Measures how long a call to a traced function takes when it's made
+at different stack depths. The hooks used to walk the whole stack to check
+that they weren't being called recursively, so this grew with the depth.
+
+Usage:
+
+    python misc/benchmarks/bench_reentrancy.py
+"""
+
+import sys
+from timeit import timeit
+
+from birdseye.bird import BirdsEye
+from birdseye.writer import CallWriter
+
+eye = BirdsEye('sqlite://')
+
+
+class _NullWriter(CallWriter):
+    # Leave the database out of the measurement
+    def add_call(self, record):
+        pass
+
+
+eye.writer = _NullWriter(eye)
+
+
+@eye
+def traced(n):
+    total = 0
+    for i in range(n):
+        total += i * i
+    return total
+
+
+def at_depth(depth, func):
+    if depth <= 0:
+        return func()
+    return at_depth(depth - 1, func)
+
+
+def main():
+    sys.setrecursionlimit(10000)
+    number = 200
+    print('%8s %14s' % ('depth', 'us per call'))
+    for depth in [0, 10, 100, 1000, 3000]:
+        seconds = timeit(lambda: at_depth(depth, lambda: traced(10)), number=number)
+        baseline = timeit(lambda: at_depth(depth, lambda: None), number=number)
+        print('%8d %14.1f' % (depth, (seconds - baseline) / number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""
+Measures the time taken by many short calls of a traced function where
+the same small values (loop indices, short strings, tuples of these)
+are recorded over and over.
+
+Usage:
+
+    python misc/benchmarks/bench_repeated_values.py
+"""
+
+from timeit import timeit
+
+from birdseye.bird import BirdsEye
+from birdseye.writer import CallWriter
+
+eye = BirdsEye('sqlite://')
+
+
+class _NullWriter(CallWriter):
+    # Leave the database out of the measurement
+    def add_call(self, record):
+        pass
+
+
+eye.writer = _NullWriter(eye)
+
+
+@eye
+def short_loop(words):
+    result = []
+    for i, word in enumerate(words):
+        pair = (i, word.upper())
+        if len(word) > 3:
+            result.append(pair)
+    return result
+
+
+words = ['apple', 'fig', 'banana', 'kiwi', 'plum']
+
+
+def main():
+    number = 500
+    seconds = timeit(lambda: short_loop(words), number=number)
+    print('short_loop: %.1f us per call' % (seconds / number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Measures the time taken by a new process to import birdseye and
+trace one call, compared to a process that does nothing,
+and lists the optional libraries that importing birdseye loaded.
+
+Usage:
+
+    python misc/benchmarks/bench_startup.py
+"""
+
+import os
+import subprocess
+import sys
+from tempfile import mkdtemp
+from time import perf_counter
+
+repeat = 5
+
+traced_program = '''
+import sys
+from birdseye import eye
+
+@eye
+def f(x):
+    return x + 1
+
+f(1)
+print(' '.join(name for name in ['numpy', 'pandas', 'django'] if name in sys.modules))
+'''
+
+
+def run(args, env):
+    best = float('inf')
+    output = b''
+    for _ in range(repeat):
+        start = perf_counter()
+        output = subprocess.check_output([sys.executable] + args, env=env)
+        best = min(best, perf_counter() - start)
+    return best, output.decode().strip()
+
+
+def main():
+    directory = mkdtemp()
+    env = dict(
+        os.environ,
+        BIRDSEYE_DB=os.path.join(directory, 'bench.db'),
+        BIRDSEYE_CACHE_DIR=directory,
+    )
+    env.pop('BIRDSEYE_CHECK_OUTDATED', None)
+
+    # birdseye needs to read the source of traced functions from a file
+    path = os.path.join(directory, 'bench_program.py')
+    with open(path, 'w') as f:
+        f.write(traced_program)
+
+    empty, _ = run(['-c', 'pass'], env)
+    traced, imported = run([path], env)
+    print('%-8s %8.1f ms' % ('empty', empty * 1000))
+    print('%-8s %8.1f ms' % ('traced', traced * 1000))
+    print('imported: %s' % (imported or 'none'))
+
+
+if __name__ == '__main__':
+    main()
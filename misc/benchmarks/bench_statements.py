@@ -0,0 +1,44 @@
+"""
+Measures the overhead added to each statement by the instrumentation
+itself, using TreeTracerBase without any hooks overridden.
+
+Usage:
+
+    python misc/benchmarks/bench_statements.py
+"""
+
+from timeit import timeit
+
+from birdseye.tracer import TreeTracerBase
+
+tracer = TreeTracerBase()
+
+
+def loop(n):
+    total = 0
+    for i in range(n):
+        if i % 3:
+            continue
+        total += i
+    return total
+
+
+traced_loop = tracer(loop)
+
+
+def main():
+    n = 100000
+    number = 5
+    plain = timeit(lambda: loop(n), number=number)
+    traced = timeit(lambda: traced_loop(n), number=number)
+
+    # Statements executed per call: the loop, `if`, `continue` or `total += i`,
+    # plus `total = 0` and `return` once
+    statements = 3 * n + 2
+    print('untraced: %.3fs' % plain)
+    print('traced:   %.3fs' % traced)
+    print('overhead per statement: %.2f us' % ((traced - plain) / number / statements * 1e6))
+
+
+if __name__ == '__main__':
+    main()
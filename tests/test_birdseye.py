@@ -7,28 +7,37 @@ Module docstrings before __future__ imports can break things...
 from __future__ import division
 
 import ast
+import gc
 import json
 import os
 import random
 import re
+import shutil
 import sys
 import unittest
+import warnings
 import weakref
 from collections import namedtuple
 from copy import copy
 from functools import partial
 from importlib import import_module
 from multiprocessing.dummy import Pool as ThreadPool
+from tempfile import mkdtemp
+from threading import Event
 from time import sleep
 
 from bs4 import BeautifulSoup
-from cheap_repr import register_repr
+from cheap_repr import register_repr, repr_registry
 from littleutils import file_to_json, only
 
-from birdseye import eye
-from birdseye.bird import NodeValue, is_interesting_expression, is_obvious_builtin
-from birdseye.utils import PYPY
-from tests.utils import SharedCounter
+from birdseye import cache, eye
+from birdseye.bird import BirdsEye, NodeValue, is_interesting_expression, is_obvious_builtin
+from birdseye.cache import CodeCache
+from birdseye.governor import OverheadGovernor
+from birdseye.tracer import TreeTracerBase
+from birdseye.utils import FILE_SENTINEL_NAME, PYPY, render_html_body
+from birdseye.writer import BackgroundCallWriter, CallWriter
+from tests.utils import SharedCounter, requires_python_version
 from collections.abc import Set, Mapping
 
 Session = eye.db.Session
@@ -134,13 +143,28 @@ def get_call_stuff(sess, c_id):
     call = sess.query(Call).filter_by(id=c_id).one()
 
     # <pre> makes it preserve whitespace
-    soup = BeautifulSoup('<pre>' + call.function.html_body + '</pre>', 'html.parser')
+    func_data = json.loads(call.function.data)
+    soup = BeautifulSoup('<pre>' + render_html_body(func_data['html']) + '</pre>', 'html.parser')
 
     call_data = normalise_call_data(call.data)
-    func_data = json.loads(call.function.data)
     return CallStuff(copy(call), soup, call_data, func_data)
 
 
+def get_inner_call_ids(c_id):
+    result = []
+
+    def walk(x):
+        if isinstance(x, dict):
+            result.extend(x.get('inner_calls', []))
+            x = list(x.values())
+        if isinstance(x, list):
+            for y in x:
+                walk(y)
+
+    walk(json.loads(get_call_stuff(c_id).call.data))
+    return result
+
+
 def byteify(x):
     # Legacy from Python 2 days
     return x
@@ -373,6 +397,106 @@ class TestBirdsEye(unittest.TestCase):
         for line in str(soup).splitlines():
             self.assertTrue(line.count('for') in (0, 1))
 
+    def test_generator_expressions(self):
+        @eye
+        def consume(it):
+            return list(it)
+
+        @eye
+        def f():
+            return consume(x * 2 for x in [5, 6])
+
+        @eye
+        def g():
+            return (y for y in [7, 8])
+
+        stuff = get_call_stuff(get_call_ids(f)[0])
+
+        # Evaluated in another frame, but still recorded in f
+        self.assertIn({'0': ['10', 'int', {}], '1': ['12', 'int', {}]},
+                      stuff.call_data['node_values'].values())
+
+        # Runs after g has returned, so nothing is recorded
+        self.assertEqual(list(g()), [7, 8])
+        self.assertFalse(eye.stack)
+
+    @requires_python_version(3.12)
+    def test_without_expressions(self):
+        @eye(expressions=False)
+        def f(n):
+            total = 0
+            for i in range(n):
+                if i % 2:
+                    continue
+                total += i
+            while total:
+                total -= 2
+            1 / total
+
+        # Only the original code, not the hooks
+        self.assertNotIn('_treetrace_hidden', str(f.__code__.co_names))
+
+        call_id = get_call_ids(lambda: self.assertRaises(ZeroDivisionError, f, 5))[0]
+        stuff = get_call_stuff(call_id)
+        self.assertEqual(stuff.call.arguments, '[["n", "5"]]')
+        self.assertEqual(stuff.call.exception, 'ZeroDivisionError: division by zero')
+
+        node_values = stuff.call_data['node_values']
+        values = {}
+        for span in stuff.soup('span'):
+            index = span['data-index']
+            if index in node_values:
+                values[span.text.splitlines()[0].strip()] = node_values[index]
+
+        s = ['', -2, {}]
+        self.assertEqual(values, {
+            'total = 0': s,
+            'for i in range(n):': s,
+            'if i % 2:': {str(i): s for i in range(5)},
+            'continue': {'1': s, '3': s},
+            'total += i': {'0': s, '2': s, '4': s},
+            'while total:': s,
+            'total -= 2': {str(i): s for i in range(3)},
+            '1 / total': ['ZeroDivisionError: division by zero', -1, {}],
+        })
+        self.assertEqual(len(stuff.call_data['loop_iterations']), 2)
+        self.assertFalse(eye.stack)
+
+    @requires_python_version(3.12)
+    def test_one_line_loops_without_expressions(self):
+        @eye(expressions=False)
+        def f(n):
+            total = 0
+            for i in range(n): total += i
+            for i in []: total -= i
+            while n: n -= 1
+            for i in range(2): y = [j for j in range(i)]
+            return total
+
+        stuff = get_call_stuff(get_call_ids(lambda: f(5))[0])
+        self.assertEqual(stuff.call.return_value, '10')
+
+        node_values = stuff.call_data['node_values']
+        values = {}
+        for span in stuff.soup('span'):
+            index = span['data-index']
+            if index in node_values:
+                values[' '.join(span.text.split())] = node_values[index]
+
+        s = ['', -2, {}]
+        self.assertEqual(values, {
+            'total = 0': s,
+            'for i in range(n): total += i': s,
+            'total += i': {str(i): s for i in range(5)},
+            'for i in []: total -= i': s,
+            'while n: n -= 1': s,
+            'n -= 1': {str(i): s for i in range(5)},
+            'for i in range(2): y = [j for j in range(i)]': s,
+            'y = [j for j in range(i)]': {'0': s, '1': s},
+            'return total': s,
+        })
+        self.assertFalse(eye.stack)
+
     def test_expansion(self):
         @eye
         def f():
@@ -402,6 +526,265 @@ class TestBirdsEye(unittest.TestCase):
                       ['3', ["'Hello World!H...d!Hello World!'",
                              'str', {'len': 600}]]]]])
 
+    def test_library_types(self):
+        from types import ModuleType
+        from birdseye.bird import LibraryTypes, _Missing
+
+        class FakeLibraryTypes(LibraryTypes):
+            classes = dict(Series=('fake_pandas', 'Series'))
+
+        library_types = FakeLibraryTypes()
+        library_types.update()
+        self.assertIs(library_types.Series, _Missing)
+
+        # The module is found even if another one was removed at the same time,
+        # so the number of modules is the same
+        sys.modules['fake_other'] = ModuleType('fake_other')
+        library_types.update()
+        module = ModuleType('fake_pandas')
+        module.Series = type('Series', (), {})
+        del sys.modules['fake_other']
+        sys.modules['fake_pandas'] = module
+        try:
+            library_types.update()
+        finally:
+            del sys.modules['fake_pandas']
+        self.assertIs(library_types.Series, module.Series)
+
+        import numpy as np
+
+        expand = partial(NodeValue.expression, eye.num_samples)
+        self.assertEqual(expand(np.int64(3), 3).as_json()[0], '3')
+        array = expand(np.array([1, 2]), 3).as_json()
+        self.assertEqual([child[0] for child in array[3:]], ['dtype', 'shape', '0', '1'])
+
+    def test_pandas_samples(self):
+        import numpy as np
+        import pandas as pd
+
+        expand = partial(NodeValue.expression, eye.num_samples)
+        series = pd.Series(np.arange(40) * 2, index=['r%s' % i for i in range(40)])
+        value = expand(series, 3)
+        self.assertEqual([(k, v.val_repr, type(v) is NodeValue) for k, v in value.children[1:]][8:12],
+                         [('r8', '16', True), ('r9', '18', True), ('r30', '60', True), ('r31', '62', True)])
+        self.assertEqual(value.val_repr, 'r0 = 0; r1 = 2; r2 = 4; ...; r37 = 74; r38 = 76; r39 = 78')
+
+        frame = pd.DataFrame(dict(('c%s' % i, range(i, i + 30)) for i in range(200)))
+        value = expand(frame, 3)
+        self.assertEqual(value.meta['dataframe'], dict(row_break=10, col_break=50))
+        names = [k for k, v in value.children]
+        self.assertEqual(names[49:51], ['c49', 'c150'])
+        column = value.children[-1][1]
+        self.assertEqual(column.meta, {'len': 30})
+        self.assertEqual(column.children[-1][1].val_repr, '228')
+        self.assertEqual(column.val_repr, '0 = 199; 1 = 200; 2 = 201; ...; 27 = 226; 28 = 227; 29 = 228')
+
+        # The row index is formatted once for all the columns, and the column names once
+        from birdseye import bird
+        formatted = []
+        original_format = bird.format_pandas_index
+
+        def format_pandas_index(index):
+            formatted.append(len(index))
+            return original_format(index)
+
+        bird.format_pandas_index = format_pandas_index
+        try:
+            def to_json(v):
+                return json.dumps(v, default=NodeValue.as_json)
+
+            self.assertEqual(to_json(expand(frame, 3)), to_json(value))
+        finally:
+            bird.format_pandas_index = original_format
+        self.assertEqual(formatted, [100, 20])
+
+    def test_register_opaque(self):
+        from io import StringIO
+        from birdseye.bird import register_opaque, _opaque_classes, _expansion_infos
+
+        class LazyQuery(object):
+            def __init__(self):
+                self.results = [1, 2, 3]
+
+            def __len__(self):
+                raise AssertionError('len() called')
+
+            def __repr__(self):
+                raise AssertionError('repr() called')
+
+        @eye
+        def f(q):
+            return q
+
+        register_opaque(LazyQuery)
+        try:
+            query = LazyQuery()
+            opaque_repr = '<LazyQuery instance at %#x>' % id(query)
+            holder = NormalClass()
+            holder.query = query
+            value = NodeValue.expression(eye.num_samples, holder, 3)
+            child = dict(value.children)['query']
+            self.assertEqual(child.val_repr, opaque_repr)
+            self.assertIsNone(child.meta)
+            self.assertIsNone(child.children)
+
+            # The repr is only used by birdseye, not registered with cheap_repr
+            self.assertNotIn(LazyQuery, repr_registry)
+
+            # Including the repr of arguments and return values
+            call = get_call_stuff(get_call_ids(lambda: f(query))[0]).call
+            self.assertEqual(call.arguments, json.dumps([['q', opaque_repr]]))
+            self.assertEqual(call.return_value, opaque_repr)
+        finally:
+            _opaque_classes.remove(LazyQuery)
+            _expansion_infos.clear()
+
+        # Files are inspected as usual
+        stream = StringIO('some text')
+        value = NodeValue.expression(eye.num_samples, stream, 3)
+        self.assertNotIn('instance at', value.val_repr)
+
+    def test_register_expander(self):
+        from birdseye.bird import register_expander, _expanders, _expansion_infos
+
+        class Point(object):
+            def __init__(self, x, y):
+                self.x = x
+                self.y = y
+                self.cache = list(range(100))
+
+        class Point3D(Point):
+            pass
+
+        expand = partial(NodeValue.expression, eye.num_samples)
+        self.assertEqual([child[0] for child in expand(Point(1, 2), 3).as_json()[3:]],
+                         ['cache', 'x', 'y'])
+
+        @register_expander(Point)
+        def expand_point(point, add_child, samples):
+            self.assertEqual(samples, eye.num_samples['big'])
+            add_child('x', point.x)
+            add_child('y', point.y)
+
+        try:
+            for point in [Point(1, 2), Point3D(1, 2)]:
+                self.assertEqual([(key, child.val_repr) for key, child in expand(point, 3).children],
+                                 [('x', '1'), ('y', '2')])
+            self.assertEqual(expand(Point(1, 2), 0).as_json()[3:], [])
+
+            @register_expander(Point3D)
+            def expand_point_3d(point, add_child, samples):
+                add_child('x', point.x)
+                raise ValueError('no z')
+
+            with self.assertWarns(UserWarning):
+                value = expand(Point3D(1, 2), 3)
+            self.assertEqual([(key, child.val_repr) for key, child in value.children],
+                             [('x', '1')])
+        finally:
+            del _expanders[Point]
+            _expanders.pop(Point3D, None)
+            _expansion_infos.clear()
+
+    def test_expression_memo(self):
+        expand = partial(NodeValue.expression, eye.num_samples)
+
+        for val in [1, 'abc', (1, ('x', None))]:
+            self.assertIs(expand(val, 3), expand(val, 3))
+
+        # Equal values which are recorded differently aren't mixed up
+        self.assertEqual([expand(val, 3).val_repr for val in [1, True, 1.0, 0.0, -0.0, (1,), (True,)]],
+                         ['1', 'True', '1.0', '0.0', '-0.0', '(1,)', '(True,)'])
+
+        value = expand(5, 3)
+        with_calls = value.with_meta('inner_calls', ['abc'])
+        self.assertEqual(with_calls.meta, {'inner_calls': ['abc']})
+        self.assertIsNone(value.meta)
+        self.assertIs(expand(5, 3), value)
+
+        # Changing the samples in place changes the children of tuples
+        samples = copy(eye.num_samples)
+        samples['big'] = dict(samples['big'], list=4)
+        value = NodeValue.expression(samples, tuple(range(10)), 3)
+        self.assertEqual(len(value.children), 4)
+        samples['big']['list'] = 6
+        value = NodeValue.expression(samples, tuple(range(10)), 3)
+        self.assertEqual(len(value.children), 6)
+
+        # Values are recorded again after cheap_repr settings change
+        from birdseye.bird import _expression_memo
+        from cheap_repr import find_repr_function
+
+        repr_str = find_repr_function(str)
+        maxparts = repr_str.maxparts
+        self.assertIn('...', expand('x' * 80, 3).val_repr)
+        try:
+            repr_str.maxparts = 100
+            _expression_memo.check_repr_settings()
+            self.assertEqual(expand('x' * 80, 3).val_repr, repr('x' * 80))
+        finally:
+            repr_str.maxparts = maxparts
+            _expression_memo.check_repr_settings()
+
+    def test_stable_values(self):
+        from types import ModuleType
+
+        module = ModuleType('stable_module')
+        module.x = 1
+        module.f = lambda: 0
+        expand = partial(NodeValue.expression, eye.num_samples)
+
+        first = expand(module, 2)
+        self.assertIs(expand(module, 2), first)
+
+        module.x = 2
+        third = expand(module, 2)
+        self.assertIsNot(third, first)
+        self.assertEqual(dict((k, v.val_repr) for k, v in third.children)['x'], '2')
+
+        # A new attribute value with the same id as the old one is still noticed.
+        # The strings are too long to be kept alive by the memo.
+        module.x = 'a' * 200
+        expand(module, 2)
+        del module.x
+        module.x = 'c' * 200
+        self.assertIn('ccc', dict((k, v.val_repr) for k, v in expand(module, 2).children)['x'])
+
+        # Modifying the samples in place isn't missed either
+        samples = copy(eye.num_samples)
+        samples['small'] = dict(samples['small'], attributes=1)
+        self.assertEqual(len(NodeValue.expression(samples, module, 2).children), 1)
+        samples['small']['attributes'] = 50
+        self.assertEqual(len(NodeValue.expression(samples, module, 2).children), 7)
+
+        # Changes inside mutable attributes can't be noticed, so those values aren't shared
+        module.items = [1]
+        fourth = expand(module, 2)
+        self.assertIsNot(expand(module, 2), fourth)
+        module.items.append(2)
+        self.assertEqual(dict((k, v.val_repr) for k, v in expand(module, 2).children)['items'],
+                         '[1, 2]')
+
+    def test_reassigned_module_attribute(self):
+        from types import ModuleType
+
+        module = ModuleType('reassigned_module')
+
+        @eye
+        def f():
+            return module
+
+        def recorded_value():
+            stuff = get_call_stuff(get_call_ids(f)[0])
+            value = only(v for v in stuff.call_data['node_values'].values()
+                         if isinstance(v, list) and 'reassigned_module' in v[0])
+            return dict((k, v[0]) for k, v in value[3:])['value']
+
+        module.value = 'a' * 200
+        self.assertIn('aaa', recorded_value())
+        module.value = 'c' * 200
+        self.assertIn('ccc', recorded_value())
+
     def test_against_files(self):
 
         @register_repr(weakref.ref)
@@ -411,6 +794,10 @@ class TestBirdsEye(unittest.TestCase):
         def normalise_addresses(string):
             return re.sub(r'at 0x\w+>', 'at 0xABC>', string)
 
+        def function_data(function):
+            result = byteify(json.loads(function.data))
+            return result, render_html_body(result.pop('html'))
+
         for name, calls in golden_calls.items():
             data = [dict(
                 arguments=byteify(json.loads(normalise_addresses(call.arguments))),
@@ -420,9 +807,9 @@ class TestBirdsEye(unittest.TestCase):
                 data=normalise_call_data(normalise_addresses(call.data)),
                 function=dict(
                     name=byteify(call.function.name),
-                    html_body=byteify(call.function.html_body),
+                    html_body=function_data(call.function)[1],
                     lineno=call.function.lineno,
-                    data=byteify(json.loads(call.function.data)),
+                    data=function_data(call.function)[0],
                 ),
             ) for call in calls]
             version = ('pypy' if PYPY else '') + '.'.join(map(str, sys.version_info[:2]))
@@ -434,6 +821,73 @@ class TestBirdsEye(unittest.TestCase):
             else:
                 self.assertEqual(data, byteify(file_to_json(path)))
 
+    def test_server_renders_html_body(self):
+        from birdseye.server import app
+
+        call_id = get_call_ids(bar)[0]
+        with eye.db.session_scope() as session:
+            func = session.query(Call).filter_by(id=call_id).one().function
+            func.html_body = None
+
+        response = app.test_client().get('/call/' + call_id)
+        self.assertEqual(response.status_code, 200)
+        with eye.db.session_scope() as session:
+            html_body = session.query(Call).filter_by(id=call_id).one().function.html_body
+        self.assertIn('<span data-index=', html_body)
+        self.assertIn(html_body, response.get_data(as_text=True))
+
+    def test_call_limits(self):
+        from birdseye.server import app
+
+        @eye
+        def many_values():
+            x = [1, 2, 3]
+            for i in range(10):
+                x + [i]
+            return x
+
+        def call_data(limits):
+            for name, limit in limits.items():
+                setattr(eye, name, limit)
+            try:
+                call_id = get_call_ids(many_values)[0]
+            finally:
+                eye.max_values_per_call = 100000
+                eye.max_call_data_size = 50 * 1024 * 1024
+            with eye.db.session_scope() as session:
+                data = session.query(Call).filter_by(id=call_id).one().parsed_data
+            return call_id, data
+
+        def all_values(data):
+            values = []
+            for value in data['node_values'].values():
+                if isinstance(value, dict):
+                    values.extend(value.values())
+                else:
+                    values.append(value)
+            return values
+
+        _, full_data = call_data({})
+        self.assertNotIn('truncated', full_data)
+
+        # The first values are recorded in full, then without children, then not at all
+        call_id, data = call_data(dict(max_values_per_call=16))
+        self.assertTrue(data['truncated'])
+        sums = only(iterations for iterations in data['node_values'].values()
+                    if isinstance(iterations, dict) and iterations['0'][0] == '[1, 2, 3, 0]')
+        self.assertEqual(len(sums['0']), 7)
+        self.assertEqual(sums['2'], ['[1, 2, 3, 2]', 5, {'len': 4}])
+        self.assertEqual(sums['5'], ['', -2, {}])
+        response = app.test_client().get('/call/' + call_id)
+        self.assertIn('some values are shortened or missing', response.get_data(as_text=True))
+
+        # Only which expressions ran is kept when the data is too big
+        _, data = call_data(dict(max_call_data_size=1000))
+        self.assertTrue(data['truncated'])
+        values = all_values(data)
+        self.assertEqual(len(values), len(all_values(full_data)))
+        self.assertEqual([value for value in values if value != ['', -2, {}]], [])
+
     def test_decorate_class(self):
         with self.assertRaises(TypeError) as e:
             # noinspection PyUnusedLocal
@@ -584,6 +1038,22 @@ class TestBirdsEye(unittest.TestCase):
 
         test_A()
 
+    def test_no_tracing_inside_hooks(self):
+        class A(object):
+            @eye
+            def __repr__(self):
+                return 'A()'
+
+        @eye
+        def f(a):
+            return a
+
+        a = A()
+
+        # repr(a) is only called by the hooks recording the values in f
+        self.assertEqual(len(get_call_ids(lambda: f(a))), 1)
+        self.assertEqual(len(get_call_ids(lambda: repr(a))), 1)
+
     def test_unicode(self):
         @eye
         def f():
@@ -607,6 +1077,164 @@ class TestBirdsEye(unittest.TestCase):
         finally:
             eye.enter_call = call
 
+    def test_sampled_eye(self):
+        @eye(sample_rate=0)
+        def never(x):
+            return x * 3
+
+        @eye(sample_rate=1)
+        def always(x):
+            return x * 4
+
+        @eye(when=lambda x, big=False: big or x > 10)
+        def sometimes(x, big=False):
+            return x * 5
+
+        @eye(sample_rate=0, optional=True)
+        def explicit(x):
+            return x * 6
+
+        call_stuff = get_call_stuff(get_call_ids(lambda: always(2))[0])
+        self.assertEqual(call_stuff.call.result, '8')
+        call_stuff = get_call_stuff(get_call_ids(lambda: sometimes(20))[0])
+        self.assertEqual(call_stuff.call.result, '100')
+        call_stuff = get_call_stuff(get_call_ids(lambda: sometimes(1, big=True))[0])
+        self.assertEqual(call_stuff.call.result, '5')
+        call_stuff = get_call_stuff(get_call_ids(lambda: explicit(2, trace_call=True))[0])
+        self.assertEqual(call_stuff.call.result, '12')
+
+        @eye
+        def outer(x):
+            return always(x) + 1
+
+        call_ids = get_call_ids(lambda: outer(1))
+        self.assertEqual(get_inner_call_ids(call_ids[0]), call_ids[1:])
+
+        call = eye.enter_call
+        eye.enter_call = lambda *args, **kwargs: 1 / 0
+        try:
+            self.assertEqual(never(3), 9)
+            self.assertEqual(sometimes(3), 15)
+            self.assertEqual(explicit(3), 18)
+        finally:
+            eye.enter_call = call
+
+        with self.assertRaises(ValueError):
+            eye(sample_rate=2)
+
+    def test_lazy_eye(self):
+        instrumented = []
+        trace_function = eye.trace_function
+
+        def counting_trace_function(func, *args, **kwargs):
+            instrumented.append(func.__name__)
+            return trace_function(func, *args, **kwargs)
+
+        eye.trace_function = counting_trace_function
+        try:
+            @eye(lazy=True)
+            def f(x):
+                return x * 7
+
+            @eye(lazy=True, optional=True)
+            def g(x):
+                return x * 8
+
+            self.assertEqual(f.__name__, 'f')
+            self.assertEqual(instrumented, [])
+
+            self.assertEqual(g(1), 8)
+            self.assertEqual(g(2, trace_call=False), 16)
+            self.assertEqual(instrumented, [])
+
+            call_ids = get_call_ids(lambda: [f(2), f(3), g(4, trace_call=True)])
+            self.assertEqual([get_call_stuff(i).call.result for i in call_ids], ['14', '21', '32'])
+            self.assertEqual(instrumented, ['f', 'g'])
+
+            @eye(lazy=True)
+            def calls_f():
+                return f(1)
+
+            call_ids = get_call_ids(calls_f)
+            self.assertEqual(get_inner_call_ids(call_ids[0]), call_ids[1:])
+        finally:
+            eye.trace_function = trace_function
+
+        with self.assertRaises(ValueError):
+            eye(lambda: 0, lazy=True)
+
+    def test_governor(self):
+        # Functions have already been decorated without a governor
+        with self.assertWarns(UserWarning):
+            eye.governor = OverheadGovernor(max_overhead=0, cooldown=60)
+        try:
+            @eye
+            def expensive(x):
+                return x + 1
+
+            @eye(sample_rate=1)
+            def sampled(x):
+                return x + 2
+
+            self.assertEqual(len(get_call_ids(lambda: [expensive(i) for i in range(3)])), 1)
+            self.assertEqual(len(get_call_ids(lambda: [sampled(i) for i in range(3)])), 1)
+            self.assertEqual(expensive(1), 2)
+
+            eye.governor.reset()
+            self.assertEqual(len(get_call_ids(lambda: expensive(1))), 1)
+
+            with self.assertWarns(UserWarning):
+                eye.governor = OverheadGovernor(max_overhead=None, max_calls_per_second=2)
+
+            @eye
+            def frequent(x):
+                return x + 3
+
+            @eye
+            def calls_frequent():
+                return frequent(0)
+
+            self.assertEqual(len(get_call_ids(lambda: [frequent(i) for i in range(10)])), 3)
+
+            eye.governor.reset()
+            call_ids = get_call_ids(calls_frequent)
+            self.assertEqual(get_inner_call_ids(call_ids[0]), call_ids[1:])
+        finally:
+            eye.governor = None
+
+        self.assertNotIn('enter_call', eye.__dict__)
+        self.assertEqual(len(get_call_ids(lambda: frequent(1))), 1)
+
+    def test_governor_subclass(self):
+        exited = []
+
+        class MyEye(BirdsEye):
+            def exit_call(self, exit_info):
+                exited.append(exit_info.current_frame.f_code.co_name)
+                super(MyEye, self).exit_call(exit_info)
+
+        my_eye = MyEye()
+        my_eye.writer = CallWriter(my_eye)
+        my_eye.writer.add_call = lambda record: None
+        my_eye.governor = OverheadGovernor(max_overhead=None)
+
+        @my_eye
+        def f():
+            return 1
+
+        # The governor times the overridden hook
+        self.assertEqual(f(), 1)
+        self.assertEqual(exited, ['f'])
+        self.assertIn('exit_call', my_eye.__dict__)
+
+        # Hooks set on the instance by someone else are left alone
+        my_eye.after_stmt = after_stmt = lambda *args: None
+        my_eye.governor = None
+        self.assertEqual(f(), 1)
+        self.assertEqual(exited, ['f', 'f'])
+        self.assertNotIn('exit_call', my_eye.__dict__)
+        self.assertIs(my_eye.after_stmt, after_stmt)
+
     def test_first_check(self):
         def deco(f):
             f.attr = 3
@@ -649,16 +1277,311 @@ class TestBirdsEye(unittest.TestCase):
         indexes = [i['index'] for i in iteration_list]
         self.assertEqual(indexes, [0, 1, 2, 12, 13, 17, 18, 19])
 
+    def test_nested_loop_expansion_levels(self):
+        @eye
+        def f():
+            for i in range(2):
+                for j in range(2):
+                    str([[[i, j]]])
+
+        stuff = get_call_stuff(get_call_ids(f)[0])
+        values = only(
+            values
+            for values in stuff.call_data['node_values'].values()
+            if isinstance(values, dict) and isinstance(values['0'], dict)
+            and values['0']['0'][0].startswith('[[[')
+        )
+
+        def depth(value):
+            return 1 + max([depth(child) for _, child in value[3:]] or [-1])
+
+        # Values are only expanded fully while all the loops are in their first iteration
+        self.assertEqual(depth(values['0']['0']), 3)
+        self.assertEqual(depth(values['0']['1']), 1)
+        self.assertEqual(depth(values['1']['0']), 1)
+        self.assertEqual(depth(values['1']['1']), 1)
+
+    def test_skipped_iterations(self):
+        @eye
+        def f():
+            for i in range(20):
+                y = i * 3
+                if i == 10:
+                    str(y)
+
+        stuff = get_call_stuff(get_call_ids(f)[0])
+        iteration_list = only(stuff.call_data['loop_iterations'].values())
+        indexes = [i['index'] for i in iteration_list]
+        self.assertEqual(indexes, [0, 1, 2, 10, 17, 18, 19])
+
+        def reprs(position):
+            return {
+                values[str(position)][0]
+                for values in stuff.call_data['node_values'].values()
+                if str(position) in values
+            }
+
+        # Only expressions evaluated after it turned out that the iteration
+        # was needed have values, the rest just show that they ran
+        self.assertIn('30', reprs(3))
+        self.assertIn("'30'", reprs(3))
+        self.assertNotIn('10', reprs(3))
+        self.assertIn('57', reprs(6))
+
+        @eye
+        def h():
+            for i in range(20):
+                y = i * 3
+                if i == 10:
+                    str(y)
+                if i == 15:
+                    break
+
+        stuff = get_call_stuff(get_call_ids(h)[0])
+        iteration_list = only(stuff.call_data['loop_iterations'].values())
+        indexes = [i['index'] for i in iteration_list]
+
+        # The last three iterations are kept even though the loop ended early,
+        # and since it could, no values were skipped
+        self.assertEqual(indexes, [0, 1, 2, 10, 13, 14, 15])
+        self.assertIn('39', reprs(4))
+        self.assertIn('42', reprs(5))
+        self.assertIn('45', reprs(6))
+
+        @eye
+        def g(n):
+            return [x * 2 if x != 50 else -x for x in range(n)]
+
+        stuff = get_call_stuff(get_call_ids(lambda: g(100))[0])
+        iteration_list = only(stuff.call_data['loop_iterations'].values())
+        indexes = [i['index'] for i in iteration_list]
+        self.assertEqual(indexes, [0, 1, 2, 50, 97, 98, 99])
+        self.assertIn('-50', reprs(3))
+        self.assertIn('198', reprs(6))
+
+    def test_code_cache(self):
+        directory = mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        source = 'def f(x):\n    return [y * 2 for y in x]\n'
+        filename = os.path.join(directory, 'cached_module.py')
+
+        def compile_file():
+            tracer = BirdsEye()
+            tracer.code_cache = CodeCache(directory)
+            return tracer.compile(source, filename)
+
+        original = compile_file()
+        self.assertEqual(len(os.listdir(directory)), 1)
+
+        # The same hook names can't be used by two tracers in one process
+        self.assertNotEqual(compile_file().frame_info_name, original.frame_info_name)
+
+        # The names can be used again once the code using them is gone
+        frame_info_name = original.frame_info_name
+        del original
+        BirdsEye.compile.cache_clear()
+        TreeTracerBase.compile.cache_clear()
+        gc.collect()
+        loaded = compile_file()
+        self.assertEqual(loaded.frame_info_name, frame_info_name)
+
+        # Compare with the file instrumented from scratch, which gets new names
+        original = compile_file()
+        self.assertNotEqual(original.frame_info_name, loaded.frame_info_name)
+        self.assertEqual(loaded.code.co_code, original.code.co_code)
+        self.assertEqual(len(loaded.nodes), len(original.nodes))
+        for node, original_node in zip(loaded.nodes, original.nodes):
+            self.assertEqual(type(node), type(original_node))
+            self.assertEqual([n._tree_index for n in node._loops],
+                             [n._tree_index for n in original_node._loops])
+            self.assertEqual(getattr(node, '_is_interesting_expression', None),
+                             getattr(original_node, '_is_interesting_expression', None))
+            if hasattr(original_node, 'first_token'):
+                self.assertEqual(loaded.tokens.get_text_range(node),
+                                 original.tokens.get_text_range(original_node))
+
+        CodeCache(directory, max_size=0).store(BirdsEye(), 'x = 1', filename, 0, dict(names=[]))
+        self.assertEqual(os.listdir(directory), [])
+
+    def test_eye_code_cache(self):
+        directory = mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        original_cache = eye.code_cache
+        eye.code_cache = CodeCache(directory)
+        try:
+            source = 'def f(x):\n    return [y * 2 for y in x]\n\nf([1, 2])\n'
+            filename = os.path.join(directory, 'eye_cached_module.py')
+
+            def run():
+                BirdsEye.compile.cache_clear()
+                TreeTracerBase.compile.cache_clear()
+                gc.collect()
+                call_ids = get_call_ids(lambda: eye.exec_string(source, filename, deep=True))
+                return [get_call_stuff(c_id).call.return_value for c_id in call_ids]
+
+            self.assertEqual(run(), ['None', '[2, 4]'])
+            entries = sorted(os.listdir(directory))
+            self.assertTrue(entries)
+
+            # The second run loads the instrumented code from the cache
+            self.assertEqual(run(), ['None', '[2, 4]'])
+            self.assertEqual(sorted(os.listdir(directory)), entries)
+        finally:
+            eye.code_cache = original_cache
+
+    def test_function_registration(self):
+        directory = mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        db_uri = os.path.join(directory, 'functions.db')
+        source = '\n'.join('def f%s(x):\n    return x + %s\n' % (i, i) for i in range(3)) + 'f1(3)\n'
+        filename = os.path.join(directory, 'functions_module.py')
+
+        def run(tracer):
+            tracer.code_cache = CodeCache(directory)
+            tracer.exec_string(source, filename, deep=True)
+            with tracer.db.session_scope() as session:
+                return sorted(
+                    (func.name, [call.return_value for call in func.calls])
+                    for func in session.query(tracer.db.Function)
+                )
+
+        tracer = BirdsEye(db_uri)
+        batches = []
+        db_function_ids = tracer._db_function_ids
+
+        def count_batches(rows):
+            batches.append(len(rows))
+            return db_function_ids(rows)
+
+        tracer._db_function_ids = count_batches
+        expected = [
+            (FILE_SENTINEL_NAME, ['None']),
+            ('f0', []),
+            ('f1', ['4']),
+            ('f2', []),
+        ]
+        self.assertEqual(run(tracer), expected)
+        self.assertEqual(batches, [4])
+
+        # A new process with unchanged code finds the IDs in the cache
+        cache._names_in_use.clear()
+        tracer = BirdsEye(db_uri)
+        tracer._db_function_ids = None
+        expected[0] = (FILE_SENTINEL_NAME, ['None', 'None'])
+        expected[2] = ('f1', ['4', '4'])
+        self.assertEqual(run(tracer), expected)
+
+        # The cached IDs are no longer valid after the database is cleared
+        tracer.db.clear()
+        cache._names_in_use.clear()
+        self.assertEqual(run(BirdsEye(db_uri)), [
+            (FILE_SENTINEL_NAME, ['None']),
+            ('f0', []),
+            ('f1', ['4']),
+            ('f2', []),
+        ])
+
+    def test_store_functions_error(self):
+        tracer = BirdsEye(os.path.join(mkdtemp(), 'functions.db'))
+        row = dict(file='f.py', name='f', type='function', lineno=1,
+                   data='{}', body_hash='body', hash='f_hash')
+        tracer._pending_functions['f_hash'] = row
+        tracer._db_function_ids = lambda rows: 1 / 0
+        with self.assertRaises(ZeroDivisionError):
+            tracer._function_id('f_hash')
+
+        # The function is stored next time
+        self.assertEqual(tracer._pending_functions, {'f_hash': row})
+        del tracer._db_function_ids
+        self.assertIsInstance(tracer._function_id('f_hash'), int)
+        self.assertEqual(tracer._pending_functions, {})
+
+    def test_background_writer(self):
+        original_writer = eye.writer
+        writer = eye.writer = BackgroundCallWriter(eye, max_batch_size=3, flush_interval=60)
+        try:
+            ids = get_call_ids(lambda: [sleepy(i, 0) for i in range(5)])
+            writer.flush()
+            self.assertEqual(writer.written, 5)
+            self.assertEqual(writer.dropped, 0)
+
+            # Calls finishing after the writer is closed are dropped
+            writer.close()
+            sleepy(3, 0)
+            self.assertEqual(writer.written, 5)
+            self.assertEqual(writer.dropped, 1)
+        finally:
+            writer.close()
+            eye.writer = original_writer
+
+        results = [int(get_call_stuff(i).call.result) for i in ids]
+        self.assertEqual(results, list(range(0, 10, 2)))
+
+    def test_background_writer_queue_full(self):
+        release = Event()
+        written = []
+
+        class SlowTracer(object):
+            def _write_calls(self, records):
+                release.wait()
+                written.extend(records)
+
+        writer = BackgroundCallWriter(SlowTracer(), max_queue_size=1, flush_interval=0)
+        writer.add_call(1)
+        while not writer._queue.empty():
+            sleep(0.01)
+
+        # The first call is being written, so only one more fits in the queue
+        for i in range(2, 5):
+            writer.add_call(i)
+        self.assertEqual(writer.dropped, 2)
+
+        release.set()
+        writer.close()
+        self.assertEqual(written, [1, 2])
+        self.assertEqual(writer.written, 2)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires os.fork')
+    def test_background_writer_fork(self):
+        written = []
+
+        class Tracer(object):
+            def _write_calls(self, records):
+                written.extend(records)
+
+        writer = BackgroundCallWriter(Tracer(), flush_interval=0)
+        writer.add_call(1)
+        writer.flush()
+
+        read_fd, write_fd = os.pipe()
+        with warnings.catch_warnings():
+            # Python 3.12 warns about forking while the writer thread is running
+            warnings.simplefilter('ignore', DeprecationWarning)
+            pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            try:
+                writer.add_call(2)
+                writer.flush()
+                os.write(write_fd, repr((written, writer.written)).encode())
+            finally:
+                os._exit(0)
+
+        os.close(write_fd)
+        with os.fdopen(read_fd) as f:
+            result = f.read()
+        os.waitpid(pid, 0)
+        writer.close()
+        self.assertEqual(result, repr(([1, 2], 1)))
+        self.assertEqual(written, [1])
+
     @classmethod
     def tearDownClass(cls):
         assert not eye.stack, eye.stack
-        assert not eye.main_to_secondary_frames, eye.main_to_secondary_frames
-        assert not eye.secondary_to_main_frames, eye.secondary_to_main_frames
 
 
 @eye
-def sleepy(x):
-    sleep(random.random())
+def sleepy(x, max_sleep=1):
+    sleep(random.random() * max_sleep)
     return x * 2
 
 
@@ -1,6 +1,10 @@
+import os
+import subprocess
+import sys
 import unittest
+from tempfile import mkdtemp
 
-from birdseye.db import Database
+from birdseye.db import Database, get_database
 
 
 class TestDatabase(unittest.TestCase):
@@ -15,6 +19,33 @@ class TestDatabase(unittest.TestCase):
         kv.thing = 'bar'
         self.assertEqual(kv.thing, 'bar')
 
+    def test_get_database(self):
+        db_uri = os.path.join(mkdtemp(), 'shared.db')
+        db = get_database(db_uri)
+        self.assertIs(get_database(db_uri), db)
+
+        # Clearing the tables means they have to be created again
+        db.clear()
+        self.assertIsNot(get_database(db_uri), db)
+
+    def test_tracing_without_sqlalchemy(self):
+        # Tracing a call only needs the database once the call is written
+        code = '''
+import sys
+from birdseye.bird import BirdsEye
+
+eye = BirdsEye()
+records = []
+eye.writer.add_call = records.append
+eye.exec_string('def f(x): return x + 1\\nf(1)', 'code.py', deep=True)
+print(len(records), 'sqlalchemy' in sys.modules)
+'''
+        output = subprocess.check_output(
+            [sys.executable, '-c', code],
+            env=dict(os.environ, OUTDATED_IGNORE='1'),
+        )
+        self.assertEqual(output.decode().strip(), '2 False')
+
 
 if __name__ == '__main__':
     unittest.main()
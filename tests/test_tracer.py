@@ -21,3 +21,106 @@ async def f(): pass""")
                 exec("""
 @tracer
 async def f(): yield 1""")
+
+    def test_needs_expr_hooks(self):
+        import ast
+        from birdseye.tracer import TreeTracerBase
+
+        class Tracer(TreeTracerBase):
+            def __init__(self):
+                super(Tracer, self).__init__()
+                self.nodes = []
+
+            def needs_expr_hooks(self, node):
+                return not isinstance(node, ast.Constant)
+
+            def before_expr(self, node, frame):
+                self.nodes.append(node)
+
+        tracer = Tracer()
+
+        @tracer
+        def f(x):
+            return [x + 1, 'a']
+
+        self.assertEqual(f(2), [3, 'a'])
+        self.assertEqual([type(node).__name__ for node in tracer.nodes],
+                         ['List', 'BinOp', 'Name'])
+
+    def test_statement_hooks(self):
+        from birdseye.tracer import TreeTracerBase
+
+        class Tracer(TreeTracerBase):
+            def __init__(self):
+                super(Tracer, self).__init__()
+                self.events = []
+
+            def before_stmt(self, node, frame):
+                self.events.append(('before', node.lineno))
+
+            def after_stmt(self, node, frame, exc_value, exc_traceback, exc_node):
+                self.events.append(('after', node.lineno, type(exc_value).__name__))
+                # Suppress the exception raised by `1 / 0`
+                return isinstance(exc_value, ZeroDivisionError)
+
+            def exit_call(self, exit_info):
+                self.events.append(('exit', exit_info.return_value))
+
+        tracer = Tracer()
+
+        @tracer
+        def f():
+            for i in range(3):
+                if i:
+                    break
+                1 / 0
+            return i
+
+        # The line of the decorator
+        start = f.__code__.co_firstlineno
+        self.assertEqual(f(), 1)
+        self.assertEqual(
+            [event[:1] + (event[1] - start,) + event[2:] if event[0] != 'exit' else event
+             for event in tracer.events],
+            [
+                ('before', 2),
+                ('before', 3),
+                ('after', 3, 'NoneType'),
+                ('before', 5),
+                ('after', 5, 'ZeroDivisionError'),
+                ('before', 3),
+                ('before', 4),
+                ('after', 4, 'NoneType'),
+                ('after', 3, 'NoneType'),
+                ('after', 2, 'NoneType'),
+                ('before', 6),
+                ('after', 6, 'NoneType'),
+                ('exit', 1),
+            ])
+        self.assertFalse(tracer.stack)
+
+    def test_code_index(self):
+        from birdseye.tracer import TreeTracerBase
+
+        source = '''
+def f():
+    def g():
+        pass
+    return g
+
+
+class A:
+    @staticmethod
+    def g():
+        return [x for x in []]
+'''
+        traced_file = TreeTracerBase().compile(source, 'code_index.py')
+        outer_g, = traced_file.find_codes(3, 'g')
+        method_g, = traced_file.find_codes(9, 'g')
+        self.assertEqual(traced_file.find_codes(10, 'g'), [])
+        self.assertEqual(traced_file.function_node(outer_g).lineno, 3)
+        self.assertEqual(traced_file.function_node(method_g).lineno, 10)
+
+        uninstrumented_g, = traced_file.find_codes(9, 'g', instrumented=False)
+        self.assertNotEqual(uninstrumented_g.co_code, method_g.co_code)
+        self.assertIs(traced_file.function_node(uninstrumented_g), traced_file.function_node(method_g))